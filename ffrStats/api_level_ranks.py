@@ -9,53 +9,67 @@ that contains a valid FFR API key in JSON format:
 
 Note that the FFR API is a bit sketchy. The resulting data produced by
 this script is not guaranteed to be 100% accurate.
+
+API responses are cached on disk (see ffrapi.py), so running this again
+for the same user within 'cache_ttl' seconds makes no network request.
 """
 
 from collections import OrderedDict
 from tabulate import tabulate
+import ffrapi
 import json
-import os
-import requests
+import profiling
 import sys
 
 output_file = 'level_ranks.txt'
+cache_ttl = ffrapi.CACHE_TTL
 
 # check for valid arguments
+profiling.parse_args(sys.argv)
 if len(sys.argv) != 2:
 	print('Invalid argument format. Please call this script with the following format:')
-	print('\tpython3 api_level_ranks.py <username>')
+	print('\tpython3 api_level_ranks.py <username> [--profile[=FILE]] [--profile-phase=NAME]')
 	sys.exit()
 
 # set up variables
 username = sys.argv[1]
 api_key = json.loads(open('credentials', 'r').read())['key']
-url = 'http://www.flashflashrevolution.com/api/api.php?key=' + api_key + '&action=ranks&username=' + username
+api = ffrapi.FFRApi(api_key, ttl=cache_ttl)
 
-# call the API and check for errors
+# call the API and check for errors; songs are read one at a time as they are parsed
 print('[+] Fetching level ranks...')
-json_ranks = requests.get(url).json()
-if 'error' in json_ranks:
-	print('ERROR: Invalid user specified')
+levels = []
+songs = 0
+try:
+	with profiling.phase('read songs'):
+		for level, song in api.iter_songs(username):
+			# extract meaningful data for each level
+			difficulty = int(song['info']['difficulty'])
+			rank = int(song['scores']['rank'])
+			name = song['info']['name']
+			songs += 1
+
+			if rank != 1:
+				levels.append(OrderedDict([('D', difficulty),
+					('Rank', rank),
+					('Name', name)]))
+		profiling.add(rows=songs)
+except ffrapi.ApiError as e:
+	print('ERROR: ' + str(e))
 	sys.exit()
 
+if api.requests == 0:
+	print('[+] Used cached API response')
 print('[+] Formatting level ranks...')
-levels = []
-for level in json_ranks['songs']:
-	# extract meaningful data for each level
-	difficulty = int(json_ranks['songs'][level]['info']['difficulty'])
-	rank = int(json_ranks['songs'][level]['scores']['rank'])
-	name = json_ranks['songs'][level]['info']['name']
-
-	if rank != 1:
-		levels.append(OrderedDict([('D', difficulty),
-			('Rank', rank),
-			('Name', name)]))
 
 # sort the level data primarily by difficulty, and secondly by highest rank
-sorted_levels = sorted(levels, key=lambda level:level['Rank'], reverse=True)
-sorted_levels = sorted(sorted_levels, key=lambda level:level['D'])
+with profiling.phase('sort'):
+	sorted_levels = sorted(levels, key=lambda level:level['Rank'], reverse=True)
+	sorted_levels = sorted(sorted_levels, key=lambda level:level['D'])
 
-with open(output_file, 'w') as f:
-    f.write(tabulate(sorted_levels, headers='keys', tablefmt='presto'))
+with profiling.phase('write'):
+	with open(output_file, 'w') as f:
+		f.write(tabulate(sorted_levels, headers='keys', tablefmt='presto'))
 
 print('[+] Level ranks written to ' + output_file)
+profiling.finish()
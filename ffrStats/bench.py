@@ -0,0 +1,470 @@
+"""
+Benchmarks for ffrStats.
+
+Run from this directory:
+    python3 bench.py [micro [rows]]
+    python3 bench.py site [--rows 100,2000,20000] [--song-pages 1,40,200] [--latency MS]
+        [--output FILE] [--compare FILE]
+    python3 bench.py check [--rows N]
+
+'check' only runs the correctness checks (streaming vs BeautifulSoup
+levelrank parsing, song catalog lookups) and exits non-zero if one fails.
+'micro' times the data structures on their own, after the same checks. 'site' runs the parsing,
+rendering and scraping code end to end against the local fakesite.py
+stand-in and writes the best time of each step to a JSON file; '--compare'
+lists the change from an earlier results file.
+"""
+
+from collections import OrderedDict
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from fakesite import COLUMNS, generate_rows
+import checkpoint
+import fakesite
+import ffrapi
+import ffrsession
+import levelarrows
+import planner
+import songdata
+import stats
+
+LEVEL_TIERS = json.load(open(songdata.TIERS_FILENAME, 'r'))
+
+# a step that gets this much slower than in the compared results is flagged; timings of the
+# same code on a busy machine easily differ by 10-20%
+REGRESSION_THRESHOLD = 0.25
+
+class DictLevelrank:
+    """The original dict-backed Levelrank with a linear tier walk, kept as a baseline"""
+    def __init__(self, row, cols):
+        self.rank = int(row[cols['rank']].replace(',', ''))
+        self.d = int(row[cols['d']])
+        self.level = row[cols['level']]
+        self.score = int(row[cols['score']].replace(',', '').replace('*', ''))
+        self.fc = '*' in row[cols['score']]
+        self.p = int(row[cols['p']].replace(',', ''))
+        self.g = int(row[cols['g']].replace(',', ''))
+        self.a = int(row[cols['a']].replace(',', ''))
+        self.m = int(row[cols['m']].replace(',', ''))
+        self.b = int(row[cols['b']].replace(',', ''))
+        self.c = int(row[cols['c']].replace(',', ''))
+        self.played = int(row[cols['played']].replace(',', ''))
+        self.arrows = songdata.level_arrows()[self.level]
+        self.tp = 0
+        self.tpmax = 0
+
+        if self.level in LEVEL_TIERS:
+            tiers = LEVEL_TIERS[self.level]
+            self.tpmax = len(tiers)
+            self.tp = self.tpmax
+
+            for tier in tiers:
+                if tier != 'Passed' and self.score >= int(tier):
+                    break
+                elif tier == 'Passed' and self.passed():
+                    break
+                self.tp -= 1
+
+    def passed(self):
+        return self.p + self.g + self.a + self.m == self.arrows
+
+def measure(fn, repeat=5):
+    """Returns (result, best seconds, peak traced bytes) for calls to fn"""
+    best = min(timeit.repeat(fn, number=1, repeat=repeat))
+
+    # memory is measured on a separate call since tracing slows everything down
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+def check_levelrank_parsers(n):
+    """The streaming parser yields the same Levelranks as BeautifulSoup, however the page is chunked"""
+    rows = generate_rows(n, unique=True)
+    # names that need escaping or fall outside ASCII
+    for i, name in enumerate(['Rock & Roll <Remix>', 'Caf\xe9 "Deluxe"', "Don't Stop"]):
+        rows[i % len(rows)][COLUMNS.index('level')] = name
+    content = fakesite.levelrank_page(rows).encode(ffrsession.ENCODING)
+
+    def slots(levelranks):
+        return [tuple(getattr(levelrank, slot) for slot in stats.Levelrank.__slots__) for levelrank in levelranks]
+
+    expected = slots(stats.extract_levelranks(ffrsession.parse_html(content)))
+    assert len(expected) == len(rows), 'BeautifulSoup found %d of %d rows' % (len(expected), len(rows))
+    level = stats.Levelrank.__slots__.index('level')
+    for size in (1, 7, 512, len(content)):
+        chunks = [content[i:i + size] for i in range(0, len(content), size)]
+        streamed = slots(stats.stream_levelranks(chunks))
+        for i, (want, got) in enumerate(zip(expected, streamed)):
+            assert got == want, 'chunks of %d bytes, row %d (%s): streamed %r, BeautifulSoup %r' % (
+                size, i + 1, want[level], got, want)
+        assert len(streamed) == len(expected), 'chunks of %d bytes: streamed %d of %d rows' % (
+            size, len(streamed), len(expected))
+
+def bench_levelrank(n):
+    check_levelrank_parsers(min(n, 500))
+    cols = {name: i for i, name in enumerate(COLUMNS)}
+    rows = generate_rows(n)
+
+    baseline, base_time, base_peak = measure(lambda: [DictLevelrank(row, cols) for row in rows])
+    current, cur_time, cur_peak = measure(lambda: [stats.Levelrank(row, cols) for row in rows])
+
+    assert [(l.tp, l.tpmax) for l in baseline] == [(l.tp, l.tpmax) for l in current]
+
+    print('Levelrank construction, %d rows' % n)
+    print('\tdict + linear tiers:  %7.1f ms  %6.1f bytes/row' % (1000 * base_time, base_peak / n))
+    print('\tslots + bisect tiers: %7.1f ms  %6.1f bytes/row' % (1000 * cur_time, cur_peak / n))
+
+def linear_tierpoints(tiers, score, passed):
+    """The original linear tier walk, kept as a baseline"""
+    tp = len(tiers)
+    for tier in tiers:
+        if tier != 'Passed' and score >= int(tier):
+            break
+        elif tier == 'Passed' and passed:
+            break
+        tp -= 1
+    return tp
+
+def bench_tierpoints(n):
+    rng = random.Random(0)
+    levels = sorted(LEVEL_TIERS)
+    lookups = []
+    for _ in range(n):
+        level = rng.choice(levels)
+        top = int(LEVEL_TIERS[level][0])
+        lookups.append((level, rng.randint(top - 20000, top + 100), rng.random() < 0.9))
+
+    baseline, base_time, _ = measure(lambda: [linear_tierpoints(LEVEL_TIERS[level], score, passed)
+        for level, score, passed in lookups])
+    current, cur_time, _ = measure(lambda: [songdata.tier_tables()[level].tierpoints(score, passed)
+        for level, score, passed in lookups])
+
+    assert baseline == current
+
+    print('Tier point lookups, %d rows' % n)
+    print('\tlinear walk: %7.1f ms' % (1000 * base_time))
+    print('\tbisect:      %7.1f ms' % (1000 * cur_time))
+
+def bench_songdata():
+    def load_json():
+        arrows = json.load(open(songdata.ARROWS_FILENAME, 'r'))
+        tables = {level: songdata.TierTable.from_tiers(tiers)
+            for level, tiers in json.load(open(songdata.TIERS_FILENAME, 'r')).items()}
+        return arrows, tables
+
+    def load_cache():
+        songdata._level_arrows = songdata._tier_tables = None
+        return songdata.level_arrows(), songdata.tier_tables()
+
+    load_cache()
+    _, json_time, _ = measure(load_json)
+    _, cache_time, _ = measure(load_cache)
+
+    print('Song metadata load')
+    print('\tJSON parse + compile: %7.2f ms' % (1000 * json_time))
+    print('\tbinary cache:         %7.2f ms' % (1000 * cache_time))
+
+def check_catalog():
+    """A tier-only level gets its own entry, and only a name cut short with '...' matches by prefix"""
+    tiers = dict(songdata.tier_tables())
+    name = max(sorted(tiers), key=len)
+    tier_table = tiers[name]
+    tiers['Brand New Tiered Level'] = tier_table
+    tiers[' %s ' % name.upper()] = tier_table
+    catalog = songdata.SongCatalog(songdata.level_arrows(), tiers)
+    song = catalog.get('Brand New Tiered Level')
+    assert song is not None and song.arrows is None and song.tier_table is tier_table
+    assert len(catalog) == len(songdata.level_arrows()) + 1
+    assert catalog.get(name[:-2] + '...').name == name
+    assert catalog.get(name[:-2]) is None and name[:-2] in catalog.missing
+
+def bench_catalog(n):
+    check_catalog()
+    catalog = songdata.catalog()
+    rng = random.Random(0)
+    names = [rng.choice(sorted(catalog.songs)) for _ in range(n)]
+    drifted = [' %s ' % name.upper() for name in names]
+
+    _, exact_time, _ = measure(lambda: [catalog.get(name) for name in names])
+    found, drifted_time, _ = measure(lambda: [catalog.get(name) for name in drifted])
+    assert sum(song is not None for song in found) > 0.95 * n
+
+    def scan():
+        return sorted((song for song in catalog.songs.values() if song.arrows is not None
+            and 1500 <= song.arrows <= 2000 and song.tpmax >= 10), key=lambda song: song.name)
+
+    baseline, scan_time, _ = measure(scan)
+    current, query_time, _ = measure(lambda: catalog.query(arrows=(1500, 2000), tpmax=(10, None)))
+    assert baseline == current
+
+    print('Song catalog, %d lookups' % n)
+    print('\texact name:       %7.2f ms' % (1000 * exact_time))
+    print('\tnormalized name:  %7.2f ms' % (1000 * drifted_time))
+    print('Songs with 1,500-2,000 arrows and 10+ tiers (%d of %d)' % (len(current), len(catalog)))
+    print('\tlinear scan:      %7.3f ms' % (1000 * scan_time))
+    print('\tsorted indexes:   %7.3f ms' % (1000 * query_time))
+
+def bench_planner(n, k=20):
+    cols = {name: i for i, name in enumerate(COLUMNS)}
+    levelranks = [stats.Levelrank(row, cols) for row in generate_rows(n)]
+    goals = [goal for levelrank in levelranks for goal in planner.level_goals(levelrank)]
+    key = lambda goal: (planner.score_cost(goal), -goal.tp)
+
+    _, goals_time, _ = measure(lambda: [goal for levelrank in levelranks for goal in planner.level_goals(levelrank)])
+    baseline, sort_time, _ = measure(lambda: sorted(goals, key=key)[:k])
+    current, heap_time, _ = measure(lambda: list(itertools.islice(planner.plan_goals(goals), k)))
+
+    assert [key(goal) for goal in baseline] == [key(goal) for goal in current]
+
+    print('Planner top %d of %d goals (%d levels)' % (k, len(goals), n))
+    print('\tlisting goals: %7.1f ms' % (1000 * goals_time))
+    print('\tfull sort:     %7.1f ms' % (1000 * sort_time))
+    print('\theap:          %7.1f ms' % (1000 * heap_time))
+
+def bench_rankmatrix(n, users=50, copies=20):
+    # numpy is only needed here, so the other benchmarks run without it
+    import numpy as np
+    import rankmatrix
+
+    cols = {name: i for i, name in enumerate(COLUMNS)}
+    levelranks = [('user%d' % i, [stats.Levelrank(row, cols) for row in generate_rows(n, seed=i, unique=True)])
+        for i in range(users)]
+    matrix = rankmatrix.RankMatrix.build(levelranks)
+
+    def loop():
+        aggregates = stats.Aggregates()
+        for _, user_levelranks in levelranks:
+            aggregates.merge(stats.Aggregates(user_levelranks))
+        return aggregates
+
+    baseline, loop_time, _ = measure(loop)
+    current, vector_time, _ = measure(lambda: matrix.band_totals().sum(axis=0))
+
+    for i, band in enumerate(current):
+        totals = baseline.groups['difficulty'].get(i)
+        assert band.tolist() == (totals.to_list() if totals else [0] * len(stats.Totals.FIELDS))
+
+    # the same users repeated, for a dataset too large to build from Levelrank objects here
+    big = rankmatrix.RankMatrix(['user%d' % i for i in range(users * copies)], matrix.levels,
+        {name: np.tile(array, (copies, 1)) for name, array in matrix.cells.items()}, matrix.level_data)
+    directory = tempfile.mkdtemp()
+    try:
+        big.save(directory)
+        loaded, mmap_time, _ = measure(lambda: rankmatrix.RankMatrix.load(directory))
+        _, read_time, _ = measure(lambda: rankmatrix.RankMatrix.load(directory, mmap=False))
+        _, bands_time, _ = measure(lambda: loaded.band_totals())
+    finally:
+        shutil.rmtree(directory)
+
+    print('Totals per difficulty over %d users (%d levels each)' % (users, min(n, len(matrix.levels))))
+    print('\tAggregates loop: %7.1f ms' % (1000 * loop_time))
+    print('\tRankMatrix:      %7.1f ms' % (1000 * vector_time))
+    print('RankMatrix of %d users x %d levels' % (users * copies, len(matrix.levels)))
+    print('\topen (mmap):     %7.1f ms' % (1000 * mmap_time))
+    print('\tload (read):     %7.1f ms' % (1000 * read_time))
+    print('\tband totals:     %7.1f ms' % (1000 * bands_time))
+
+def best_of(fn, repeat):
+    """Best wall time of 'repeat' calls to fn, with its output (the session logs every GET) discarded"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+class SiteBench:
+    """Runs steps against fakesite.py and collects {'name[size]': result}"""
+    def __init__(self, latency, repeat):
+        self.latency = latency
+        self.repeat = repeat
+        self.results = OrderedDict()
+        self.tmp = tempfile.mkdtemp(prefix='ffrbench-')
+
+    def record(self, name, size, unit, fn, repeat=None):
+        seconds = best_of(fn, repeat or self.repeat)
+        self.results['%s[%d]' % (name, size)] = OrderedDict([('seconds', seconds), ('size', size), ('unit', unit)])
+        print('\t%-28s %7d %-5s %9.2f ms' % (name, size, unit, 1000 * seconds))
+
+    def start(self, **kwargs):
+        site = fakesite.FakeSite(latency=self.latency, **kwargs)
+        fakesite.install(site.start())
+        return site
+
+    def session(self):
+        session = ffrsession.FFRSession({'username': 'bench', 'password': 'bench'},
+            os.path.join(self.tmp, 'cookies.txt'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            # log in once, outside the timings
+            session.get_content(ffrsession.URL_TIERS, login_required=True)
+        return session
+
+    def levelranks(self, rows):
+        site = self.start(rows=rows, token_rows=max(rows // 10, 1), song_page_count=1)
+        session = self.session()
+        url = ffrsession.URL_LEVELRANK % 'bench'
+        with contextlib.redirect_stdout(io.StringIO()):
+            content = session.get_content(url, login_required=True)
+            levelranks = stats.get_levelranks(session, 'bench')
+            token_levelranks = stats.get_levelranks(session, 'bench', special=True)
+        # the results are keyed by row count, so make sure the page really has that many
+        assert len(levelranks) == rows, '%d rows requested, %d served' % (rows, len(levelranks))
+
+        self.record('levelrank fetch', rows, 'rows', lambda: session.get_content(url, login_required=True))
+        self.record('extract_levelranks', rows, 'rows',
+            lambda: stats.extract_levelranks(ffrsession.parse_html(content)))
+        self.record('stream_levelranks', rows, 'rows', lambda: list(stats.stream_levelranks([content])))
+        self.record('get_levelranks', rows, 'rows', lambda: stats.get_levelranks(session, 'bench'))
+
+        self.record('Aggregates', rows, 'rows', lambda: stats.Aggregates(levelranks))
+
+        aggregates = stats.Aggregates(levelranks)
+        token_aggregates = stats.Aggregates(token_levelranks)
+        # format_levelranks and format_tierpoints are now the Report model plus a renderer
+        self.record('Report', rows, 'rows', lambda: stats.Report(aggregates, token_aggregates))
+        report = stats.Report(aggregates, token_aggregates)
+        for ext, render in stats.RENDERERS.items():
+            self.record('render %s' % ext, rows, 'rows', lambda: render(report))
+
+        cache_dir = os.path.join(self.tmp, 'api_cache')
+        # a TTL of 0 makes every call download the ranks again
+        api = ffrapi.FFRApi('bench', cache_dir, ttl=0)
+        self.record('api iter_songs', rows, 'rows', lambda: sum(1 for _ in api.iter_songs('bench')))
+        site.stop()
+
+    def crawl(self, pages, workers):
+        journal = checkpoint.Journal(os.path.join(self.tmp, 'levelarrows.checkpoint'))
+        journal.remove()
+        crawl = levelarrows.Crawl(levelarrows.SongListBrowser(workers), journal)
+        if workers > 1:
+            results = levelarrows.crawl_concurrent(crawl, workers)
+        else:
+            results = levelarrows.crawl_serial(crawl)
+        journal.remove()
+        assert len(results) == pages
+        return results
+
+    def song_pages(self, pages):
+        site = self.start(rows=1, token_rows=1, song_page_count=pages)
+        for workers in (1, 8):
+            self.record('levelarrows crawl x%d' % workers, pages, 'pages', lambda: self.crawl(pages, workers),
+                min(self.repeat, 3))
+        site.stop()
+
+    def tiers(self):
+        site = self.start(rows=1, token_rows=1, song_page_count=1)
+        session = self.session()
+        self.record('FFRSession.tiers', len(songdata.tier_tables()), 'tiers', session.tiers)
+        site.stop()
+
+    def close(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+def compare(meta, results, filename, threshold=REGRESSION_THRESHOLD):
+    previous = checkpoint.load_json(filename)
+    if previous is None:
+        print('[+] Cannot read %s' % filename)
+        return
+    print('Compared with %s (%s)' % (filename, previous['meta'].get('date', '?')))
+    for setting in ('latency_ms', 'python'):
+        if previous['meta'].get(setting) != meta[setting]:
+            print('[+] Warning: %s differs (%s, now %s); the timings are not comparable' %
+                (setting, previous['meta'].get(setting), meta[setting]))
+    for name, result in results.items():
+        old = previous['results'].get(name)
+        if old is None:
+            print('\t%-36s %9.2f ms  (new)' % (name, 1000 * result['seconds']))
+            continue
+        change = result['seconds'] / old['seconds'] - 1 if old['seconds'] else 0
+        print('\t%-36s %9.2f ms -> %9.2f ms  %+6.1f%%%s' % (name, 1000 * old['seconds'], 1000 * result['seconds'],
+            100 * change, '  REGRESSION' if change > threshold else ''))
+
+def bench_site(args):
+    bench = SiteBench(args.latency / 1000, args.repeat)
+    try:
+        print('Levelrank pages')
+        for rows in args.rows:
+            bench.levelranks(rows)
+        print('Song list pages')
+        for pages in args.song_pages:
+            bench.song_pages(pages)
+        print('Tiers page')
+        bench.tiers()
+    finally:
+        bench.close()
+
+    output = args.output or time.strftime('bench-%Y-%m-%d-%H-%M-%S.json')
+    meta = OrderedDict([
+        ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('latency_ms', args.latency),
+        ('repeat', args.repeat),
+    ])
+    checkpoint.save_json(output, OrderedDict([('meta', meta), ('results', bench.results)]), indent=4)
+    print('[+] Results written to ' + output)
+    if args.compare:
+        compare(meta, bench.results, args.compare, args.threshold / 100)
+
+def run_checks(args):
+    try:
+        check_levelrank_parsers(args.rows)
+        print('[+] Streaming and BeautifulSoup levelrank parsers agree on %d rows' % args.rows)
+        check_catalog()
+        print('[+] Song catalog lookups are correct')
+    except AssertionError as e:
+        print('[+] Check failed: %s' % e)
+        sys.exit(1)
+
+def bench_micro(args):
+    n = args.rows
+    bench_levelrank(n)
+    bench_tierpoints(n)
+    bench_songdata()
+    bench_catalog(n)
+    bench_planner(n)
+    bench_rankmatrix(n)
+
+def sizes(value):
+    return [int(size) for size in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ffrStats.')
+    parser.set_defaults(fn=bench_micro, rows=10000)
+    sub = parser.add_subparsers(dest='bench')
+
+    p = sub.add_parser('micro', help='data structure micro-benchmarks')
+    p.add_argument('rows', type=int, nargs='?', default=10000, help='synthetic levelrank rows')
+    p.set_defaults(fn=bench_micro)
+
+    p = sub.add_parser('site', help='end-to-end steps against the local fakesite.py stand-in')
+    p.add_argument('--rows', type=sizes, default=[100, 2000, 20000], help='levelrank sizes (default: 100,2000,20000)')
+    p.add_argument('--song-pages', type=sizes, default=[1, 40, 200], help='song list sizes (default: 1,40,200)')
+    p.add_argument('--latency', type=float, default=0, help='milliseconds before each response (default: 0)')
+    p.add_argument('--repeat', type=int, default=5, help='runs per step; the best is kept (default: 5)')
+    p.add_argument('--output', help='results file (default: bench-<date>.json)')
+    p.add_argument('--compare', help='earlier results file to compare with')
+    p.add_argument('--threshold', type=float, default=100 * REGRESSION_THRESHOLD,
+        help='percent slowdown flagged as a regression (default: %(default)g)')
+    p.set_defaults(fn=bench_site)
+
+    p = sub.add_parser('check', help='correctness checks only; exits non-zero on a failure')
+    p.add_argument('--rows', type=int, default=500, help='synthetic levelrank rows (default: 500)')
+    p.set_defaults(fn=run_checks)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == "__main__":
+    main()
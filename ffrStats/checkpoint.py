@@ -0,0 +1,78 @@
+"""
+Progress and cache files for the crawling scripts.
+
+A Journal is an append-only file of JSON records, one per line, flushed to
+disk as each record is written, so a crawl that dies part way can resume
+from the records already there. A last line cut short by the crash is
+ignored. save_json() replaces a file atomically, so readers never see a
+half written one.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+def fingerprint(content):
+    return hashlib.sha1(content).hexdigest()
+
+def load_json(filename, default=None):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_json(filename, data, **kwargs):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(data, f, **kwargs)
+    os.replace(filename + '.tmp', filename)
+
+class Journal:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.f = None
+
+    def load(self):
+        """Returns the records written so far (by this run or an interrupted one)"""
+        records = []
+        try:
+            with open(self.filename, 'rb+') as f:
+                end = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('incomplete record')
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        # only the last line can be incomplete; cut it off so new records start cleanly
+                        f.truncate(end)
+                        break
+                    end += len(line)
+        except OSError:
+            pass
+        return records
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            if self.f is None:
+                self.f = open(self.filename, 'a')
+            self.f.write(line)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    def remove(self):
+        """Closes and deletes the journal once the work it records is complete"""
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
@@ -0,0 +1,304 @@
+"""
+Local stand-in for the parts of the FFR website the ffrStats scripts use,
+for benchmarks and for running the scripts offline.
+
+Pages are generated from the level names, arrow counts and tier
+requirements in levelarrows.json and leveltiers.json, in the markup the
+scrapers expect:
+
+    /                              login form (vb_login_username)
+    /login.php?do=login            login POST; sets the session cookie
+    /levelrank.php?sub=USER        levelrank table, 'rows' rows (login)
+    /levelrank_special.php?sub=    token levelrank table, 'token_rows' rows (login)
+    /FFRStats/FFRSongs.php?page=N  the song list split over 'song_page_count' pages
+    /FFRStats/level_tiers.php      tier requirement blocks (login)
+    /api/api.php?action=ranks      JSON ranks for 'rows' levels
+    /profile/edit/thoughts/ID      random thought form (login); POSTs are counted
+
+Every response waits 'latency' seconds before it starts and, with a
+'bandwidth' in bytes per second, is sent in chunks paced to that rate.
+
+    python3 fakesite.py [--port P] [--rows N] [--song-pages N] [--latency MS] [--bandwidth KB/s]
+
+then point the scripts at it with FFR_URL_BASE=http://127.0.0.1:P.
+Benchmarks in the same process call install() instead.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import html
+import json
+import math
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+import songdata
+import stats
+
+COLUMNS = ['rank', 'd', 'level', 'score', 'p', 'g', 'a', 'm', 'b', 'c', 'played']
+HEADERS = ['Rank', 'D', 'Level', 'Score', 'P', 'G', 'A', 'M', 'B', 'C', 'Played']
+
+COOKIE = 'bbsessionhash'
+CHUNK_SIZE = 8192
+
+def generate_rows(n, seed=0, unique=False):
+    """
+    Returns 'n' synthetic levelrank rows as lists of cell strings, weighted
+    towards tiered levels. With 'unique', no level appears twice (as on a real
+    levelrank page); once every known level is used, the remaining rows get
+    made-up level names that are not in the song data.
+    """
+    rng = random.Random(seed)
+    tiered = sorted(songdata.tier_tables())
+    levels = sorted(songdata.level_arrows())
+    rows = []
+    used = set()
+    while len(rows) < n:
+        if unique and len(used) == len(levels):
+            level = 'Unreleased Level %d' % (len(rows) - len(levels) + 1)
+            # the same arrow count on every user's page
+            arrows = random.Random(level).randint(100, 3000)
+        else:
+            level = rng.choice(tiered) if rng.random() < 0.5 else rng.choice(levels)
+            if unique:
+                if level in used:
+                    continue
+                used.add(level)
+            arrows = songdata.level_arrows()[level]
+        g = rng.choice([0, 0, 1, 4, 30])
+        a = rng.choice([0, 0, 2])
+        m = rng.choice([0, 0, 0, 5])
+        b = rng.choice([0, 0, 1])
+        unplayed = rng.choice([0, 0, 0, 10])
+        # without song data the arrow count is read back as p + g + a + m, so play made-up levels to the end
+        p = max(arrows - g - a - m - (unplayed if level in songdata.level_arrows() else 0), 0)
+        score = stats.PERFECT_SCORE * p + stats.GOOD_SCORE * g + stats.AVERAGE_SCORE * a \
+            + stats.MISS_SCORE * m + stats.BOO_SCORE * b
+        fc = '*' if m == 0 and rng.random() < 0.7 else ''
+        combo = p + g + a if m == 0 else p // 2
+        rows.append(['{:,}'.format(rng.randint(1, 5000)), str(rng.randint(1, 110)), level,
+            '{:,}{}'.format(score, fc), '{:,}'.format(p), str(g), str(a), str(m), str(b),
+            '{:,}'.format(combo), str(rng.randint(1, 200))])
+    return rows
+
+def levelrank_page(rows):
+    out = ['<html><head><title>Level Ranks</title></head><body>\n<table class="levelrank">\n<tr>']
+    out.append(''.join('<th>%s</th>' % name if name != 'Rank' else '<th>Rank<span>&#9660;</span></th>'
+        for name in HEADERS))
+    out.append('</tr>\n')
+    level = COLUMNS.index('level')
+    for row in rows:
+        out.append('<tr>%s</tr>\n' % ''.join('<td><a href="#">%s</a></td>' % html.escape(cell) if i == level
+            else '<td>%s</td>' % cell for i, cell in enumerate(row)))
+    out.append('</table>\n</body></html>\n')
+    return ''.join(out)
+
+def song_pages(page_count):
+    """Splits the catalog, sorted by name, into 'page_count' lists of (name, arrows)"""
+    songs = sorted(songdata.level_arrows().items())
+    per_page = max(math.ceil(len(songs) / page_count), 1)
+    return [songs[i:i + per_page] for i in range(0, per_page * page_count, per_page)]
+
+def song_page(songs, page, page_count):
+    out = ['<html><body><p>Generated %s</p>\n<div class="pages">' % time.strftime('%H:%M:%S')]
+    out.append(' '.join('<a href="FFRSongs.php?page=%d&order_by=songname&order=ASC">%d</a>' % (n, n)
+        for n in range(1, min(page_count, 10) + 1)))
+    out.append('</div>\n')
+    for name, arrows in songs:
+        out.append('<table class="data"><tr><td><span class="name">%s</span></td>'
+            '<td class="info">Stepfile by Someone - {:,} arrows, 2:00</td></tr></table>\n'.format(arrows)
+            % html.escape(name))
+    out.append('</body></html>\n')
+    return ''.join(out)
+
+def tiers_page():
+    out = ['<html><body><div class="tiers">\n']
+    for level, requirements in sorted(json.load(open(songdata.TIERS_FILENAME, 'r')).items()):
+        out.append('<div class="tier_main"><div class="tier_details"><div>%s</div><div>%d tiers</div></div>'
+            '<ul class="tier_req_list">' % (html.escape(level), len(requirements)))
+        for i, requirement in enumerate(requirements):
+            value = requirement if requirement == 'Passed' else '{:,}'.format(int(requirement))
+            out.append('<li>Tier %d %s</li>' % (len(requirements) - i, value))
+        out.append('</ul></div>\n')
+    out.append('</div></body></html>\n')
+    return ''.join(out)
+
+def api_ranks(rows):
+    cols = {name: i for i, name in enumerate(COLUMNS)}
+    songs = {}
+    for i, row in enumerate(rows):
+        songs[str(i + 1)] = {'info': {'name': row[cols['level']], 'difficulty': row[cols['d']]},
+            'scores': {'rank': row[cols['rank']].replace(',', ''), 'score': row[cols['score']]}}
+    return json.dumps({'songs': songs})
+
+LOGIN_FORM = ('<form action="login.php?do=login" method="post">'
+    '<input type="text" name="vb_login_username"><input type="password" name="vb_login_password">'
+    '<input type="hidden" name="securitytoken" value="guest"><input type="hidden" name="do" value="login">'
+    '<input type="submit" value="Log in"></form>')
+
+POST_FORM = ('<html><body><form method="post" action="/profile/save">'
+    '<input type="hidden" name="securitytoken" value="token">'
+    '<input type="text" name="blog_title" value=""><textarea name="blog_post"></textarea>'
+    '<input type="submit" name="sbutton" value="Save"></form></body></html>')
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately; without this, Nagle's algorithm and delayed ACKs
+        # add ~40 ms to every small response on a keep-alive connection
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def logged_in(self):
+        return ('%s=' % COOKIE) in (self.headers.get('Cookie') or '')
+
+    def send(self, body, content_type='text/html; charset=iso-8859-1', headers=()):
+        site = self.server.site
+        if isinstance(body, str):
+            body = body.encode('iso-8859-1', 'xmlcharrefreplace')
+        if site.latency:
+            time.sleep(site.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if not site.bandwidth:
+            self.wfile.write(body)
+            return
+        for i in range(0, len(body), CHUNK_SIZE):
+            chunk = body[i:i + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(len(chunk) / site.bandwidth)
+
+    def do_GET(self):
+        site = self.server.site
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        site.count(url.path)
+
+        if url.path == '/FFRStats/FFRSongs.php':
+            return self.send(site.song_page(int(query.get('page', ['1'])[0])))
+        if url.path == '/api/api.php':
+            return self.send(site.page('api', lambda: api_ranks(site.rows)), 'application/json')
+
+        login_required = url.path in ('/levelrank.php', '/levelrank_special.php', '/FFRStats/level_tiers.php') \
+            or url.path.startswith('/profile/')
+        if not login_required:
+            return self.send('<html><body>%s</body></html>' % LOGIN_FORM)
+        if not self.logged_in():
+            return self.send('<html><body>%s<p>You are not logged in.</p></body></html>' % LOGIN_FORM)
+
+        if url.path == '/levelrank.php':
+            return self.send(site.page('levelrank', lambda: levelrank_page(site.rows)))
+        if url.path == '/levelrank_special.php':
+            return self.send(site.page('levelrank_special', lambda: levelrank_page(site.token_rows)))
+        if url.path == '/FFRStats/level_tiers.php':
+            return self.send(site.page('tiers', tiers_page))
+        return self.send(POST_FORM)
+
+    def do_POST(self):
+        site = self.server.site
+        url = urllib.parse.urlsplit(self.path)
+        data = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('iso-8859-1'))
+        site.count(url.path)
+
+        if url.path == '/login.php':
+            if site.password is not None and data.get('vb_login_password') != [site.password]:
+                return self.send('<html><body>You have entered an invalid username or password.</body></html>')
+            return self.send('<html><body>Thank you for logging in.</body></html>',
+                headers=[('Set-Cookie', '%s=fake; path=/' % COOKIE)])
+
+        with site.lock:
+            site.posts.append({name: values[0] for name, values in data.items()})
+        return self.send('<html><body>Saved.</body></html>')
+
+class FakeSite:
+    def __init__(self, rows=2000, token_rows=200, song_page_count=40, latency=0, bandwidth=0, password=None, seed=0):
+        """'latency' is in seconds and 'bandwidth' in bytes per second (0 for unlimited)"""
+        self.rows = generate_rows(rows, seed, unique=True)
+        self.token_rows = generate_rows(token_rows, seed + 1, unique=True)
+        self.song_pages = song_pages(song_page_count)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.password = password
+        self.lock = threading.Lock()
+        # request counts per path, and the submitted post forms
+        self.requests = {}
+        self.posts = []
+        self.pages = {}
+        self.server = None
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def page(self, name, render):
+        """Renders a page once and serves the same bytes afterwards"""
+        if name not in self.pages:
+            self.pages[name] = render().encode('iso-8859-1', 'xmlcharrefreplace')
+        return self.pages[name]
+
+    def song_page(self, page):
+        songs = self.song_pages[page - 1] if 1 <= page <= len(self.song_pages) else []
+        return song_page(songs, page, len(self.song_pages))
+
+    def start(self, port=0):
+        """Serves in a background thread; returns the base URL"""
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.server.site = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def install(base):
+    """Points the already imported ffrStats modules at a base URL, for benchmarks run in one process"""
+    import ffrapi
+    import ffrsession
+    import levelarrows
+    import stats
+
+    ffrsession.URL_BASE = base
+    ffrsession.URL_LEVELRANK = base + '/levelrank.php?sub=%s'
+    ffrsession.URL_SPECIAL_LEVELRANK = base + '/levelrank_special.php?sub=%s'
+    ffrsession.URL_TIERS = base + '/FFRStats/level_tiers.php'
+    ffrapi.URL_API = base + '/api/api.php'
+    levelarrows.URL_SONGS = base + '/FFRStats/FFRSongs.php?page=%d&order_by=songname&order=ASC'
+    stats.URL_BASE = base
+    stats.URL_POST = base + '/profile/edit/thoughts/' + stats.RANDOM_THOUGHT_ID
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the FFR website.')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: 8080)')
+    parser.add_argument('--rows', type=int, default=2000, help='levelrank rows (default: 2000)')
+    parser.add_argument('--token-rows', type=int, default=200, help='token levelrank rows (default: 200)')
+    parser.add_argument('--song-pages', type=int, default=40, help='song list pages (default: 40)')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds before each response')
+    parser.add_argument('--bandwidth', type=float, default=0, help='KB/s per response (default: unlimited)')
+    parser.add_argument('--password', help='the only password accepted (default: any)')
+    args = parser.parse_args()
+
+    site = FakeSite(args.rows, args.token_rows, args.song_pages, args.latency / 1000, args.bandwidth * 1024,
+        args.password)
+    print('[+] Serving on %s; Ctrl-C to stop' % site.start(args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        site.stop()
+
+if __name__ == "__main__":
+    main()
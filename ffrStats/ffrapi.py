@@ -0,0 +1,252 @@
+"""
+Client for the FFR API with an on-disk response cache.
+
+Responses are streamed straight to a cache file. Within CACHE_TTL seconds a
+repeated call is answered from disk without touching the network. After
+that the request is conditional (If-None-Match / If-Modified-Since) when the
+server sent an ETag or Last-Modified; a 304 or a body with the same SHA-1
+as the cached one just renews the entry. Requests time out, and connection
+errors and server errors are retried with exponential backoff.
+
+iter_songs() reads the 'songs' object of a ranks response incrementally,
+yielding one (level, record) pair at a time instead of building the whole
+dict.
+"""
+
+import hashlib
+import json
+import os
+import profiling
+import requests
+import time
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(DATA_DIR, 'api_cache')
+
+URL_API = os.environ.get('FFR_URL_BASE', 'http://www.flashflashrevolution.com') + '/api/api.php'
+
+CACHE_TTL = 3600
+TIMEOUT = 30
+RETRIES = 3
+BACKOFF = 1.0
+CHUNK_SIZE = 65536
+
+class ApiError(Exception):
+    pass
+
+class CacheEntry:
+    """A cached response body and its metadata (when it was checked, validators, hash)"""
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = path + '.meta'
+
+    def load_meta(self):
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if os.path.exists(self.path) else None
+
+    def save_meta(self, meta):
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+
+    def invalidate(self):
+        for path in (self.path, self.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class FFRApi:
+    def __init__(self, key, cache_dir=CACHE_DIR, ttl=CACHE_TTL, timeout=TIMEOUT, retries=RETRIES):
+        self.key = key
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        # network requests made, and how many of those were answered with 304 Not Modified
+        self.requests = 0
+        self.not_modified = 0
+
+    def entry(self, params):
+        """The cache entry for a request; the API key is hashed so it never appears on disk"""
+        digest = hashlib.sha1(self.key.encode('utf-8'))
+        for name in sorted(params):
+            digest.update(('\0%s=%s' % (name, params[name])).encode('utf-8'))
+        return CacheEntry(os.path.join(self.cache_dir, '%s-%s.json' % (params.get('action', 'api'),
+            digest.hexdigest()[:20])))
+
+    def fetch(self, **params):
+        """Returns the path of the cached response body, downloading it only when needed"""
+        with profiling.phase('api fetch'):
+            return self._fetch(params)
+
+    def _fetch(self, params):
+        entry = self.entry(params)
+        meta = entry.load_meta()
+        if meta is not None and time.time() - meta['checked'] < self.ttl:
+            return entry.path
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        part = entry.path + '.part'
+        try:
+            response, sha1 = self.download(dict(params, key=self.key), headers, part)
+            if response.status_code == 304 and meta is None:
+                # nothing usable is cached to renew, so ask for the body without validators
+                response, sha1 = self.download(dict(params, key=self.key), {'Cache-Control': 'no-cache'}, part)
+                if response.status_code == 304:
+                    raise ApiError('API answered 304 Not Modified, but nothing is cached')
+            if response.status_code == 304:
+                self.not_modified += 1
+            elif meta is None or sha1 != meta['sha1']:
+                os.replace(part, entry.path)
+                meta = {'sha1': sha1}
+        finally:
+            # a failed download or unchanged content leaves the partial file behind
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+
+        meta['checked'] = time.time()
+        meta['etag'] = response.headers.get('ETag', meta.get('etag'))
+        meta['last_modified'] = response.headers.get('Last-Modified', meta.get('last_modified'))
+        entry.save_meta(meta)
+        return entry.path
+
+    def download(self, params, headers, path):
+        """GETs the API into 'path', returning (response, sha1 of the body); sha1 is None for a 304"""
+        for attempt in range(self.retries + 1):
+            try:
+                self.requests += 1
+                with self.session.get(URL_API, params=params, headers=headers, timeout=self.timeout,
+                        stream=True) as response:
+                    if response.status_code == 304:
+                        return response, None
+                    response.raise_for_status()
+                    digest = hashlib.sha1()
+                    with open(path, 'wb') as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            profiling.add(bytes=len(chunk))
+                            digest.update(chunk)
+                            f.write(chunk)
+                    return response, digest.hexdigest()
+            except requests.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                # client errors will not go away by retrying
+                if attempt == self.retries or (status is not None and status < 500):
+                    raise ApiError('API request failed: %s' % e)
+                time.sleep(BACKOFF * 2 ** attempt)
+
+    def iter_songs(self, username):
+        """Yields (level, record) for every song in the user's ranks response"""
+        params = {'action': 'ranks', 'username': username}
+        path = self.fetch(**params)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for key, value in iter_object(f, 'songs'):
+                    yield key, value
+        except ApiError:
+            # never keep an error response around for the rest of the TTL
+            self.entry(params).invalidate()
+            raise
+
+class JsonStream:
+    """Decodes JSON values one at a time from a file, reading it in chunks"""
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Reads another chunk; returns False at the end of the file"""
+        if self.eof:
+            return False
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf += chunk
+        return not self.eof
+
+    def peek(self):
+        """Skips whitespace and returns the next character ('' at the end of the file)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ApiError('Malformed API response: expected %r, found %r' % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decodes the next complete value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise ApiError('Malformed API response')
+            self.fill()
+
+def iter_object(f, name):
+    """
+    Yields the (key, value) pairs of the object stored under 'name' in the
+    top-level object of the JSON file 'f', decoding one pair at a time.
+    Raises ApiError if the response is an API error instead.
+    """
+    stream = JsonStream(f)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == name:
+            if stream.peek() == '[':
+                # PHP's json_encode writes an empty array, not an object, when there are no songs
+                stream.expect('[')
+                stream.expect(']')
+                return
+            stream.expect('{')
+            if stream.peek() != '}':
+                while True:
+                    item = stream.value()
+                    stream.expect(':')
+                    yield item, stream.value()
+                    if stream.expect(',}') == '}':
+                        break
+            else:
+                stream.expect('}')
+            return
+
+        value = stream.value()
+        if key == 'error':
+            raise ApiError(str(value))
+        if stream.expect(',}') == '}':
+            return
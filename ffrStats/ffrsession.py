@@ -0,0 +1,282 @@
+"""
+Persistent, pooled HTTP session for the FFR website, shared by the scripts
+in this directory.
+
+Logging in is a plain form POST, and the resulting cookies are saved to
+a COOKIE_FILENAME jar for the account, so later runs reuse the login until
+the cookies expire or the site stops accepting them. Pages that need a login are checked for
+the login form; if it is there, the session logs in again and retries the
+request once. All requests go through one requests.Session whose
+connection pool can be shared by several threads.
+"""
+
+from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+import http.cookiejar
+import levelrank_parser
+import os
+import profiling
+import re
+import requests
+import threading
+import urllib.parse
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+# one cookie jar per account, so scripts logged in as different users never share a login
+COOKIE_FILENAME = os.path.join(DATA_DIR, 'cookies-%s.txt')
+
+# URLs; FFR_URL_BASE points the scripts at another server, such as fakesite.py
+URL_BASE = os.environ.get('FFR_URL_BASE', 'http://www.flashflashrevolution.com')
+URL_LEVELRANK = URL_BASE + '/levelrank.php?sub=%s'
+URL_SPECIAL_LEVELRANK = URL_BASE + '/levelrank_special.php?sub=%s'
+URL_TIERS = URL_BASE + '/FFRStats/level_tiers.php'
+
+ENCODING = 'iso-8859-1'
+POOL_SIZE = 8
+TIMEOUT = 60
+CHUNK_SIZE = 65536
+# only present on pages served to a logged out visitor
+LOGIN_MARKER = b'vb_login_username'
+# the login form is in the site header, well within this many bytes of the start of a page
+LOGIN_SCAN_SIZE = 65536
+# start of each level's block on the tiers page
+TIER_BLOCK_START = re.compile(rb'<div[^>]*class="tier_main[" ]')
+
+class LoginError(Exception):
+    pass
+
+class FormParser(HTMLParser):
+    """Collects the action and the fields a browser would submit for every form on a page"""
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self.form = None
+        # name of the textarea or select whose contents are being read
+        self.textarea = None
+        self.select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form':
+            self.form = {'action': attrs.get('action') or '', 'method': (attrs.get('method') or 'get').lower(),
+                'fields': {}, 'submitted': False}
+            self.forms.append(self.form)
+        elif self.form is None:
+            return
+        elif tag == 'input' and attrs.get('name'):
+            kind = (attrs.get('type') or 'text').lower()
+            if kind in ('checkbox', 'radio') and 'checked' not in attrs:
+                return
+            if kind in ('submit', 'image'):
+                # like a click on the first submit button
+                if self.form['submitted']:
+                    return
+                self.form['submitted'] = True
+            elif kind in ('button', 'reset', 'file'):
+                return
+            self.form['fields'][attrs['name']] = attrs.get('value') or ''
+        elif tag == 'textarea' and attrs.get('name'):
+            self.textarea = attrs['name']
+            self.form['fields'][self.textarea] = ''
+        elif tag == 'select' and attrs.get('name'):
+            self.select = attrs['name']
+        elif tag == 'option' and self.select:
+            value = attrs.get('value') or ''
+            if self.select not in self.form['fields'] or 'selected' in attrs:
+                self.form['fields'][self.select] = value
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self.form = None
+        elif tag == 'textarea':
+            self.textarea = None
+        elif tag == 'select':
+            self.select = None
+
+    def handle_data(self, data):
+        if self.textarea and self.form is not None:
+            self.form['fields'][self.textarea] += data
+
+def parse_html(content):
+    with profiling.phase('BeautifulSoup'):
+        return BeautifulSoup(content, 'html.parser', from_encoding=ENCODING)
+
+def split_tier_blocks(content):
+    """Splits the raw tiers page into the HTML of each level's tier_main block"""
+    starts = [match.start() for match in TIER_BLOCK_START.finditer(content)]
+    return [content[start:end] for start, end in zip(starts, starts[1:] + [len(content)])]
+
+def parse_tier_block(block):
+    """Returns (level name, [score requirement strings]) for a block from split_tier_blocks()"""
+    tier_main = parse_html(block).find('div', class_='tier_main')
+    name = tier_main.find('div', class_='tier_details')('div')[0].text
+    return name, [li.text.split()[2].replace(',', '') for li in tier_main.find('ul', class_='tier_req_list')('li')]
+
+class FFRSession:
+    def __init__(self, credentials=None, cookie_filename=None, pool_size=POOL_SIZE):
+        """
+        'credentials' is a {"username", "password"} dict, needed only for pages
+        behind the login. The cookies are kept in the account's COOKIE_FILENAME
+        jar unless 'cookie_filename' is given; without credentials they are not
+        saved at all.
+        """
+        self.credentials = credentials
+        if cookie_filename is None and credentials is not None:
+            cookie_filename = COOKIE_FILENAME % urllib.parse.quote(credentials['username'], safe='')
+        self.session = requests.Session()
+        self.session.headers['User-agent'] = 'Mozilla/5.0'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.cookie_filename = cookie_filename
+        self.session.cookies = http.cookiejar.LWPCookieJar(cookie_filename)
+        if cookie_filename and os.path.exists(cookie_filename):
+            try:
+                # expired cookies are dropped while loading
+                self.session.cookies.load(ignore_discard=True)
+            except (OSError, http.cookiejar.LoadError):
+                pass
+
+        self.login_lock = threading.Lock()
+        self.logins = 0
+        # a failed login is not retried by the other threads
+        self.login_error = None
+        # set once a page that needs the login has been served to this session
+        self.logged_in = threading.Event()
+
+    def save_cookies(self):
+        if self.cookie_filename:
+            self.session.cookies.save(ignore_discard=True)
+            os.chmod(self.cookie_filename, 0o600)
+
+    def get_form(self, url, nr=0):
+        """Loads the page at 'url' and returns its form number 'nr' as (action URL, method, fields)"""
+        print('[+] GET ' + url)
+        response = self.session.get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+        profiling.add(bytes=len(response.content))
+        parser = FormParser()
+        parser.feed(response.content.decode(ENCODING))
+        form = parser.forms[nr]
+        return urllib.parse.urljoin(response.url, form['action']), form['method'], form['fields']
+
+    def submit(self, form, fields):
+        """Submits a form returned by get_form() with 'fields' filled in"""
+        action, method, defaults = form
+        data = dict(defaults, **fields)
+        # browsers send form data in the page's encoding
+        data = {name: value.encode(ENCODING, 'xmlcharrefreplace') for name, value in data.items()}
+        if method == 'post':
+            response = self.session.post(action, data=data, timeout=TIMEOUT)
+        else:
+            response = self.session.get(action, params=data, timeout=TIMEOUT)
+        response.raise_for_status()
+        profiling.add(bytes=len(response.content))
+        return response
+
+    def submit_form(self, url, fields, nr=0):
+        """Fills in form 'nr' on the page at 'url' with 'fields' and submits it"""
+        return self.submit(self.get_form(url, nr), fields)
+
+    def login(self):
+        if not self.credentials:
+            raise LoginError('Login required, but no credentials were given')
+        print('[+] Logging in with credentials...')
+        with profiling.phase('login'):
+            response = self.submit_form(URL_BASE, {'vb_login_username': self.credentials['username'],
+                'vb_login_password': self.credentials['password']})
+        if b'invalid' in response.content:
+            raise LoginError('Invalid username or password')
+        self.logins += 1
+        self.save_cookies()
+        print('[+] Login successful!')
+
+    def ensure_login(self, logins_seen):
+        """Logs in unless another thread has already done so since 'logins_seen'"""
+        with self.login_lock:
+            if self.login_error is not None:
+                raise self.login_error
+            if self.logins == logins_seen:
+                try:
+                    self.login()
+                except LoginError as e:
+                    self.login_error = e
+                    raise
+
+    def open(self, url, login_required=False):
+        """
+        Returns the start of the body and an iterator over the rest, logging in
+        if the page needs it. Pages that need the login are buffered until
+        LOGIN_SCAN_SIZE bytes (or the whole page) have arrived, since chunked or
+        compressed responses can hand out much less than that at a time.
+        """
+        retried = False
+        while True:
+            logins_seen = self.logins
+            print('[+] GET ' + url)
+            with profiling.phase('request'):
+                response = self.session.get(url, timeout=TIMEOUT, stream=True)
+                response.raise_for_status()
+                chunks = response.iter_content(CHUNK_SIZE)
+                first = next(chunks, b'')
+                logged_out = LOGIN_MARKER in first
+                if login_required and not logged_out:
+                    head = [first]
+                    size = len(first)
+                    # the end of the previous chunk, so a marker split across two chunks is still found
+                    tail = first[-len(LOGIN_MARKER):]
+                    while size < LOGIN_SCAN_SIZE:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        head.append(chunk)
+                        size += len(chunk)
+                        if LOGIN_MARKER in tail + chunk:
+                            logged_out = True
+                            break
+                        tail = (tail + chunk)[-len(LOGIN_MARKER):]
+                    first = b''.join(head)
+            if not login_required:
+                return first, chunks
+            if not logged_out:
+                self.logged_in.set()
+                return first, chunks
+            response.close()
+            if retried:
+                raise LoginError('Still logged out after logging in')
+            self.ensure_login(logins_seen)
+            retried = True
+
+    def get_stream(self, url, login_required=False):
+        """Yields the raw response body in chunks as it is downloaded"""
+        first, chunks = self.open(url, login_required)
+        profiling.add(bytes=len(first))
+        yield first
+        for chunk in chunks:
+            profiling.add(bytes=len(chunk))
+            yield chunk
+
+    def get_content(self, url, login_required=False):
+        return b''.join(self.get_stream(url, login_required))
+
+    def get_soup(self, url, login_required=False):
+        return parse_html(self.get_content(url, login_required))
+
+    def levelrank(self, username):
+        """Yields (cols, cells) for every row of the user's public levelrank page"""
+        url = URL_LEVELRANK % urllib.parse.quote(username)
+        return levelrank_parser.iter_rows(self.get_stream(url, login_required=True))
+
+    def special_levelrank(self, username):
+        """Yields (cols, cells) for every row of the user's token levelrank page"""
+        url = URL_SPECIAL_LEVELRANK % urllib.parse.quote(username)
+        return levelrank_parser.iter_rows(self.get_stream(url, login_required=True))
+
+    def tiers(self):
+        """Returns {level name: [score requirement strings]} from the level tiers page"""
+        content = self.get_content(URL_TIERS, login_required=True)
+        with profiling.phase('extract tiers'):
+            tiers = dict(parse_tier_block(block) for block in split_tier_blocks(content))
+            profiling.add(rows=len(tiers))
+        return tiers
@@ -10,77 +10,49 @@ that contains a username and password in JSON format:
 """
 
 from collections import OrderedDict
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.chrome.options import Options
 from tabulate import tabulate
+import ffrsession
 import json
-import re
 import sys
 
 output_file = 'level_ranks.txt'
 
 def get_data(credentials, stats_username):
 	"""
-	Given a credentials object, returns all level rank data for 'stats_username'.
+	Given a credentials object, returns all level rank rows for 'stats_username'
+	as (cols, cells) pairs. The login is only repeated when the cookies saved
+	by a previous run are no longer accepted.
 	"""
-	url_base = 'http://www.flashflashrevolution.com'
-	url_levelrank = url_base + '/levelrank.php?sub=' + stats_username
-
-	# start the Chrome webdriver
-	chrome_options = Options()
-	chrome_options.add_argument('--headless')
-	driver = webdriver.Chrome(chrome_options=chrome_options)
-
-	print('[+] GET ' + url_base)
-	driver.get(url_base)
-
-	# send login credentials and submit the form
-	print('[+] Logging in with credentials...')
-	driver.find_element_by_name('vb_login_username').send_keys(credentials['username'])
-	driver.find_element_by_name('vb_login_password').send_keys(credentials['password'])
-	driver.find_element_by_class_name('login-button-fix').click()
-
-	# collect data from login page
-	print('[+] GET ' + url_levelrank)
-	driver.get(url_levelrank)
-	
-	# check if the login was successful
+	session = ffrsession.FFRSession(credentials)
+
 	try:
-		tbody = driver.find_element_by_xpath('//tbody[1]')
-	except NoSuchElementException:
+		rows = list(session.levelrank(stats_username))
+	except ffrsession.LoginError:
 		print("[+] ERROR: Invalid login credentials")
-		driver.quit()
 		sys.exit()
-	
-	print('[+] Scraping level ranks...')
-	raw_data = tbody.text
-
-	driver.quit()
 
-	return raw_data
+	return rows
 
-def format_data(raw_data):
+def format_data(rows):
 	"""
-	Given raw level rank data, returns a list of OrderedDict objects containing the
+	Given level rank rows, returns a list of OrderedDict objects containing the
 	difficulty, rank, and name of all levels that have not been AAA'd.
 	"""
 	print('[+] Formatting level ranks...')
-	lines = raw_data.strip().split('\n')
 	levels = []
 
-	for line in lines:
-	    # skip entries that are already AAA'd
-	    rank = int(re.sub('[,]', '', line.split(' ')[0]))
-	    if rank != 1:
-	        # extract meaningful data for each level
-	        difficulty = int(line.split(' ')[1])
-	        name = ' '.join(line.split(' ')[2:-8])
-	
-	        levels.append(OrderedDict([('D', difficulty),
-	            ('Rank', rank),
-	            ('Name', name)]))
-	
+	for cols, cells in rows:
+		# skip entries that are already AAA'd
+		rank = int(cells[cols['rank']].replace(',', ''))
+		if rank != 1:
+			# extract meaningful data for each level
+			difficulty = int(cells[cols['d']])
+			name = cells[cols['level']]
+
+			levels.append(OrderedDict([('D', difficulty),
+				('Rank', rank),
+				('Name', name)]))
+
 	return levels
 
 credentials = json.loads(open('credentials', 'r').read())
@@ -94,8 +66,8 @@ elif len(sys.argv) != 1:
 	print('\tpython3 get_level_ranks.py <OPTIONAL:stats_username>')
 	sys.exit()
 
-raw_data = get_data(credentials, stats_username)
-levels = format_data(raw_data)
+rows = get_data(credentials, stats_username)
+levels = format_data(rows)
 
 # sort the level data primarily by difficulty, and secondly by highest rank
 sorted_levels = sorted(levels, key=lambda level:level['Rank'], reverse=True)
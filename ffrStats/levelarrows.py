@@ -1,42 +1,248 @@
-"""
-Scrapes all song list pages to collect each level's arrow count.
-"""
-
-from bs4 import BeautifulSoup
-import json
-import mechanize
-
-OUTPUT_FILENAME = 'levelarrows.json'
-
-class Browser:
-    def __init__(self):
-        """Initialize mechanize browser"""
-        self.br = mechanize.Browser()
-        self.br.set_handle_robots(False)
-        self.br.addheaders = [('User-agent', 'Mozilla/5.0')]
-
-    def get(self, page):
-        url = 'http://www.flashflashrevolution.com/FFRStats/FFRSongs.php?page=' + str(page) + '&order_by=songname&order=ASC'
-        print('GET ' + url)
-        data = self.br.open(url)
-        return BeautifulSoup(data, 'html.parser', from_encoding='iso-8859-1')
-
-br = Browser()
-data = {}
-page = 1
-
-while True:
-    tables = br.get(page)('table', class_='data')
-
-    if len(tables) == 0:
-        break
-
-    for table in tables:
-        name = table.find('span', class_='name').text
-        arrows = int(table.find('td', class_='info').text.split()[-3].replace(',', ''))
-        data[name] = arrows
-
-    page += 1
-
-open(OUTPUT_FILENAME, 'w').write(json.dumps(data, indent=4, sort_keys=True))
-print('Stats written to ' + OUTPUT_FILENAME)
+"""
+Scrapes all song list pages to collect each level's arrow count.
+
+By default the pages are crawled one at a time until an empty page is
+found. Passing '--workers N' (N > 1) first determines the page count and
+then fetches the pages through a pool of N workers that share keep-alive
+connections. Use '--rate R' to cap the crawl at R requests per second.
+
+Every page is recorded in a checkpoint journal as soon as it is parsed, so
+an interrupted crawl resumes where it stopped on the next run (unless
+'--restart' is given). A finished crawl keeps each page's fingerprint and
+songs; with '--incremental' the next crawl still downloads every page but
+only parses the pages whose song table changed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import checkpoint
+import ffrsession
+import json
+import profiling
+import re
+import sys
+import threading
+import time
+
+OUTPUT_FILENAME = 'levelarrows.json'
+# progress of the current crawl, deleted once it completes
+CHECKPOINT_FILENAME = 'levelarrows.checkpoint'
+# {page: [fingerprint, songs]} from the last complete crawl, for --incremental
+PAGES_FILENAME = 'levelarrows.pages.json'
+
+# one song's table on a song list page; the rest of the page changes on every request
+SONG_TABLE = re.compile(rb'<table[^>]*class="[^"]*\bdata\b.*?</table>', re.S)
+
+# URLs
+URL_SONGS = ffrsession.URL_BASE + '/FFRStats/FFRSongs.php?page=%d&order_by=songname&order=ASC'
+
+class SongListBrowser:
+    """Thread-safe song list page fetcher over a pooled FFR session, optionally rate limited"""
+    def __init__(self, workers=1, rate=0):
+        # the song list is public, so no credentials are needed
+        self.session = ffrsession.FFRSession(pool_size=workers)
+        self.limiter = RateLimiter(rate)
+
+    def get(self, page):
+        """Returns the raw song list page"""
+        self.limiter.wait()
+        with profiling.phase('get page'):
+            return self.session.get_content(URL_SONGS % page)
+
+class RateLimiter:
+    """Spaces out calls to wait() so at most 'rate' happen per second (0 = unlimited)"""
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def parse_page(soup):
+    """Returns a list of (name, arrows) tuples for every song on a song list page"""
+    songs = []
+    with profiling.phase('parse page'):
+        for table in soup('table', class_='data'):
+            name = table.find('span', class_='name').text
+            arrows = int(table.find('td', class_='info').text.split()[-3].replace(',', ''))
+            songs.append((name, arrows))
+        profiling.add(rows=len(songs))
+    return songs
+
+def page_fingerprint(content):
+    tables = SONG_TABLE.findall(content)
+    return checkpoint.fingerprint(b''.join(tables) if tables else content)
+
+class Crawl:
+    """
+    Song list pages for one crawl. Pages recorded in the checkpoint journal
+    are not fetched again, and pages whose fingerprint matches 'previous'
+    ({page: (fingerprint, songs)} from the last complete crawl) are not
+    parsed again.
+    """
+    def __init__(self, br, journal, previous=None):
+        self.br = br
+        self.journal = journal
+        self.previous = previous or {}
+        # page -> (fingerprint, songs)
+        self.pages = {}
+        self.page_count = None
+        # highest page number linked from the first page, if it was downloaded
+        self.last_link = None
+        # the counters are updated from every worker thread
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.parsed = 0
+        self.unchanged = 0
+        for record in journal.load():
+            if 'page_count' in record:
+                self.page_count = record['page_count']
+            else:
+                self.pages[record['page']] = (record['fingerprint'], [tuple(song) for song in record['songs']])
+        self.resumed = len(self.pages)
+
+    def songs(self, page):
+        """Returns the (name, arrows) tuples on a page"""
+        if page in self.pages:
+            return self.pages[page][1]
+
+        content = self.br.get(page)
+        with self.lock:
+            self.fetched += 1
+        if page == 1:
+            self.last_link = max((int(n) for n in re.findall(rb'page=(\d+)', content)), default=None)
+        fingerprint = page_fingerprint(content)
+        old = self.previous.get(page)
+        if old is not None and old[0] == fingerprint:
+            songs = old[1]
+            with self.lock:
+                self.unchanged += 1
+        else:
+            songs = parse_page(ffrsession.parse_html(content))
+            with self.lock:
+                self.parsed += 1
+
+        self.pages[page] = (fingerprint, songs)
+        self.journal.append({'page': page, 'fingerprint': fingerprint, 'songs': songs})
+        return songs
+
+    def set_page_count(self, page_count):
+        self.page_count = page_count
+        self.journal.append({'page_count': page_count})
+
+def find_page_count(crawl):
+    """
+    Returns the number of non-empty song list pages. The pagination links on
+    the first page and the page count of the previous crawl are tried first,
+    otherwise the last page is found with an exponential probe followed by a
+    binary search.
+    """
+    if not crawl.songs(1):
+        return 0
+
+    for last in (crawl.last_link, max(crawl.previous, default=None)):
+        # make sure the guess did not stop short of the real end
+        if last and crawl.songs(last) and not crawl.songs(last + 1):
+            return last
+
+    # double until an empty page is found, then binary search between the bounds
+    lo, hi = 1, 2
+    while crawl.songs(hi):
+        lo, hi = hi, hi * 2
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if crawl.songs(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+def crawl_serial(crawl):
+    """Fetches song list pages in order until an empty page is found"""
+    results = []
+    page = 1
+
+    while True:
+        songs = crawl.songs(page)
+
+        if len(songs) == 0:
+            break
+
+        results.append(songs)
+        page += 1
+
+    return results
+
+def crawl_concurrent(crawl, workers):
+    """Fetches all song list pages using a pool of 'workers' threads"""
+    if crawl.page_count is None:
+        crawl.set_page_count(find_page_count(crawl))
+    page_count = crawl.page_count
+    print('Found %d pages' % page_count)
+
+    if page_count == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map preserves page order regardless of completion order
+        return list(executor.map(crawl.songs, range(1, page_count + 1)))
+
+def load_previous_pages():
+    pages = checkpoint.load_json(PAGES_FILENAME, {})
+    return {int(page): (fingerprint, [tuple(song) for song in songs]) for page, (fingerprint, songs) in pages.items()}
+
+def main():
+    profiling.parse_args(sys.argv)
+    parser = argparse.ArgumentParser(description='Collect the arrow count of every FFR level.',
+        epilog='Add --profile[=FILE] [--profile-phase=NAME] to write a phase trace.')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of pages fetched concurrently (default: 1, a serial crawl)')
+    parser.add_argument('--rate', type=float, default=0,
+        help='maximum requests per second, for serial and concurrent crawls (default: unlimited)')
+    parser.add_argument('--incremental', action='store_true',
+        help='only parse pages that changed since the last complete crawl')
+    parser.add_argument('--restart', action='store_true',
+        help='ignore the checkpoint of an interrupted crawl')
+    args = parser.parse_args()
+
+    journal = checkpoint.Journal(CHECKPOINT_FILENAME)
+    if args.restart:
+        journal.remove()
+    crawl = Crawl(SongListBrowser(args.workers, args.rate), journal,
+        load_previous_pages() if args.incremental else None)
+    if crawl.resumed:
+        print('Resuming from %s (%d pages done)' % (CHECKPOINT_FILENAME, crawl.resumed))
+
+    start = time.perf_counter()
+    with profiling.phase('crawl'):
+        if args.workers > 1:
+            results = crawl_concurrent(crawl, args.workers)
+        else:
+            results = crawl_serial(crawl)
+    elapsed = time.perf_counter() - start
+
+    # merge pages in page order so later duplicates win, as in a serial crawl
+    data = {}
+    for songs in results:
+        data.update(songs)
+
+    checkpoint.save_json(OUTPUT_FILENAME, data, indent=4, sort_keys=True)
+    checkpoint.save_json(PAGES_FILENAME, {page: crawl.pages[page] for page in range(1, len(results) + 1)})
+    journal.remove()
+    print('Stats written to ' + OUTPUT_FILENAME)
+    print('Crawled %d pages (%d songs) in %.2fs with %d worker(s), %.1f pages/s' %
+        (len(results), len(data), elapsed, args.workers, crawl.fetched / elapsed if elapsed else 0))
+    print('Downloaded %d pages: %d parsed, %d unchanged; %d resumed from the checkpoint' %
+        (crawl.fetched, crawl.parsed, crawl.unchanged, crawl.resumed))
+    profiling.finish()
+
+if __name__ == "__main__":
+    main()
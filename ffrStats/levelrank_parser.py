@@ -0,0 +1,80 @@
+"""
+Incremental parser for the levelrank tables on levelrank.php and
+levelrank_special.php.
+
+Rather than building a full document tree, the page is fed to an event
+driven HTML parser as it is downloaded. The header row is read once to map
+column names to indices, and every following row is yielded as a list of
+cell strings as soon as its closing tag has been seen.
+"""
+
+from html.parser import HTMLParser
+import codecs
+
+class LevelrankTableParser(HTMLParser):
+    """Collects levelrank table rows from HTML fed in arbitrary chunks"""
+    def __init__(self):
+        super().__init__()
+        # column name -> index, filled in from the first row
+        self.cols = None
+        # completed rows that have not been handed out yet
+        self.rows = []
+        self.row = None
+        self.cell = None
+        self.header = False
+        # depth of <span> elements inside a header cell; their text is the sort arrow
+        self.span_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self.row = []
+            self.header = self.cols is None
+        elif self.row is None:
+            return
+        elif tag == 'th' and self.header or tag == 'td' and not self.header:
+            self.cell = []
+        elif tag == 'span' and self.header and self.cell is not None:
+            self.span_depth += 1
+
+    def handle_endtag(self, tag):
+        if self.row is None:
+            return
+        if tag == 'span' and self.span_depth:
+            self.span_depth -= 1
+        elif tag in ('td', 'th') and self.cell is not None:
+            self.row.append(''.join(self.cell))
+            self.cell = None
+        elif tag == 'tr':
+            if self.header:
+                self.cols = {name.lower(): i for i, name in enumerate(self.row)}
+            else:
+                self.rows.append(self.row)
+            self.row = None
+
+    def handle_data(self, data):
+        if self.cell is not None and not self.span_depth:
+            self.cell.append(data)
+
+    def pop_rows(self):
+        """Returns and forgets all rows completed so far"""
+        rows, self.rows = self.rows, []
+        return rows
+
+def iter_rows(chunks, encoding='iso-8859-1'):
+    """
+    Given an iterable of raw byte chunks, yields (cols, cells) for every
+    levelrank row, where 'cols' maps lowercase column names to indices and
+    'cells' is the list of cell strings for the row.
+    """
+    parser = LevelrankTableParser()
+    decoder = codecs.getincrementaldecoder(encoding)()
+
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        for cells in parser.pop_rows():
+            yield parser.cols, cells
+
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    for cells in parser.pop_rows():
+        yield parser.cols, cells
@@ -1,59 +1,54 @@
 """
 Scrapes all tier requirement data.
 
+Each level's block on the tiers page is fingerprinted, and only blocks that
+changed since the last run are parsed again; the others are taken from
+BLOCKS_FILENAME.
+
 Assumes there is an existing file in this directory named
 'credentials.json' that contains a username and password:
 {"username":"YOUR_USERNAME","password":"YOUR_PASSWORD"}
 """
 
-from bs4 import BeautifulSoup
+import checkpoint
+import ffrsession
 import json
-import mechanize
+import profiling
+import sys
 
 OUTPUT_FILENAME = 'leveltiers.json'
+# {block fingerprint: [level name, requirements]} from the last run
+BLOCKS_FILENAME = 'leveltiers.blocks.json'
 
-# URLs
-URL_BASE = 'http://www.flashflashrevolution.com'
-URL_TIERS = URL_BASE + '/FFRStats/level_tiers.php'
+# --profile[=FILE] [--profile-phase=NAME] writes a phase trace
+profiling.parse_args(sys.argv)
 
 credentials = json.loads(open('credentials.json', 'r').read())
 
-class Browser:
-    def __init__(self):
-        """Initialize mechanize browser"""
-        self.br = mechanize.Browser()
-        self.br.set_handle_robots(False)
-        self.br.addheaders = [('User-agent', 'Mozilla/5.0')]
-
-    def login(self):
-        print('GET ' + URL_BASE)
-        self.br.open(URL_BASE)
-
-        print('Logging in with credentials...')
-        self.br.select_form(nr=0)
-        self.br.form['vb_login_username'] = credentials['username']
-        self.br.form['vb_login_password'] = credentials['password']
-        self.br.submit()
-
-        if 'invalid' in str(self.br.response().read()):
-            print('Invalid username or password. Please update credentials.json')
-        else:
-            print('Login successful!')
-
-    def get(self, url):
-        print('GET ' + url)
-        data = self.br.open(url)
-        return BeautifulSoup(data, 'html.parser', from_encoding='iso-8859-1')
-
-br = Browser()
-br.login()
+# reuses the saved login cookies when they are still valid
+session = ffrsession.FFRSession(credentials)
+try:
+    content = session.get_content(ffrsession.URL_TIERS, login_required=True)
+except ffrsession.LoginError as e:
+    print('%s. Please update credentials.json' % e)
+    sys.exit()
 
+old_blocks = checkpoint.load_json(BLOCKS_FILENAME, {})
+blocks = {}
 tiers = {}
-
-for tier_main in br.get(URL_TIERS)('div', class_='tier_main'):
-    name = tier_main.find('div', class_='tier_details')('div')[0].text
-    leveltiers = [li.text.split()[2].replace(',', '') for li in tier_main.find('ul', class_='tier_req_list')('li')]
-    tiers[name] = leveltiers
-
-open(OUTPUT_FILENAME, 'w').write(json.dumps(tiers, indent=4, sort_keys=True))
+with profiling.phase('extract tiers'):
+    for block in ffrsession.split_tier_blocks(content):
+        fingerprint = checkpoint.fingerprint(block)
+        if fingerprint not in blocks:
+            blocks[fingerprint] = old_blocks.get(fingerprint) or ffrsession.parse_tier_block(block)
+        name, requirements = blocks[fingerprint]
+        tiers[name] = requirements
+    profiling.add(rows=len(tiers))
+parsed = sum(1 for fingerprint in blocks if fingerprint not in old_blocks)
+
+with profiling.phase('write'):
+    checkpoint.save_json(OUTPUT_FILENAME, tiers, indent=4, sort_keys=True)
+    checkpoint.save_json(BLOCKS_FILENAME, blocks)
 print('Stats written to ' + OUTPUT_FILENAME)
+print('%d levels, %d tier blocks parsed, %d unchanged' % (len(tiers), parsed, len(blocks) - parsed))
+profiling.finish()
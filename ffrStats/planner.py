@@ -0,0 +1,161 @@
+"""
+Suggests what to play next: the cheapest score improvements over all of a
+user's levelranks.
+
+Every levelrank offers up to four goals: reaching the next tier threshold,
+passing the level, getting the SDG and getting the AAA. Each goal records
+the score still missing, and a cost model turns that into a cost. plan()
+heapifies the goals once and pops them cheapest first, so asking for the
+top 20 of 10k levels never sorts the whole list.
+
+    python3 planner.py [<username>] [--top K] [--cost score|difficulty|arrows] [--goals tier,AAA,...]
+"""
+
+from collections import namedtuple
+from tabulate import tabulate
+import argparse
+import bisect
+import ffrsession
+import heapq
+import itertools
+import json
+import os
+import snapshots
+import songdata
+import stats
+import sys
+
+# goal kinds, in the order they are listed for a level
+KINDS = ('tier', 'Passed', 'SDG', 'AAA')
+
+# 'gap' is the score still missing (for a pass, the unjudged arrows counted as perfects);
+# 'tp' is the number of tier points the goal earns
+Goal = namedtuple('Goal', 'level kind d arrows score target gap tp')
+
+def sdg_score(arrows):
+    """The lowest score that counts as an SDG"""
+    return stats.PERFECT_SCORE * (arrows - 10) + stats.GOOD_SCORE * 10 + 1
+
+def level_goals(levelrank):
+    """Returns the goals a levelrank (or snapshots.Row) still has open"""
+    goals = []
+    arrows = levelrank.arrows
+    score = levelrank.score
+    song = songdata.catalog().get(levelrank.level)
+    tier_table = song.tier_table if song is not None else None
+
+    if tier_table is not None:
+        i = bisect.bisect_right(tier_table.thresholds, score)
+        if i < len(tier_table.thresholds):
+            target = tier_table.thresholds[i]
+            tp = tier_table.tierpoints(target, True) - levelrank.tp
+            goals.append(Goal(levelrank.level, 'tier', levelrank.d, arrows, score, target, target - score, tp))
+
+    if not levelrank.passed():
+        # a pass needs every arrow judged; the missing arrows are counted as perfects
+        judged = levelrank.p + levelrank.g + levelrank.a + levelrank.m
+        tp = 1 if tier_table is not None and tier_table.has_passed and levelrank.tp == 0 else 0
+        goals.append(Goal(levelrank.level, 'Passed', levelrank.d, arrows, score, score,
+            max(arrows - judged, 0) * stats.PERFECT_SCORE, tp))
+
+    if not levelrank.isSDG():
+        target = sdg_score(arrows)
+        goals.append(Goal(levelrank.level, 'SDG', levelrank.d, arrows, score, target, max(target - score, 0), 0))
+
+    if not levelrank.isAAA():
+        target = stats.PERFECT_SCORE * arrows
+        goals.append(Goal(levelrank.level, 'AAA', levelrank.d, arrows, score, target, max(target - score, 0), 0))
+
+    return goals
+
+def score_cost(goal):
+    """The score still missing"""
+    return goal.gap
+
+def difficulty_cost(goal):
+    """The score still missing, weighted by the level's difficulty"""
+    return goal.gap * max(goal.d, 1)
+
+def arrows_cost(goal):
+    """The score still missing per arrow, so long charts with a spread out gap come first"""
+    return goal.gap / max(goal.arrows, 1)
+
+COST_MODELS = {
+    'score': score_cost,
+    'difficulty': difficulty_cost,
+    'arrows': arrows_cost,
+}
+
+def plan_goals(goals, cost=score_cost, kinds=KINDS):
+    """
+    Yields 'goals' cheapest first under the cost model 'cost' (ties go to
+    the goal earning more tier points). The goals are heapified once and
+    popped lazily, so taking the first K costs O(n + K log n).
+    """
+    kinds = set(kinds)
+    counter = itertools.count()
+    heap = [(cost(goal), -goal.tp, next(counter), goal) for goal in goals if goal.kind in kinds]
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[-1]
+
+def plan(levelranks, cost=score_cost, kinds=KINDS):
+    """Yields the open goals of 'levelranks' cheapest first"""
+    return plan_goals((goal for levelrank in levelranks for goal in level_goals(levelrank)), cost, kinds)
+
+def top_goals(levelranks, k, cost=score_cost, kinds=KINDS):
+    """Returns the 'k' cheapest goals"""
+    return list(itertools.islice(plan(levelranks, cost, kinds), k))
+
+def load_levelranks(username, offline, special=False):
+    """The user's public (or token) levelranks, from the site or from the latest stats.py snapshot"""
+    if offline:
+        store = snapshots.SnapshotStore(stats.SNAPSHOT_DB)
+        try:
+            snapshot = store.latest(username, 'token' if special else 'public')
+        finally:
+            store.close()
+        if snapshot is None:
+            print('[+] No snapshot of %s in %s; run stats.py first' % (username, stats.SNAPSHOT_DB))
+            sys.exit()
+        return list(snapshot.rows.values())
+
+    credentials = json.loads(open('credentials.json', 'r').read())
+    session = ffrsession.FFRSession(credentials)
+    try:
+        return stats.get_levelranks(session, username, special)
+    except ffrsession.LoginError as e:
+        print('[+] %s. Please update credentials.json' % e)
+        sys.exit()
+
+def main():
+    parser = argparse.ArgumentParser(description='List the cheapest score improvements for an FFR user.')
+    parser.add_argument('username', nargs='?',
+        help='user to plan for (default: the user in credentials.json)')
+    parser.add_argument('--top', type=int, default=20, help='number of goals to list (default: 20)')
+    parser.add_argument('--cost', choices=sorted(COST_MODELS), default='score',
+        help='cost model (default: score)')
+    parser.add_argument('--goals', default=','.join(KINDS),
+        help='comma separated goal kinds to consider (default: %(default)s)')
+    parser.add_argument('--offline', action='store_true',
+        help='use the latest snapshot stored by stats.py instead of fetching the levelranks')
+    args = parser.parse_args()
+
+    kinds = args.goals.split(',')
+    for kind in kinds:
+        if kind not in KINDS:
+            parser.error('unknown goal kind %r (choose from %s)' % (kind, ', '.join(KINDS)))
+
+    username = args.username
+    if username is None:
+        if not os.path.exists('credentials.json'):
+            parser.error('no username given and no credentials.json')
+        username = json.loads(open('credentials.json', 'r').read())['username']
+
+    levelranks = load_levelranks(username, args.offline)
+    goals = top_goals(levelranks, args.top, COST_MODELS[args.cost], kinds)
+    print(tabulate([(goal.kind, goal.d, goal.level, goal.score, goal.target, goal.gap, goal.tp or '')
+        for goal in goals], headers=('Goal', 'D', 'Name', 'Score', 'Target', 'Gap', 'TPs'), tablefmt='presto'))
+
+if __name__ == "__main__":
+    main()
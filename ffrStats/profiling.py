@@ -0,0 +1,192 @@
+"""
+Opt-in phase profiling for the ffrStats scripts.
+
+Scripts mark their phases with 'with profiling.phase(name):' and report
+transferred bytes and parsed rows with profiling.add(). Unless profiling is
+enabled (the '--profile' flag, handled by parse_args()), phase() returns a
+shared no-op context manager and add() returns immediately, so the
+instrumentation can stay in place.
+
+When enabled, every phase records its wall time, the CPU time of its
+thread, and the bytes and rows counted while it was open (nested phases
+count towards every enclosing phase on the same thread). finish() prints a
+summary and writes a Chrome trace event file that chrome://tracing and
+Perfetto can load. '--profile-phase NAME' also runs every phase called NAME
+under cProfile and prints its hottest functions.
+
+    python3 stats.py --profile[=trace.json] [--profile-phase=NAME] ...
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+# the active Profiler, or None when profiling is disabled
+profiler = None
+
+class NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_PHASE = NullPhase()
+
+class Phase:
+    __slots__ = ('profiler', 'name', 'start', 'cpu_start', 'bytes', 'rows', 'profiling')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.bytes = 0
+        self.rows = 0
+        self.profiling = False
+
+    def __enter__(self):
+        self.profiler.stack().append(self)
+        self.profiling = self.profiler.start_cprofile(self.name)
+        self.cpu_start = time.thread_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        cpu = time.thread_time_ns() - self.cpu_start
+        if self.profiling:
+            self.profiler.stop_cprofile()
+        self.profiler.stack().pop()
+        self.profiler.record(self, end, cpu)
+        return False
+
+class Profiler:
+    def __init__(self, trace_filename, cprofile_phase=None):
+        self.trace_filename = trace_filename
+        self.cprofile_phase = cprofile_phase
+        self.cprofile = cProfile.Profile() if cprofile_phase else None
+        self.cprofile_lock = threading.Lock()
+        self.cprofile_running = False
+        self.origin = time.perf_counter_ns()
+        self.local = threading.local()
+        # (name, thread id, start ns, duration ns, cpu ns, bytes, rows), appended from any thread
+        self.events = []
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, bytes=0, rows=0):
+        for phase in self.stack():
+            phase.bytes += bytes
+            phase.rows += rows
+
+    def record(self, phase, end, cpu):
+        self.events.append((phase.name, threading.get_ident(), phase.start - self.origin,
+            end - phase.start, cpu, phase.bytes, phase.rows))
+
+    def start_cprofile(self, name):
+        """Starts cProfile for a phase with the chosen name, unless it is already running in another one"""
+        if name != self.cprofile_phase:
+            return False
+        with self.cprofile_lock:
+            if self.cprofile_running:
+                return False
+            self.cprofile_running = True
+        self.cprofile.enable()
+        return True
+
+    def stop_cprofile(self):
+        self.cprofile.disable()
+        self.cprofile_running = False
+
+    def write_trace(self):
+        # small, stable thread ids read better in the trace viewer than raw idents
+        tids = {}
+        events = []
+        for name, ident, start, duration, cpu, nbytes, rows in self.events:
+            tid = tids.setdefault(ident, len(tids) + 1)
+            events.append({'name': name, 'cat': 'phase', 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                'ts': start / 1000, 'dur': duration / 1000,
+                'args': {'cpu_ms': cpu / 1e6, 'bytes': nbytes, 'rows': rows}})
+        with open(self.trace_filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        """Returns (name, count, wall s, cpu s, bytes, rows) per phase name, in order of first start"""
+        totals = {}
+        for name, _, start, duration, cpu, nbytes, rows in sorted(self.events, key=lambda event: event[2]):
+            t = totals.setdefault(name, [0, 0, 0, 0, 0])
+            t[0] += 1
+            t[1] += duration
+            t[2] += cpu
+            t[3] += nbytes
+            t[4] += rows
+        return [(name, count, wall / 1e9, cpu / 1e9, nbytes, rows)
+            for name, (count, wall, cpu, nbytes, rows) in totals.items()]
+
+    def print_summary(self):
+        print('[+] Profile (%s):' % self.trace_filename)
+        print('[+]   %-32s %5s %9s %9s %11s %7s' % ('phase', 'calls', 'wall s', 'cpu s', 'bytes', 'rows'))
+        for name, count, wall, cpu, nbytes, rows in self.summary():
+            print('[+]   %-32s %5d %9.3f %9.3f %11d %7d' % (name[:32], count, wall, cpu, nbytes, rows))
+
+        if self.cprofile is not None:
+            filename = os.path.splitext(self.trace_filename)[0] + '.prof'
+            self.cprofile.dump_stats(filename)
+            out = io.StringIO()
+            pstats.Stats(self.cprofile, stream=out).sort_stats('cumulative').print_stats(15)
+            print('[+] cProfile of phase %r (saved to %s):' % (self.cprofile_phase, filename))
+            print(out.getvalue())
+
+def phase(name):
+    """A context manager timing the phase 'name', or a no-op when profiling is disabled"""
+    if profiler is None:
+        return NULL_PHASE
+    return profiler.phase(name)
+
+def add(bytes=0, rows=0):
+    """Counts transferred bytes and parsed rows towards the phases open on this thread"""
+    if profiler is not None:
+        profiler.add(bytes, rows)
+
+def enable(trace_filename, cprofile_phase=None):
+    global profiler
+    profiler = Profiler(trace_filename, cprofile_phase)
+    return profiler
+
+def parse_args(argv):
+    """
+    Removes '--profile[=FILE]' and '--profile-phase=NAME' from 'argv' (in
+    place, so the script's own argument handling never sees them) and
+    enables profiling if either was given.
+    """
+    trace_filename = None
+    cprofile_phase = None
+    script = os.path.splitext(os.path.basename(argv[0]))[0]
+    for arg in argv[1:]:
+        if arg == '--profile' or arg.startswith('--profile='):
+            trace_filename = arg.partition('=')[2]
+        elif arg.startswith('--profile-phase='):
+            cprofile_phase = arg.partition('=')[2]
+        else:
+            continue
+        argv.remove(arg)
+
+    if trace_filename is None and cprofile_phase is None:
+        return None
+    return enable(trace_filename or time.strftime(script + '-trace-%Y-%m-%d-%H-%M-%S.json'), cprofile_phase)
+
+def finish():
+    """Writes the trace and prints the summary, if profiling is enabled"""
+    if profiler is not None:
+        profiler.write_trace()
+        profiler.print_summary()
@@ -0,0 +1,377 @@
+"""
+Columnar analytics over many users' levelranks.
+
+A RankMatrix holds one row per user and one column per level, with a NumPy
+array for each levelrank field (difficulty, score, rank, FC, p/g/a/m/b
+counts and max combo). Difficulty is kept per user because levels get
+re-rated between snapshots. Arrow counts and tier thresholds are per-level
+arrays aligned to the same columns, so AAA/SDG/pass/tier point classification
+and grouped totals are whole-array operations instead of loops over
+Levelrank objects. Levelranks whose judgement counts are unknown (FFR API
+records without them) are left out of every total, and counted separately.
+
+A matrix is built from the snapshots stored by stats.py or from FFR API
+rank dumps, and saved as a directory of .npy files plus a meta.json
+listing the users and levels. Loading memory-maps the arrays, so a large
+dataset opens without reading it.
+
+    python3 rankmatrix.py build DIR [--snapshots DB] [--page public|token] [--api NAME,...]
+    python3 rankmatrix.py bands DIR
+    python3 rankmatrix.py users DIR [--top N]
+    python3 rankmatrix.py song DIR LEVEL
+"""
+
+from collections import OrderedDict, namedtuple
+from tabulate import tabulate
+import argparse
+import checkpoint
+import ffrapi
+import json
+import numpy as np
+import os
+import snapshots
+import songdata
+import stats
+import sys
+
+META_FILENAME = 'meta.json'
+FORMAT_VERSION = 2
+
+# per-user arrays (users x levels); 'present' marks the levels a user has a levelrank for, and 'known'
+# the levelranks whose p/g/a/m/b counts and max combo are real rather than zero placeholders
+CELL_FIELDS = OrderedDict([
+    ('present', np.bool_),
+    ('known', np.bool_),
+    ('d', np.int16),
+    ('rank', np.int32),
+    ('score', np.int32),
+    ('fc', np.bool_),
+    ('p', np.uint16),
+    ('g', np.uint16),
+    ('a', np.uint16),
+    ('m', np.uint16),
+    ('b', np.uint16),
+    ('c', np.uint16),
+])
+
+# per-level arrays; 'thresholds' is levels x tiers, ascending and padded with NO_TIER
+LEVEL_FIELDS = ('arrows', 'thresholds', 'has_passed', 'tpmax')
+NO_TIER = np.iinfo(np.int32).max
+
+# an FFR API ranks record, shaped like a Levelrank for RankMatrix.build
+ApiRank = namedtuple('ApiRank', 'level d rank score fc p g a m b c arrows known')
+
+API_COUNTS = ('perfect', 'good', 'average', 'miss', 'boo', 'maxcombo')
+
+def api_rank(record):
+    """
+    Converts a record from FFRApi.iter_songs. The score, rank and difficulty
+    are always present; the judgement counts are read when the response has
+    them. Without them only an AAA score tells what the counts are (every
+    arrow a perfect); any other score is marked as not known, so it is kept
+    out of the totals instead of being counted as unpassed.
+    """
+    info = record['info']
+    scores = record['scores']
+    song = songdata.catalog().get(info['name'])
+    level = song.name if song is not None else info['name']
+    arrows = song.arrows if song is not None and song.arrows is not None else int(info.get('arrows', 0))
+    raw_score = str(scores.get('score', 0))
+    score = int(raw_score.replace(',', '').replace('*', ''))
+    fc = '*' in raw_score
+    known = all(name in scores for name in API_COUNTS)
+    if known:
+        counts = [int(str(scores[name]).replace(',', '')) for name in API_COUNTS]
+    elif arrows and score == stats.PERFECT_SCORE * arrows:
+        known = True
+        counts = [arrows, 0, 0, 0, 0, arrows]
+    else:
+        counts = [0] * len(API_COUNTS)
+    return ApiRank(level, int(info['difficulty']), int(str(scores['rank']).replace(',', '')), score, fc,
+        *counts, arrows, known)
+
+def difficulty_bands(d):
+    """The stats.DIFFICULTIES index of each difficulty in the array 'd'"""
+    # a lookup table over every difficulty present is cheaper than comparing with each band
+    table = np.array([stats.get_difficulty_index(value) for value in range(max(int(d.max(initial=0)), 0) + 1)])
+    return table[np.clip(d, 0, None)]
+
+class RankMatrix:
+    def __init__(self, usernames, levels, cells, level_data):
+        self.usernames = list(usernames)
+        self.levels = list(levels)
+        self.user_index = {username: i for i, username in enumerate(self.usernames)}
+        self.level_index = {level: i for i, level in enumerate(self.levels)}
+        # name -> array for the fields in CELL_FIELDS and LEVEL_FIELDS; each is also an attribute
+        self.cells = cells
+        self.level_data = level_data
+        for name, array in list(cells.items()) + list(level_data.items()):
+            setattr(self, name, array)
+
+    @classmethod
+    def build(cls, users):
+        """
+        'users' yields (username, levelranks), where the levelranks are
+        Levelrank objects, snapshots.Row or ApiRank. Levels missing from
+        levelarrows.json get their own column, using the row's arrow count.
+        Only an ApiRank can have unknown judgement counts.
+        """
+        catalog = songdata.level_arrows()
+        levels = sorted(catalog)
+        level_index = {level: i for i, level in enumerate(levels)}
+        extra_arrows = {}
+        usernames = []
+        user_rows = []
+        for username, levelranks in users:
+            levelranks = list(levelranks)
+            for levelrank in levelranks:
+                if levelrank.level not in level_index:
+                    level_index[levelrank.level] = len(levels)
+                    levels.append(levelrank.level)
+                    extra_arrows[levelrank.level] = levelrank.arrows
+            usernames.append(username)
+            user_rows.append(levelranks)
+
+        cells = {name: np.zeros((len(usernames), len(levels)), dtype=dtype) for name, dtype in CELL_FIELDS.items()}
+        for i, levelranks in enumerate(user_rows):
+            if not levelranks:
+                continue
+            cols = np.array([level_index[levelrank.level] for levelrank in levelranks])
+            cells['present'][i, cols] = True
+            cells['known'][i, cols] = [getattr(levelrank, 'known', True) for levelrank in levelranks]
+            for name in CELL_FIELDS:
+                if name not in ('present', 'known'):
+                    cells[name][i, cols] = [getattr(levelrank, name) for levelrank in levelranks]
+
+        tier_tables = songdata.tier_tables()
+        tier_count = max((len(table.thresholds) for table in tier_tables.values()), default=0)
+        level_data = {
+            'arrows': np.array([catalog.get(level, extra_arrows.get(level, 0)) for level in levels], dtype=np.int32),
+            'thresholds': np.full((len(levels), tier_count), NO_TIER, dtype=np.int32),
+            'has_passed': np.zeros(len(levels), dtype=np.bool_),
+            'tpmax': np.zeros(len(levels), dtype=np.int8),
+        }
+        for level, table in tier_tables.items():
+            col = level_index.get(level)
+            if col is not None:
+                level_data['thresholds'][col, :len(table.thresholds)] = table.thresholds
+                level_data['has_passed'][col] = table.has_passed
+                level_data['tpmax'][col] = table.tpmax
+        return cls(usernames, levels, cells, level_data)
+
+    @classmethod
+    def from_snapshots(cls, filename=stats.SNAPSHOT_DB, page='public', usernames=None):
+        """The latest stored snapshot of every user (or of 'usernames') for the page"""
+        store = snapshots.SnapshotStore(filename)
+        try:
+            users = []
+            for username in usernames or store.users(page):
+                snapshot = store.latest(username, page)
+                if snapshot is not None:
+                    users.append((username, snapshot.rows.values()))
+            return cls.build(users)
+        finally:
+            store.close()
+
+    @classmethod
+    def from_api(cls, api, usernames):
+        """Every user's FFR API ranks, through the on-disk cache of 'api' (an ffrapi.FFRApi)"""
+        return cls.build((username, [api_rank(record) for _, record in api.iter_songs(username)])
+            for username in usernames)
+
+    def save(self, directory):
+        """Writes one .npy file per array; meta.json is written last, so a partial save is never loaded"""
+        os.makedirs(directory, exist_ok=True)
+        for name, array in list(self.cells.items()) + list(self.level_data.items()):
+            filename = os.path.join(directory, name + '.npy')
+            with open(filename + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(filename + '.tmp', filename)
+        checkpoint.save_json(os.path.join(directory, META_FILENAME), OrderedDict([
+            ('version', FORMAT_VERSION),
+            ('usernames', self.usernames),
+            ('levels', self.levels),
+        ]))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Opens a saved matrix; with 'mmap' the arrays are read-only views of the files"""
+        meta = checkpoint.load_json(os.path.join(directory, META_FILENAME), None)
+        if meta is None or meta.get('version') != FORMAT_VERSION:
+            raise ValueError('%s is not a saved RankMatrix' % directory)
+
+        def load_array(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+
+        return cls(meta['usernames'], meta['levels'], {name: load_array(name) for name in CELL_FIELDS},
+            {name: load_array(name) for name in LEVEL_FIELDS})
+
+    def judged(self):
+        """The levelranks with known judgement counts; only these are classified and totalled"""
+        return self.present & self.known
+
+    def unknown(self):
+        """The number of levelranks left out of the totals because their judgement counts are unknown"""
+        return int((self.present & ~self.known).sum())
+
+    def passed(self):
+        judged = self.p.astype(np.int32) + self.g + self.a + self.m
+        return self.judged() & (judged == self.arrows)
+
+    def aaa(self):
+        return self.judged() & self.fc & (self.p == self.c) & (self.b == 0)
+
+    def sdg(self, passed=None):
+        if passed is None:
+            passed = self.passed()
+        return passed & (self.score > stats.PERFECT_SCORE * (self.arrows - 10) + stats.GOOD_SCORE * 10)
+
+    def tierpoints(self, passed=None):
+        """Earned tier points (users x levels), as TierTable.tierpoints would give them"""
+        if passed is None:
+            passed = self.passed()
+        tp = np.zeros(self.score.shape, dtype=np.int16)
+        tiered = np.flatnonzero(self.tpmax)
+        if len(tiered):
+            # tiers at or below each score; NO_TIER padding is never reached
+            earned = (self.score[:, tiered, None] >= self.thresholds[tiered][None, :, :]).sum(axis=2)
+            has_passed = self.has_passed[tiered]
+            tp[:, tiered] = np.where((earned > 0) | (has_passed & passed[:, tiered]), earned + has_passed, 0)
+        return np.where(self.judged(), tp, 0)
+
+    def classify(self):
+        """Returns {Totals field: users x levels array} for every levelrank with known judgement counts"""
+        judged = self.judged()
+        passed = self.passed()
+        return OrderedDict([
+            ('total', judged),
+            ('aaa', self.aaa()),
+            ('sdg', self.sdg(passed)),
+            ('fc', judged & self.fc),
+            ('passed', passed),
+            ('tpearned', self.tierpoints(passed)),
+            ('tptotal', np.where(judged, self.tpmax, 0)),
+        ])
+
+    def grouped_totals(self, keys, key_count):
+        """
+        Returns users x key_count x len(Totals.FIELDS) sums, grouping each
+        user's levels by 'keys' (users x levels, from 0 to key_count-1)
+        """
+        users = len(self.usernames)
+        # one bin per (user, key) pair
+        index = (keys + key_count * np.arange(users)[:, None]).ravel()
+        return np.stack([np.bincount(index, weights=values.ravel(), minlength=users * key_count)
+            .reshape(users, key_count).astype(np.int64) for values in self.classify().values()], axis=2)
+
+    def user_totals(self):
+        """Returns users x len(Totals.FIELDS) grand totals"""
+        return np.stack([values.sum(axis=1, dtype=np.int64) for values in self.classify().values()], axis=1)
+
+    def band_totals(self):
+        """Returns users x len(stats.DIFFICULTIES) x len(Totals.FIELDS) totals per difficulty band"""
+        return self.grouped_totals(difficulty_bands(self.d), len(stats.DIFFICULTIES))
+
+    def totals(self, username):
+        """The user's grand totals as a stats.Totals"""
+        return stats.Totals.from_list([int(value) for value in self.user_totals()[self.user_index[username]]])
+
+    def scores(self, level):
+        """The scores of every user with a levelrank for 'level'"""
+        col = self.level_index[level]
+        return np.asarray(self.score[:, col][self.present[:, col]])
+
+def print_unknown(matrix):
+    unknown = matrix.unknown()
+    if unknown:
+        print('[+] %d of %d levelranks have no judgement counts and are left out of the totals' % (
+            unknown, int(matrix.present.sum())))
+
+def print_bands(matrix):
+    totals = matrix.band_totals().sum(axis=0)
+    fields = stats.Totals.FIELDS
+    rows = []
+    for (name, _), band in reversed(list(zip(stats.DIFFICULTIES, totals))):
+        total = band[fields.index('total')]
+        if total:
+            rows.append([name, total] + ['%.1f%%' % (100 * band[fields.index(field)] / total)
+                for field in ('aaa', 'sdg', 'fc', 'passed')] +
+                ['%.1f%%' % (100 * band[fields.index('tpearned')] / max(band[fields.index('tptotal')], 1))])
+    print('[+] %d users, %d levels' % (len(matrix.usernames), len(matrix.levels)))
+    print_unknown(matrix)
+    print(tabulate(rows, headers=('Difficulty', 'Levelranks', 'AAA', 'SDG', 'FC', 'Passed', 'TPs'), tablefmt='presto'))
+
+def print_users(matrix, top):
+    totals = matrix.user_totals()
+    order = np.argsort(-totals[:, stats.Totals.FIELDS.index('tpearned')], kind='stable')[:top]
+    print_unknown(matrix)
+    print(tabulate([[matrix.usernames[i]] + totals[i].tolist() for i in order],
+        headers=('User', 'Levels', 'AAAs', 'SDGs', 'FCs', 'Passed', 'TPs', 'Max TPs'), tablefmt='presto'))
+
+def print_song(matrix, level):
+    if level not in matrix.level_index:
+        print('[+] Unknown level: ' + level)
+        return
+    scores = matrix.scores(level)
+    col = matrix.level_index[level]
+    aaa_score = stats.PERFECT_SCORE * int(matrix.arrows[col])
+    print('[+] %s: %d arrows, %d users' % (level, aaa_score // stats.PERFECT_SCORE, len(scores)))
+    if len(scores) == 0:
+        return
+    percentiles = (0, 10, 25, 50, 75, 90, 100)
+    print(tabulate([['%d%%' % q, '{:,}'.format(int(score)), '%.2f%%' % (100 * score / aaa_score if aaa_score else 0)]
+        for q, score in zip(percentiles, np.percentile(scores, percentiles, method='lower'))],
+        headers=('Percentile', 'Score', 'Of AAA'), tablefmt='presto'))
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query a users x levels matrix of FFR levelranks.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('build', help='build a matrix from the snapshot store or the FFR API')
+    p.add_argument('directory')
+    p.add_argument('--snapshots', default=stats.SNAPSHOT_DB, help='snapshot store (default: %(default)s)')
+    p.add_argument('--page', choices=('public', 'token'), default='public', help='levelrank page (default: public)')
+    p.add_argument('--api', help="comma separated users to load from the FFR API instead (key in 'credentials')")
+
+    p = sub.add_parser('bands', help='rates per difficulty over all users')
+    p.add_argument('directory')
+
+    p = sub.add_parser('users', help='per-user totals, most tier points first')
+    p.add_argument('directory')
+    p.add_argument('--top', type=int, default=20, help='number of users to list (default: 20)')
+
+    p = sub.add_parser('song', help='score distribution of one level')
+    p.add_argument('directory')
+    p.add_argument('level')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        if args.api:
+            api = ffrapi.FFRApi(json.loads(open('credentials', 'r').read())['key'])
+            try:
+                matrix = RankMatrix.from_api(api, args.api.split(','))
+            except ffrapi.ApiError as e:
+                print('ERROR: ' + str(e))
+                sys.exit()
+        else:
+            matrix = RankMatrix.from_snapshots(args.snapshots, args.page)
+        matrix.save(args.directory)
+        print('[+] %d users x %d levels written to %s' % (len(matrix.usernames), len(matrix.levels), args.directory))
+        print_unknown(matrix)
+        return
+
+    try:
+        matrix = RankMatrix.load(args.directory)
+    except (OSError, ValueError) as e:
+        print('[+] %s' % e)
+        sys.exit()
+    if args.command == 'bands':
+        print_bands(matrix)
+    elif args.command == 'users':
+        print_users(matrix, args.top)
+    else:
+        print_song(matrix, args.level)
+
+if __name__ == "__main__":
+    main()
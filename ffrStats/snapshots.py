@@ -0,0 +1,200 @@
+"""
+Local SQLite store of parsed levelrank results.
+
+Every run records one snapshot per user and levelrank page ('public' or
+'token'), holding the classified row for each level and the aggregated
+totals. Comparing the rows of a new run with the latest snapshot gives the
+list of levels that changed (new AAAs, new SDGs, tier point gains, ...),
+which is enough to update the previous totals instead of rebuilding them.
+Only the latest KEEP_RUNS runs of each user and page are kept; older runs
+are deleted as new ones are saved.
+"""
+
+from collections import namedtuple
+import json
+import sqlite3
+import time
+
+# runs kept per user and page
+KEEP_RUNS = 50
+
+# the stored Levelrank attributes, followed by the classification flags
+FIELDS = ('rank', 'd', 'level', 'score', 'fc', 'p', 'g', 'a', 'm', 'b', 'c',
+    'played', 'arrows', 'tp', 'tpmax', 'is_aaa', 'is_sdg', 'is_passed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    page TEXT NOT NULL,
+    taken_at REAL NOT NULL,
+    aggregates TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_user ON runs (username, page, taken_at);
+
+CREATE TABLE IF NOT EXISTS levelranks (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    %s,
+    PRIMARY KEY (run_id, level)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS levelranks_by_level ON levelranks (level, run_id);
+""" % ',\n    '.join('%s %s' % (field, 'TEXT NOT NULL' if field == 'level' else 'INTEGER') for field in FIELDS)
+
+class Row(namedtuple('Row', FIELDS)):
+    """A stored levelrank; behaves like a Levelrank for aggregation"""
+    __slots__ = ()
+
+    @classmethod
+    def from_levelrank(cls, levelrank):
+        return cls(*(getattr(levelrank, field) for field in FIELDS[:-3]),
+            levelrank.isAAA(), levelrank.isSDG(), levelrank.passed())
+
+    def isAAA(self):
+        return self.is_aaa
+
+    def isSDG(self):
+        return self.is_sdg
+
+    def passed(self):
+        return self.is_passed
+
+class Change(namedtuple('Change', ('level', 'old', 'new'))):
+    """A level whose row differs between two snapshots; 'old' or 'new' is None if missing"""
+    __slots__ = ()
+
+    def _gained(self, flag):
+        return self.new is not None and getattr(self.new, flag) and (self.old is None or not getattr(self.old, flag))
+
+    @property
+    def new_aaa(self):
+        return self._gained('is_aaa')
+
+    @property
+    def new_sdg(self):
+        return self._gained('is_sdg')
+
+    @property
+    def new_fc(self):
+        return self._gained('fc')
+
+    @property
+    def tp_gain(self):
+        return (self.new.tp if self.new else 0) - (self.old.tp if self.old else 0)
+
+    @property
+    def score_gain(self):
+        return (self.new.score if self.new else 0) - (self.old.score if self.old else 0)
+
+def unique_levels(rows):
+    """
+    Yields the Rows of one levelrank page with distinct level names: a name
+    already seen on the page is renamed 'NAME (2)', 'NAME (3)', ... in page
+    order, so songs that share a name are all kept.
+    """
+    seen = {}
+    for row in rows:
+        count = seen[row.level] = seen.get(row.level, 0) + 1
+        yield row if count == 1 else row._replace(level='%s (%d)' % (row.level, count))
+
+def diff(old_rows, levelranks):
+    """
+    Given the rows of a previous snapshot (level -> Row) and the current
+    levelranks, returns (rows, changes) where 'rows' maps every current
+    level to its Row and 'changes' lists only the levels that differ.
+    Repeated level names are kept apart by unique_levels().
+    """
+    rows = {}
+    changes = []
+    for row in unique_levels(Row.from_levelrank(levelrank) for levelrank in levelranks):
+        rows[row.level] = row
+        old = old_rows.get(row.level)
+        if old != row:
+            changes.append(Change(row.level, old, row))
+
+    for level, old in old_rows.items():
+        if level not in rows:
+            changes.append(Change(level, old, None))
+
+    return rows, changes
+
+class Snapshot:
+    """The latest stored run for a user and page"""
+    def __init__(self, run_id, taken_at, aggregates, rows):
+        self.run_id = run_id
+        self.taken_at = taken_at
+        # aggregated totals as stored by the caller, or None
+        self.aggregates = aggregates
+        # level -> Row
+        self.rows = rows
+
+class SnapshotStore:
+    def __init__(self, filename, keep_runs=KEEP_RUNS):
+        """'keep_runs' caps the stored runs per user and page; 0 keeps every run"""
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+        self.keep_runs = keep_runs
+
+    def close(self):
+        self.db.close()
+
+    def save(self, username, page, rows, aggregates=None):
+        """
+        Records a run of 'rows' (Row objects) with optional JSON-serializable
+        aggregates, and deletes the user's runs of the page beyond 'keep_runs'
+        in the same transaction.
+        """
+        with self.db:
+            cursor = self.db.execute('INSERT INTO runs (username, page, taken_at, aggregates) VALUES (?, ?, ?, ?)',
+                (username, page, time.time(), None if aggregates is None else json.dumps(aggregates)))
+            run_id = cursor.lastrowid
+            self.db.executemany('INSERT INTO levelranks (run_id, %s) VALUES (?, %s)' % (
+                ', '.join(FIELDS), ', '.join('?' * len(FIELDS))),
+                ((run_id,) + tuple(row) for row in rows))
+            if self.keep_runs:
+                self.prune(username, page)
+        return run_id
+
+    def prune(self, username, page):
+        old = self.db.execute('SELECT id FROM runs WHERE username = ? AND page = ? '
+            'ORDER BY taken_at DESC, id DESC LIMIT -1 OFFSET ?', (username, page, self.keep_runs)).fetchall()
+        self.db.executemany('DELETE FROM levelranks WHERE run_id = ?', old)
+        self.db.executemany('DELETE FROM runs WHERE id = ?', old)
+
+    def latest(self, username, page):
+        """Returns the most recent Snapshot for the user and page, or None"""
+        run = self.db.execute('SELECT id, taken_at, aggregates FROM runs WHERE username = ? AND page = ? '
+            'ORDER BY taken_at DESC LIMIT 1', (username, page)).fetchone()
+        if run is None:
+            return None
+
+        run_id, taken_at, aggregates = run
+        rows = {}
+        for values in self.db.execute('SELECT %s FROM levelranks WHERE run_id = ?' % ', '.join(FIELDS), (run_id,)):
+            row = _row(values)
+            rows[row.level] = row
+        return Snapshot(run_id, taken_at, None if aggregates is None else json.loads(aggregates), rows)
+
+    def users(self, page):
+        """Returns every username with a stored run of the page, sorted"""
+        return [username for username, in self.db.execute(
+            'SELECT DISTINCT username FROM runs WHERE page = ? ORDER BY username', (page,))]
+
+    def history(self, username, level=None):
+        """
+        Returns (taken_at, page, Row) for every stored run of the user, oldest
+        first, optionally restricted to a single level.
+        """
+        query = ('SELECT runs.taken_at, runs.page, %s FROM runs JOIN levelranks ON levelranks.run_id = runs.id '
+            'WHERE runs.username = ?' % ', '.join('levelranks.' + field for field in FIELDS))
+        params = [username]
+        if level is not None:
+            query += ' AND levelranks.level = ?'
+            params.append(level)
+        query += ' ORDER BY runs.taken_at'
+        return [(values[0], values[1], _row(values[2:])) for values in self.db.execute(query, params)]
+
+def _row(values):
+    # sqlite hands booleans back as integers
+    row = Row(*values)
+    return row._replace(fc=bool(row.fc), is_aaa=bool(row.is_aaa), is_sdg=bool(row.is_sdg),
+        is_passed=bool(row.is_passed))
@@ -0,0 +1,351 @@
+"""
+Song metadata from levelarrows.json and leveltiers.json.
+
+The tables are loaded lazily on first access rather than at import time,
+and are located relative to this file so the module can be imported from
+any working directory. The first load compiles both tables into a compact
+binary cache next to the JSON files; later loads memory-map the cache as
+long as it still matches the source files (same size and mtime, or failing
+that the same content hash).
+
+catalog() merges both tables into a SongCatalog that also finds levels
+whose names drifted (case, whitespace, Windows-1252 punctuation read as
+iso-8859-1, UTF-8 read as iso-8859-1, or a name cut short with '...') and answers
+range queries on arrow count, tier count and difficulty.
+"""
+
+import bisect
+import hashlib
+import json
+import marshal
+import mmap
+import os
+import re
+import struct
+import threading
+import unicodedata
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+ARROWS_FILENAME = os.path.join(DATA_DIR, 'levelarrows.json')
+TIERS_FILENAME = os.path.join(DATA_DIR, 'leveltiers.json')
+CACHE_FILENAME = os.path.join(DATA_DIR, 'songdata.cache')
+
+# cache layout: magic, then (size, mtime_ns, sha1) for each source file, then the marshalled tables
+CACHE_MAGIC = b'FFRSONG1'
+SOURCE_FORMAT = '<qq20s'
+HEADER_SIZE = len(CACHE_MAGIC) + 2 * struct.calcsize(SOURCE_FORMAT)
+
+class TierTable:
+    """Tier requirements for a level, precompiled for fast tier point lookups"""
+    __slots__ = ('thresholds', 'has_passed', 'tpmax')
+
+    def __init__(self, thresholds, has_passed, tpmax):
+        # score thresholds in ascending order; 'Passed' is the floor tier below all of them
+        self.thresholds = thresholds
+        self.has_passed = has_passed
+        self.tpmax = tpmax
+
+    @classmethod
+    def from_tiers(cls, tiers):
+        """Builds a table from a leveltiers.json entry such as ['104650', ..., 'Passed']"""
+        thresholds = tuple(sorted(int(tier) for tier in tiers if tier != 'Passed'))
+        return cls(thresholds, 'Passed' in tiers, len(tiers))
+
+    def tierpoints(self, score, passed):
+        earned = bisect.bisect_right(self.thresholds, score)
+        if earned or (self.has_passed and passed):
+            return earned + self.has_passed
+        return 0
+
+# C1 control characters are what Windows-1252 punctuation becomes when a page is read as iso-8859-1
+CP1252_FIXES = {}
+for _byte in range(0x80, 0xa0):
+    try:
+        CP1252_FIXES[_byte] = bytes([_byte]).decode('cp1252')
+    except UnicodeDecodeError:
+        pass
+
+# the marker of a name cut short, after normalization ('\u2026' becomes '...')
+TRUNCATION = re.compile(r'\s*\.{3}$')
+
+def normalize_name(name, casefold=True):
+    """
+    The lookup key for a level name: mojibake repaired, NFKC normalized,
+    whitespace collapsed and (by default) case folded
+    """
+    try:
+        # UTF-8 bytes that were decoded as iso-8859-1
+        name = name.encode('latin-1').decode('utf-8')
+    except UnicodeError:
+        pass
+    name = ' '.join(unicodedata.normalize('NFKC', name.translate(CP1252_FIXES)).split())
+    return name.casefold() if casefold else name
+
+class Song:
+    """A catalog entry; 'arrows' is None for a tiered level missing from levelarrows.json"""
+    __slots__ = ('name', 'arrows', 'tier_table', 'd')
+
+    def __init__(self, name, arrows, tier_table):
+        self.name = name
+        self.arrows = arrows
+        self.tier_table = tier_table
+        # difficulty, as last seen on a levelrank page
+        self.d = None
+
+    @property
+    def tpmax(self):
+        return self.tier_table.tpmax if self.tier_table is not None else 0
+
+    def __repr__(self):
+        return 'Song(%r, %r, tpmax=%d, d=%r)' % (self.name, self.arrows, self.tpmax, self.d)
+
+class SortedIndex:
+    """Songs sorted by one attribute, for inclusive range queries by bisection"""
+    def __init__(self, songs, key):
+        pairs = sorted(((key(song), song.name) for song in songs if key(song) is not None))
+        self.keys = [value for value, _ in pairs]
+        self.names = [name for _, name in pairs]
+
+    def range(self, lo=None, hi=None):
+        """Names of the songs with lo <= value <= hi; None leaves that end open"""
+        start = 0 if lo is None else bisect.bisect_left(self.keys, lo)
+        end = len(self.keys) if hi is None else bisect.bisect_right(self.keys, hi)
+        return self.names[start:end]
+
+class SongCatalog:
+    """
+    Every level in levelarrows.json and leveltiers.json, indexed by exact
+    name, by normalized name and by sorted normalized name for prefix
+    lookups. Sorted secondary indexes on arrow count, tier count (the tier
+    point total) and difficulty answer range queries.
+
+    Neither file has difficulties, so they are recorded by observe() as
+    levelranks are parsed; the difficulty index is rebuilt when one changes.
+    """
+    def __init__(self, level_arrows, tier_tables):
+        self.songs = {name: Song(name, arrows, tier_tables.get(name)) for name, arrows in level_arrows.items()}
+        self.by_key = {}
+        for song in self.songs.values():
+            self.by_key.setdefault(normalize_name(song.name), []).append(song)
+
+        # a tiered level spelled differently in the two files is still one song; only the
+        # normalized name counts here, a prefix could merge two different levels
+        for name, tier_table in tier_tables.items():
+            if name not in self.songs:
+                song = self.match(name, self.by_key.get(normalize_name(name), []))
+                if song is None:
+                    song = self.songs[name] = Song(name, None, tier_table)
+                    self.by_key.setdefault(normalize_name(name), []).append(song)
+                elif song.tier_table is None:
+                    song.tier_table = tier_table
+
+        self.sorted_keys = sorted(self.by_key)
+        self.by_arrows = SortedIndex(self.songs.values(), lambda song: song.arrows)
+        self.by_tpmax = SortedIndex(self.songs.values(), lambda song: song.tpmax or None)
+        self._by_d = None
+        self.lock = threading.Lock()
+        # names that could not be found, for reporting
+        self.missing = set()
+
+    def __len__(self):
+        return len(self.songs)
+
+    def get(self, name):
+        """
+        Returns the Song for 'name', or None. An exact match is a single dict
+        lookup; otherwise the normalized name is tried, and a name ending in
+        '...' may be the unique prefix of a longer one.
+        """
+        song = self.songs.get(name)
+        if song is None:
+            song = self.lookup(name)
+            if song is None:
+                self.missing.add(name)
+        return song
+
+    def lookup(self, name):
+        key = normalize_name(name)
+        candidates = self.by_key.get(key)
+        if candidates is None:
+            # a new level may well share the start of a known name, so only an explicitly
+            # shortened name is matched by prefix
+            truncated = TRUNCATION.sub('', key)
+            candidates = self.prefix(truncated) if truncated != key and truncated else []
+        return self.match(name, candidates)
+
+    def match(self, name, candidates):
+        """The single candidate for 'name', or None if there are none or several"""
+        if len(candidates) > 1:
+            # e.g. 'DESTINY' and 'Destiny' are different levels
+            exact = normalize_name(name, casefold=False)
+            candidates = [song for song in candidates if normalize_name(song.name, casefold=False) == exact]
+        return candidates[0] if len(candidates) == 1 else None
+
+    def prefix(self, prefix):
+        """Songs whose normalized name starts with the normalized 'prefix'"""
+        key = normalize_name(prefix)
+        start = bisect.bisect_left(self.sorted_keys, key)
+        songs = []
+        for i in range(start, len(self.sorted_keys)):
+            if not self.sorted_keys[i].startswith(key):
+                break
+            songs.extend(self.by_key[self.sorted_keys[i]])
+        return songs
+
+    def observe(self, song, d):
+        """Records the difficulty of a song seen on a levelrank page"""
+        if song.d != d:
+            with self.lock:
+                song.d = d
+                self._by_d = None
+
+    @property
+    def by_d(self):
+        with self.lock:
+            if self._by_d is None:
+                self._by_d = SortedIndex(self.songs.values(), lambda song: song.d)
+            return self._by_d
+
+    def query(self, arrows=None, tpmax=None, d=None):
+        """
+        Returns the songs in every given (lo, hi) range, sorted by name; for
+        example query(arrows=(1500, 2000), tpmax=(10, None)). The narrowest
+        range is taken from its index and the others are checked per song.
+        """
+        ranges = [(index, bounds) for index, bounds in ((self.by_arrows, arrows), (self.by_tpmax, tpmax),
+            (self.by_d, d)) if bounds is not None]
+        if not ranges:
+            return sorted(self.songs.values(), key=lambda song: song.name)
+
+        candidates = min((index.range(*bounds) for index, bounds in ranges), key=len)
+        checks = [(attribute, bounds) for attribute, bounds in (('arrows', arrows), ('tpmax', tpmax), ('d', d))
+            if bounds is not None]
+        songs = []
+        for name in candidates:
+            song = self.songs[name]
+            if all(_in_range(getattr(song, attribute), bounds) for attribute, bounds in checks):
+                songs.append(song)
+        return sorted(songs, key=lambda song: song.name)
+
+def _in_range(value, bounds):
+    lo, hi = bounds
+    return value is not None and (lo is None or value >= lo) and (hi is None or value <= hi)
+
+_level_arrows = None
+_tier_tables = None
+_catalog = None
+
+def level_arrows():
+    """Returns a dict mapping each level name to its arrow count"""
+    if _level_arrows is None:
+        _load()
+    return _level_arrows
+
+def tier_tables():
+    """Returns a dict mapping each tiered level name to its TierTable"""
+    if _tier_tables is None:
+        _load()
+    return _tier_tables
+
+def catalog():
+    """Returns the SongCatalog of both tables"""
+    global _catalog
+    if _catalog is None:
+        _catalog = SongCatalog(level_arrows(), tier_tables())
+    return _catalog
+
+def _load():
+    global _level_arrows, _tier_tables
+
+    sources = [_source_stat(ARROWS_FILENAME), _source_stat(TIERS_FILENAME)]
+    tables = _read_cache(sources)
+    if tables is None:
+        tables = _compile()
+        _write_cache(sources, tables)
+
+    arrows, tiers = tables
+    _level_arrows = arrows
+    _tier_tables = {level: TierTable(*tier) for level, tier in tiers.items()}
+
+def _source_stat(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns
+
+def _source_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+def _compile():
+    """Parses the JSON sources into (arrows, tiers) with tiers as TierTable arguments"""
+    with open(ARROWS_FILENAME, 'r') as f:
+        arrows = json.load(f)
+    with open(TIERS_FILENAME, 'r') as f:
+        tiers = json.load(f)
+
+    compiled_tiers = {}
+    for level, level_tiers in tiers.items():
+        table = TierTable.from_tiers(level_tiers)
+        compiled_tiers[level] = (table.thresholds, table.has_passed, table.tpmax)
+    return arrows, compiled_tiers
+
+def _read_cache(sources):
+    """Returns the cached tables, or None if the cache is missing or stale"""
+    try:
+        f = open(CACHE_FILENAME, 'rb')
+    except OSError:
+        return None
+
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        with mm:
+            if len(mm) < HEADER_SIZE or mm[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+                return None
+
+            offset = len(CACHE_MAGIC)
+            stale = False
+            for filename, (size, mtime) in zip((ARROWS_FILENAME, TIERS_FILENAME), sources):
+                cached_size, cached_mtime, cached_hash = struct.unpack_from(SOURCE_FORMAT, mm, offset)
+                offset += struct.calcsize(SOURCE_FORMAT)
+                if (cached_size, cached_mtime) == (size, mtime):
+                    continue
+                # the file was touched or rewritten; only the content hash decides
+                if cached_size != size or cached_hash != _source_hash(filename):
+                    return None
+                stale = True
+
+            with memoryview(mm) as view:
+                payload = view[HEADER_SIZE:]
+                try:
+                    tables = marshal.loads(payload)
+                except (EOFError, ValueError, TypeError):
+                    return None
+                finally:
+                    payload.release()
+
+    if stale:
+        # contents are unchanged, so refresh the recorded mtimes to skip hashing next time
+        _write_cache(sources, tables)
+    return tables
+
+def _write_cache(sources, tables):
+    header = CACHE_MAGIC
+    for filename, (size, mtime) in zip((ARROWS_FILENAME, TIERS_FILENAME), sources):
+        header += struct.pack(SOURCE_FORMAT, size, mtime, _source_hash(filename))
+
+    # write to a temporary file first so a concurrent reader never sees a partial cache
+    tmp_filename = CACHE_FILENAME + '.%d.tmp' % os.getpid()
+    try:
+        with open(tmp_filename, 'wb') as f:
+            f.write(header)
+            f.write(marshal.dumps(tables))
+        os.replace(tmp_filename, CACHE_FILENAME)
+    except OSError:
+        # the cache is only an optimization; a read-only checkout still works
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
@@ -1,31 +1,55 @@
 """
 Collects all FFR level rank and tier point data for a user.
 The data is formatted into a collection of stats which are posted 
-to the given random thought id.
+to the given random thought id. The report is also written to a file in
+every format listed in REPORT_FORMATS, and it is only posted when it
+differs from the last report posted to the random thought.
 
 Assumes there is an existing file in this directory named
 'credentials.json' that contains a username and password:
 {"username":"YOUR_USERNAME","password":"YOUR_PASSWORD"}
 """
 
-from bs4 import BeautifulSoup
 from collections import OrderedDict
-from tabulate import tabulate
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import ffrsession
+import hashlib
+import html
+import io
 import json
-import math
-import mechanize
-import re
+import levelrank_parser
+import os
+import profiling
+import random
+import requests
+import snapshots
+import songdata
 import sys
 import time
+import urllib.parse
 
 # config
 HIDE_ZERO_DIFFICULTY = True
 MAX_DIFFICULTY_LEVEL_TOTAL = 102
 RANDOM_THOUGHT_ID = '234639'
 SHOW_PASSED = False
+# parse levelrank pages incrementally as they download instead of building a BeautifulSoup tree
+STREAM_LEVELRANKS = True
+# batch mode: maximum concurrent requests, and retries per page with exponential backoff
+BATCH_MAX_CONCURRENCY = 8
+BATCH_RETRIES = 3
+BATCH_BACKOFF = 1.0
+# SQLite file that keeps every run's levelranks for diffing against the next run (None to disable)
+SNAPSHOT_DB = 'snapshots.db'
+# report files written by every run; 'txt' is the BBCode that gets posted
+REPORT_FORMATS = ('txt', 'json', 'csv', 'html')
+# SHA-1 of the last body posted to each random thought; delete it to force the next post
+POST_HASH_FILENAME = 'posted.json'
 
 # URLs
-URL_BASE = 'http://www.flashflashrevolution.com'
+URL_BASE = ffrsession.URL_BASE
 URL_POST = URL_BASE + '/profile/edit/thoughts/' + RANDOM_THOUGHT_ID
 
 # colors
@@ -36,6 +60,9 @@ HEX_FC = "009900"
 HEX_PASS = "999999"
 HEX_TP = "CF2222"
 
+# bonus tier points for the AAA percentage, one per percent above 49%
+MAX_EXTRA_TIERPOINTS = 50
+
 # raw scoring values
 PERFECT_SCORE = 50
 GOOD_SCORE = 25
@@ -60,75 +87,102 @@ DIFFICULTIES = [
     ('Easiest', 1),
     ('Zero', 0)
 ]
-LEVEL_ARROWS = json.loads(open('levelarrows.json', 'r').read())
-LEVEL_TIERS = json.loads(open('leveltiers.json', 'r').read())
 
-class Browser:
+def post_stats(session, body, form=None):
+    """Posts the report, using the already loaded post form if one is given"""
+    if form is None:
+        form = session.get_form(URL_POST)
+    session.submit(form, {'blog_title': time.strftime('Stats - %b %d, %Y'), 'blog_post': body})
+    print('[+] Stats posted to random thought ' + RANDOM_THOUGHT_ID)
+
+def load_post_hashes():
+    try:
+        with open(POST_HASH_FILENAME, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def post_stats_if_changed(session, body, load_form=None):
+    """
+    Posts the report unless it is identical to the last one posted; returns
+    whether it was posted. 'load_form' returns the post form (or None to
+    load it here), and is only called once the post is going to be made.
+    """
+    digest = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    hashes = load_post_hashes()
+    if hashes.get(RANDOM_THOUGHT_ID) == digest:
+        print('[+] Stats unchanged since the last post to random thought %s, not posting' % RANDOM_THOUGHT_ID)
+        return False
+
+    post_stats(session, body, load_form() if load_form else None)
+    hashes[RANDOM_THOUGHT_ID] = digest
+    with open(POST_HASH_FILENAME + '.tmp', 'w') as f:
+        json.dump(hashes, f)
+    os.replace(POST_HASH_FILENAME + '.tmp', POST_HASH_FILENAME)
+    return True
+
+class Timeline:
+    """Records when each stage of a run starts and ends, to show how the stages overlap"""
     def __init__(self):
-        """Initialize mechanize browser"""
-        self.br = mechanize.Browser()
-        self.br.set_handle_robots(False)
-        self.br.addheaders = [('User-agent', 'Mozilla/5.0')]
-
-    def login(self, credentials):
-        print('[+] GET ' + URL_BASE)
-        self.br.open(URL_BASE)
-
-        print('[+] Logging in with credentials...')
-        self.br.select_form(nr=0)
-        self.br.form['vb_login_username'] = credentials['username']
-        self.br.form['vb_login_password'] = credentials['password']
-        self.br.submit()
-
-        if 'invalid' in str(self.br.response().read()):
-            print('[+] Invalid username or password. Please update credentials.json')
-        else:
-            print('[+] Login successful!')
-
-    def get(self, url):
-        print('[+] GET ' + url)
-        data = self.br.open(url)
-        return BeautifulSoup(data, 'html.parser', from_encoding='iso-8859-1')
-
-    def post_stats(self, body):
-        print('[+] GET ' + URL_POST)
-        self.br.open(URL_POST)
-        self.br.select_form(nr=0)
-        self.br.form['blog_title'] = time.strftime('Stats - %b %d, %Y')
-        self.br.form['blog_post'] = body
-        self.br.submit()
-        print('[+] Stats posted to random thought ' + RANDOM_THOUGHT_ID)
+        self.start = time.perf_counter()
+        # (name, start, end) in seconds since the run started; appended from several threads
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with profiling.phase(name):
+                yield
+        finally:
+            self.stages.append((name, start - self.start, time.perf_counter() - self.start))
+
+    def report(self, width=40):
+        wall = time.perf_counter() - self.start
+        print('[+] Timing breakdown (%.2fs wall):' % wall)
+        for name, start, end in sorted(self.stages, key=lambda stage: stage[1]):
+            first = int(width * start / wall)
+            bar = ' ' * first + '#' * max(int(width * end / wall) - first, 1)
+            print('[+]   %-18s %6.2fs - %6.2fs  |%-*s|' % (name, start, end, width, bar))
 
 class Levelrank:
     """A row of levelrank data"""
+    __slots__ = ('rank', 'd', 'level', 'score', 'fc', 'p', 'g', 'a', 'm', 'b', 'c',
+        'played', 'arrows', 'tp', 'tpmax')
+
     def __init__(self, row, cols):
-        self.rank = int(row[cols['rank']].string.replace(',', ''))
-        self.d = int(row[cols['d']].string)
-        self.level = row[cols['level']].string
-        self.score = int(row[cols['score']].string.replace(',', '').replace('*', ''))
-        self.fc = '*' in row[cols['score']].string
-        self.p = int(row[cols['p']].string.replace(',', ''))
-        self.g = int(row[cols['g']].string.replace(',', ''))
-        self.a = int(row[cols['a']].string.replace(',', ''))
-        self.m = int(row[cols['m']].string.replace(',', ''))
-        self.b = int(row[cols['b']].string.replace(',', ''))
-        self.c = int(row[cols['c']].string.replace(',', ''))
-        self.played = int(row[cols['played']].string.replace(',', ''))
-        self.arrows = LEVEL_ARROWS[self.level]
+        """'row' is the list of cell strings for the row"""
+        self.rank = int(row[cols['rank']].replace(',', ''))
+        self.d = int(row[cols['d']])
+        self.level = row[cols['level']]
+        self.score = int(row[cols['score']].replace(',', '').replace('*', ''))
+        self.fc = '*' in row[cols['score']]
+        self.p = int(row[cols['p']].replace(',', ''))
+        self.g = int(row[cols['g']].replace(',', ''))
+        self.a = int(row[cols['a']].replace(',', ''))
+        self.m = int(row[cols['m']].replace(',', ''))
+        self.b = int(row[cols['b']].replace(',', ''))
+        self.c = int(row[cols['c']].replace(',', ''))
+        self.played = int(row[cols['played']].replace(',', ''))
         self.tp = 0
         self.tpmax = 0
 
-        if self.level in LEVEL_TIERS:
-            tiers = LEVEL_TIERS[self.level]
-            self.tpmax = len(tiers)
-            self.tp = self.tpmax
+        catalog = songdata.catalog()
+        song = catalog.get(self.level)
+        if song is None or song.arrows is None:
+            # unknown level (catalog.missing lists it): assume every arrow was judged
+            self.arrows = self.p + self.g + self.a + self.m
+        else:
+            self.arrows = song.arrows
+        if song is None:
+            return
+        # names that drifted are reported under the catalog's spelling
+        self.level = song.name
+        catalog.observe(song, self.d)
 
-            for tier in tiers:
-                if tier != 'Passed' and self.score >= int(tier):
-                    break
-                elif tier == 'Passed' and self.passed():
-                    break
-                self.tp -= 1
+        if song.tier_table is not None:
+            self.tpmax = song.tier_table.tpmax
+            self.tp = song.tier_table.tierpoints(self.score, self.passed())
 
     def isAAA(self):
         return self.fc and self.p == self.c and self.b == 0
@@ -151,17 +205,41 @@ class Totals:
         self.tptotal = 0
 
     def add_levelrank(self, levelrank):
-        self.total += 1
-        self.tpearned += levelrank.tp
-        self.tptotal += levelrank.tpmax
-        if levelrank.isAAA():
-            self.aaa += 1
-        if levelrank.isSDG():
-            self.sdg += 1
-        if levelrank.fc:
-            self.fc += 1
-        if levelrank.passed():
-            self.passed += 1
+        self.add(levelrank.tp, levelrank.tpmax, levelrank.isAAA(), levelrank.isSDG(),
+            levelrank.fc, levelrank.passed())
+
+    def add(self, tp, tpmax, aaa, sdg, fc, passed, count=1):
+        """Adds an already classified levelrank; a count of -1 removes it again"""
+        self.total += count
+        self.tpearned += tp * count
+        self.tptotal += tpmax * count
+        self.aaa += aaa * count
+        self.sdg += sdg * count
+        self.fc += fc * count
+        self.passed += passed * count
+
+    def merge(self, other):
+        self.total += other.total
+        self.aaa += other.aaa
+        self.sdg += other.sdg
+        self.fc += other.fc
+        self.passed += other.passed
+        self.tpearned += other.tpearned
+        self.tptotal += other.tptotal
+
+    FIELDS = ('total', 'aaa', 'sdg', 'fc', 'passed', 'tpearned', 'tptotal')
+
+    def to_list(self):
+        return [self.total, self.aaa, self.sdg, self.fc, self.passed, self.tpearned, self.tptotal]
+
+    def to_dict(self):
+        return OrderedDict(zip(self.FIELDS, self.to_list()))
+
+    @classmethod
+    def from_list(cls, values):
+        totals = cls()
+        totals.total, totals.aaa, totals.sdg, totals.fc, totals.passed, totals.tpearned, totals.tptotal = values
+        return totals
 
     def to_string(self):
         s = ''
@@ -182,95 +260,479 @@ class Totals:
             s += ' %d/%d [color=#%s]TPs[/color]' % (self.tpearned, self.tptotal, HEX_TP)
         return s + '\n'
 
+class Aggregates:
+    """
+    Totals for a collection of levelranks, computed in a single pass.
+
+    Each levelrank is classified once and added to the grand totals and to
+    every grouping in 'groupings', which maps a grouping name to a function
+    returning the group key for a levelrank. Grouped totals are available
+    as groups[name][key].
+    """
+    GROUPINGS = {
+        'difficulty': lambda levelrank: get_difficulty_index(levelrank.d),
+        'd': lambda levelrank: levelrank.d,
+        'tpmax': lambda levelrank: levelrank.tpmax,
+    }
+
+    def __init__(self, levelranks=(), groupings=None):
+        self.groupings = self.GROUPINGS if groupings is None else groupings
+        self.groups = {name: {} for name in self.groupings}
+        self.totals = Totals()
+        for levelrank in levelranks:
+            self.add_levelrank(levelrank)
+
+    def add_levelrank(self, levelrank, count=1):
+        classification = (levelrank.tp, levelrank.tpmax, levelrank.isAAA(), levelrank.isSDG(),
+            levelrank.fc, levelrank.passed(), count)
+
+        self.totals.add(*classification)
+        for name, key_func in self.groupings.items():
+            group = self.groups[name]
+            key = key_func(levelrank)
+            if key not in group:
+                group[key] = Totals()
+            group[key].add(*classification)
+            if group[key].total == 0:
+                del group[key]
+
+    def remove_levelrank(self, levelrank):
+        self.add_levelrank(levelrank, -1)
+
+    def apply_changes(self, changes):
+        """Updates the totals with a list of snapshots.Change"""
+        for change in changes:
+            if change.old is not None:
+                self.remove_levelrank(change.old)
+            if change.new is not None:
+                self.add_levelrank(change.new)
+
+    def to_dict(self):
+        return {
+            'totals': self.totals.to_list(),
+            'groups': {name: [[key, totals.to_list()] for key, totals in group.items()]
+                for name, group in self.groups.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        aggregates = cls()
+        aggregates.totals = Totals.from_list(data['totals'])
+        for name, group in data['groups'].items():
+            aggregates.groups[name] = {key: Totals.from_list(values) for key, values in group}
+        return aggregates
+
+    def merge(self, other):
+        """Adds the totals of another Aggregates with the same groupings"""
+        self.totals.merge(other.totals)
+        for name, group in other.groups.items():
+            mine = self.groups[name]
+            for key, totals in group.items():
+                if key not in mine:
+                    mine[key] = Totals()
+                mine[key].merge(totals)
+        return self
+
 def extract_levelranks(raw_data):
+    rows = raw_data('tr')
+
     # get table columns
     cols = {}
-    for i, th in enumerate(raw_data('tr')[0]('th')):
+    for i, th in enumerate(rows[0]('th')):
         if th.span:
             # remove arrow from table headers
             th.span.extract()
         cols[th.string.lower()] = i
 
-    return [Levelrank(tr('td'), cols) for tr in raw_data('tr')[1:]]
-
-def format_levelranks(levelranks, output_filename, title, write_level_totals):
-    # per-difficulty totals
-    difficulty_totals = [Totals() for _ in range(len(DIFFICULTIES))]
-    # per-level totals
-    level_totals = {}
-    # grand totals
-    totals = Totals()
-
-    # accumulate totals
-    for levelrank in levelranks:
-        difficulty_totals[get_difficulty_index(levelrank.d)].add_levelrank(levelrank)
-        if levelrank.d not in level_totals:
-            level_totals[levelrank.d] = Totals()
-        level_totals[levelrank.d].add_levelrank(levelrank)
-        totals.add_levelrank(levelrank)
-
-    with open(output_filename, 'a') as f:
-        f.write('[b][u]' + title + '[/u][/b]\n\n')
-
-        # write per-difficulty totals
+    return [Levelrank([td.string for td in tr('td')], cols) for tr in rows[1:]]
+
+def stream_levelranks(chunks):
+    """Yields a Levelrank for each table row as the raw page chunks arrive"""
+    for cols, cells in levelrank_parser.iter_rows(chunks):
+        yield Levelrank(cells, cols)
+
+def get_levelranks(session, username, special=False):
+    if STREAM_LEVELRANKS:
+        # the table is parsed while it downloads; Levelrank objects are built afterwards so
+        # the profile can tell the two apart
+        with profiling.phase('fetch and parse rows'):
+            rows = list(session.special_levelrank(username) if special else session.levelrank(username))
+            profiling.add(rows=len(rows))
+        with profiling.phase('build levelranks'):
+            return [Levelrank(cells, cols) for cols, cells in rows]
+    url = ffrsession.URL_SPECIAL_LEVELRANK if special else ffrsession.URL_LEVELRANK
+    soup = session.get_soup(url % urllib.parse.quote(username), login_required=True)
+    with profiling.phase('build levelranks'):
+        levelranks = extract_levelranks(soup)
+        profiling.add(rows=len(levelranks))
+    return levelranks
+
+class Report:
+    """
+    The contents of a stats report, built once from the aggregated totals.
+    Only what the post shows is kept: difficulties and levels that still have
+    AAAs remaining, and tier point totals that are not complete yet. Render it
+    with one of the RENDERERS.
+    """
+    def __init__(self, aggregates, token_aggregates, changes=(), since=None):
+        # None unless a previous snapshot exists and something changed since
+        self.changes = ReportChanges(changes, since) if since is not None else None
+        if self.changes is not None and not self.changes:
+            self.changes = None
+        self.sections = [
+            ReportSection(aggregates, 'Public Level Stats', True),
+            ReportSection(token_aggregates, 'Token Level Stats', False),
+        ]
+        all_aggregates = Aggregates().merge(aggregates).merge(token_aggregates)
+        totals = all_aggregates.totals
+
+        # (tier total, earned, total) for every tier point total with points remaining
+        self.tiers = [(tiertotal, t.tpearned, t.tptotal)
+            for tiertotal, t in sorted(all_aggregates.groups['tpmax'].items(), key=lambda x:x[0])
+            if tiertotal != 0 and t.tpearned != t.tptotal]
+        self.extra_tierpoints = extra_tierpoints(totals)
+        self.max_extra_tierpoints = MAX_EXTRA_TIERPOINTS
+        self.earned_tierpoints = totals.tpearned + self.extra_tierpoints
+        self.total_tierpoints = totals.tptotal + self.max_extra_tierpoints
+
+    def to_dict(self):
+        return OrderedDict([
+            ('changes', self.changes.to_dict() if self.changes else None),
+            ('sections', [section.to_dict() for section in self.sections]),
+            ('tierpoints', OrderedDict([
+                ('tiers', [OrderedDict([('tier', tier), ('tpearned', earned), ('tptotal', total)])
+                    for tier, earned, total in self.tiers]),
+                ('extra', self.extra_tierpoints),
+                ('max_extra', self.max_extra_tierpoints),
+                ('tpearned', self.earned_tierpoints),
+                ('tptotal', self.total_tierpoints),
+            ])),
+        ])
+
+class ReportSection:
+    """The difficulty, level and grand totals of one levelrank page"""
+    def __init__(self, aggregates, title, show_levels):
+        difficulty_totals = aggregates.groups['difficulty']
+        self.title = title
+        self.totals = aggregates.totals
+
+        # (difficulty name, Totals), easiest first
+        self.difficulties = []
         for i in range(len(DIFFICULTIES)-1, -1, -1):
             if HIDE_ZERO_DIFFICULTY and i == len(DIFFICULTIES) - 1:
                 continue
-            if difficulty_totals[i].aaa == difficulty_totals[i].total:
+            if i not in difficulty_totals or difficulty_totals[i].aaa == difficulty_totals[i].total:
                 continue
-            f.write('[color=#%s]%s[/color]:%s' % (HEX_D, DIFFICULTIES[i][0], difficulty_totals[i].to_string()))
-        f.write('\n')
+            self.difficulties.append((DIFFICULTIES[i][0], difficulty_totals[i]))
 
-        # write per-level totals
-        if (write_level_totals):
-            for d, t in sorted(level_totals.items(), key=lambda x:x[0]):
+        # (d, Totals), or None if the section does not show per-level totals
+        self.levels = None
+        if show_levels:
+            self.levels = []
+            for d, t in sorted(aggregates.groups['d'].items(), key=lambda x:x[0]):
                 if HIDE_ZERO_DIFFICULTY and d == 0:
                     continue
                 if d > MAX_DIFFICULTY_LEVEL_TOTAL:
                     break
                 if t.aaa == t.total:
                     continue
-                f.write('[color=#%s]%d[/color]:%s' % (HEX_D, d, t.to_string()))
-            f.write('\n')
-
-        # write grand totals
-        f.write('[color=#%s]AAAs[/color]: %d/%d %.1f%%\n' % (HEX_AAA, totals.aaa, totals.total, 100 * totals.aaa / totals.total))
-        f.write('[color=#%s]SDGs[/color]: %d/%d %.1f%%\n' % (HEX_SDG, totals.sdg, totals.total, 100 * totals.sdg / totals.total))
-        f.write('[color=#%s]FCs[/color]: %d/%d %.1f%%\n' % (HEX_FC, totals.fc, totals.total, 100 * totals.fc / totals.total))
-        if SHOW_PASSED:
-            f.write('[color=#%s]Passed[/color]: %d/%d %.1f%%\n' % (HEX_PASS, totals.passed, totals.total, 100 * totals.passed / totals.total))
-        f.write('[color=#%s]TPs[/color]: %d/%d %.1f%%\n' % (HEX_TP, totals.tpearned, totals.tptotal, 100 * totals.tpearned / totals.tptotal))
-        f.write('\n')
-
-def format_tierpoints(all_levelranks, output_filename):
-    tiertotals = set()
-
-    for levelrank in all_levelranks:
-        if levelrank.tpmax == 0:
-            continue
-        tiertotals.add(levelrank.tpmax)
-
-    with open(output_filename, 'a') as f:
-        f.write('[b][u]Tier Point Stats[/u][/b]\n')
-
-        for tiertotal in sorted(tiertotals):
-            lts = list(filter(lambda x: x.tpmax == tiertotal, all_levelranks))
-            earned = sum(lt.tp for lt in lts)
-            total = sum(lt.tpmax for lt in lts)
-            if earned != total:
-                f.write('\n[color=#%s]/%d[/color]: %d/%d [color=#%s]TPs[/color]' % (HEX_D, tiertotal, earned, total, HEX_TP))
-
-        total_aaas = len(list(filter(lambda x: x.isAAA(), all_levelranks)))
-        extra_tierpoints = max(int(100 * total_aaas / len(all_levelranks)) - 49, 0)
-        max_extra_tierpoints = 50
+                self.levels.append((d, t))
+
+    def to_dict(self):
+        return OrderedDict([
+            ('title', self.title),
+            ('difficulties', [OrderedDict([('difficulty', name)] + list(t.to_dict().items()))
+                for name, t in self.difficulties]),
+            ('levels', None if self.levels is None else
+                [OrderedDict([('d', d)] + list(t.to_dict().items())) for d, t in self.levels]),
+            ('totals', self.totals.to_dict()),
+        ])
+
+class ReportChanges:
+    """Levels that improved since the previous snapshot"""
+    def __init__(self, changes, since):
+        self.since = since
+        self.aaas = sorted(change.level for change in changes if change.new_aaa)
+        self.sdgs = sorted(change.level for change in changes if change.new_sdg and not change.new_aaa)
+        self.fcs = sorted(change.level for change in changes if change.new_fc and not change.new_aaa)
+        self.tp_gains = sorted((change.level, change.tp_gain) for change in changes if change.tp_gain > 0)
+
+    def __bool__(self):
+        return bool(self.aaas or self.sdgs or self.fcs or self.tp_gains)
+
+    def to_dict(self):
+        return OrderedDict([
+            ('since', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.since))),
+            ('aaas', self.aaas),
+            ('sdgs', self.sdgs),
+            ('fcs', self.fcs),
+            ('tp_gains', [OrderedDict([('level', level), ('tp', gain)]) for level, gain in self.tp_gains]),
+        ])
+
+# the grand total lines: (label, color, Totals attribute of the achieved count)
+TOTAL_LINES = [
+    ('AAAs', HEX_AAA, 'aaa'),
+    ('SDGs', HEX_SDG, 'sdg'),
+    ('FCs', HEX_FC, 'fc'),
+    ('Passed', HEX_PASS, 'passed'),
+]
 
-        f.write('\n[color=#%s]+[/color]: %d/%d [color=#%s]TPs[/color]' % (HEX_D, extra_tierpoints, max_extra_tierpoints, HEX_TP))
+def total_lines(totals):
+    """Returns (label, color, achieved, total) for every grand total line shown"""
+    lines = [(label, color, getattr(totals, attr), totals.total) for label, color, attr in TOTAL_LINES
+        if SHOW_PASSED or attr != 'passed']
+    lines.append(('TPs', HEX_TP, totals.tpearned, totals.tptotal))
+    return lines
+
+def percent(achieved, total):
+    """achieved/total as a percentage; 0 for a user without any levelranks"""
+    return 100 * achieved / total if total else 0.0
+
+def render_bbcode(report):
+    """The random thought post"""
+    out = []
+    changes = report.changes
+    if changes:
+        out.append('[b][u]Changes Since %s[/u][/b]\n\n' % time.strftime('%b %d, %Y', time.localtime(changes.since)))
+        if changes.aaas:
+            out.append('[color=#%s]New AAAs[/color]: %s\n' % (HEX_AAA, ', '.join(changes.aaas)))
+        if changes.sdgs:
+            out.append('[color=#%s]New SDGs[/color]: %s\n' % (HEX_SDG, ', '.join(changes.sdgs)))
+        if changes.fcs:
+            out.append('[color=#%s]New FCs[/color]: %s\n' % (HEX_FC, ', '.join(changes.fcs)))
+        if changes.tp_gains:
+            out.append('[color=#%s]TPs[/color]: +%d (%s)\n' % (HEX_TP, sum(gain for _, gain in changes.tp_gains),
+                ', '.join('%s +%d' % tp_gain for tp_gain in changes.tp_gains)))
+        out.append('\n')
+
+    for section in report.sections:
+        out.append('[b][u]' + section.title + '[/u][/b]\n\n')
+        for name, t in section.difficulties:
+            out.append('[color=#%s]%s[/color]:%s' % (HEX_D, name, t.to_string()))
+        out.append('\n')
+        if section.levels is not None:
+            for d, t in section.levels:
+                out.append('[color=#%s]%d[/color]:%s' % (HEX_D, d, t.to_string()))
+            out.append('\n')
+        for label, color, achieved, total in total_lines(section.totals):
+            out.append('[color=#%s]%s[/color]: %d/%d %.1f%%\n' % (color, label, achieved, total, percent(achieved, total)))
+        out.append('\n')
+
+    out.append('[b][u]Tier Point Stats[/u][/b]\n')
+    for tiertotal, earned, total in report.tiers:
+        out.append('\n[color=#%s]/%d[/color]: %d/%d [color=#%s]TPs[/color]' % (HEX_D, tiertotal, earned, total, HEX_TP))
+    out.append('\n[color=#%s]+[/color]: %d/%d [color=#%s]TPs[/color]' % (HEX_D, report.extra_tierpoints,
+        report.max_extra_tierpoints, HEX_TP))
+    out.append('\n\n[color=#%s]TPs[/color]: %d/%d %.1f%%' % (HEX_TP, report.earned_tierpoints,
+        report.total_tierpoints, percent(report.earned_tierpoints, report.total_tierpoints)))
+    return ''.join(out)
+
+def render_json(report):
+    return json.dumps(report.to_dict(), indent=4) + '\n'
+
+def render_csv(report):
+    """One row per totals line; the list of changed levels is left out"""
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(('section', 'group', 'key') + Totals.FIELDS)
+    for section in report.sections:
+        for name, t in section.difficulties:
+            writer.writerow([section.title, 'difficulty', name] + t.to_list())
+        for d, t in section.levels or ():
+            writer.writerow([section.title, 'd', d] + t.to_list())
+        writer.writerow([section.title, 'all', ''] + section.totals.to_list())
+    blank = [''] * (len(Totals.FIELDS) - 2)
+    for tiertotal, earned, total in report.tiers:
+        writer.writerow(['Tier Point Stats', 'tier', tiertotal] + blank + [earned, total])
+    writer.writerow(['Tier Point Stats', 'extra', ''] + blank + [report.extra_tierpoints, report.max_extra_tierpoints])
+    writer.writerow(['Tier Point Stats', 'all', ''] + blank + [report.earned_tierpoints, report.total_tierpoints])
+    return out.getvalue()
+
+def render_html(report):
+    """A standalone page with the same contents as the post"""
+    def colored(color, text):
+        return '<span style="color:#%s">%s</span>' % (color, html.escape(str(text)))
+
+    def totals_cells(t):
+        return ''.join('<td>%s</td>' % cell for cell in (
+            '%d/%d' % (t.aaa, t.total), '%d/%d' % (t.sdg, t.total), '%d/%d' % (t.fc, t.total),
+            '%d/%d' % (t.passed, t.total), '%d/%d' % (t.tpearned, t.tptotal)))
+
+    header = '<tr><th></th><th>%s</th><th>%s</th><th>%s</th><th>%s</th><th>%s</th></tr>' % (
+        colored(HEX_AAA, 'AAAs'), colored(HEX_SDG, 'SDGs'), colored(HEX_FC, 'FCs'),
+        colored(HEX_PASS, 'Passed'), colored(HEX_TP, 'TPs'))
+
+    out = ['<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>Stats</title>\n'
+        '<style>body { font-family: sans-serif; } td, th { padding: 2px 8px; text-align: right; }</style>\n'
+        '</head>\n<body>\n']
+    changes = report.changes
+    if changes:
+        out.append('<h2>Changes Since %s</h2>\n<ul>\n' % time.strftime('%b %d, %Y', time.localtime(changes.since)))
+        for label, color, levels in (('New AAAs', HEX_AAA, changes.aaas), ('New SDGs', HEX_SDG, changes.sdgs),
+                ('New FCs', HEX_FC, changes.fcs)):
+            if levels:
+                out.append('<li>%s: %s</li>\n' % (colored(color, label), html.escape(', '.join(levels))))
+        if changes.tp_gains:
+            out.append('<li>%s: +%d (%s)</li>\n' % (colored(HEX_TP, 'TPs'), sum(gain for _, gain in changes.tp_gains),
+                html.escape(', '.join('%s +%d' % tp_gain for tp_gain in changes.tp_gains))))
+        out.append('</ul>\n')
+
+    for section in report.sections:
+        out.append('<h2>%s</h2>\n<table>\n%s\n' % (html.escape(section.title), header))
+        for name, t in section.difficulties:
+            out.append('<tr><th>%s</th>%s</tr>\n' % (colored(HEX_D, name), totals_cells(t)))
+        for d, t in section.levels or ():
+            out.append('<tr><th>%s</th>%s</tr>\n' % (colored(HEX_D, d), totals_cells(t)))
+        out.append('<tr><th>Total</th>%s</tr>\n</table>\n' % totals_cells(section.totals))
+
+    out.append('<h2>Tier Point Stats</h2>\n<table>\n')
+    for tiertotal, earned, total in report.tiers:
+        out.append('<tr><th>%s</th><td>%d/%d</td></tr>\n' % (colored(HEX_D, '/%d' % tiertotal), earned, total))
+    out.append('<tr><th>%s</th><td>%d/%d</td></tr>\n' % (colored(HEX_D, '+'), report.extra_tierpoints,
+        report.max_extra_tierpoints))
+    out.append('<tr><th>%s</th><td>%d/%d %.1f%%</td></tr>\n</table>\n</body>\n</html>\n' % (colored(HEX_TP, 'TPs'),
+        report.earned_tierpoints, report.total_tierpoints, percent(report.earned_tierpoints, report.total_tierpoints)))
+    return ''.join(out)
+
+# file extension -> renderer
+RENDERERS = OrderedDict([
+    ('txt', render_bbcode),
+    ('json', render_json),
+    ('csv', render_csv),
+    ('html', render_html),
+])
+
+def write_reports(report, basename, formats=REPORT_FORMATS):
+    """Renders the report and writes '<basename>.<format>' for each format; returns the BBCode body"""
+    body = render_bbcode(report)
+    for ext in formats:
+        content = body if ext == 'txt' else RENDERERS[ext](report)
+        with open('%s.%s' % (basename, ext), 'w') as f:
+            f.write(content)
+    return body
+
+def snapshot_aggregates(store, username, page, levelranks):
+    """
+    Records the levelranks in the snapshot store and returns (aggregates,
+    changes, previous snapshot). When a previous snapshot exists, its stored
+    totals are updated with only the changed levels instead of being rebuilt.
+    """
+    previous = store.latest(username, page)
+    rows, changes = snapshots.diff(previous.rows if previous else {}, levelranks)
+
+    if previous and previous.aggregates and set(previous.aggregates['groups']) == set(Aggregates.GROUPINGS):
+        aggregates = Aggregates.from_dict(previous.aggregates)
+        aggregates.apply_changes(changes)
+    else:
+        aggregates = Aggregates(rows.values())
+
+    store.save(username, page, rows.values(), aggregates.to_dict())
+    return aggregates, changes, previous
+
+class BatchFetcher:
+    """Fetches and parses levelrank pages concurrently over one logged-in session"""
+    def __init__(self, session, max_concurrency=BATCH_MAX_CONCURRENCY, retries=BATCH_RETRIES, backoff=BATCH_BACKOFF):
+        self.session = session
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+
+    def submit(self, url):
+        """Returns a future for (aggregates, bytes, fetch seconds, parse seconds)"""
+        return self.executor.submit(self.fetch_aggregates, url)
+
+    def fetch(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.session.get_content(url, login_required=True)
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                # exponential backoff with jitter so retries from many workers spread out
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+                print('[+] GET %s failed (%s), retrying in %.1fs' % (url, e, delay))
+                time.sleep(delay)
+
+    def fetch_aggregates(self, url):
+        start = time.perf_counter()
+        with profiling.phase('fetch'):
+            content = self.fetch(url)
+        fetched = time.perf_counter()
+        with profiling.phase('parse and aggregate'):
+            aggregates = Aggregates(stream_levelranks([content]))
+            profiling.add(rows=aggregates.totals.total)
+        return aggregates, len(content), fetched - start, time.perf_counter() - fetched
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def run_batch(session, usernames):
+    """
+    Fetches the public and token levelranks of every user concurrently and
+    writes each user's report as soon as both of their pages are parsed.
+    """
+    fetcher = BatchFetcher(session)
+    timestamp = time.strftime('%Y-%m-%d-%H-%M-%S')
+    start = time.perf_counter()
+
+    futures = {}
+    for username in usernames:
+        sub = urllib.parse.quote(username)
+        futures[fetcher.submit(ffrsession.URL_LEVELRANK % sub)] = (username, 'public')
+        futures[fetcher.submit(ffrsession.URL_SPECIAL_LEVELRANK % sub)] = (username, 'token')
+
+    pages = {username: {} for username in usernames}
+    failed = set()
+    total_bytes = 0
+    total_parse_time = 0
+
+    for future in as_completed(futures):
+        username, kind = futures[future]
+        if username in failed:
+            continue
+        try:
+            pages[username][kind] = future.result()
+        except (requests.RequestException, ffrsession.LoginError, KeyError, ValueError) as e:
+            print('[+] Skipping %s: %s' % (username, e))
+            failed.add(username)
+            continue
 
-        earned_tierpoints = sum(l.tp for l in all_levelranks) + extra_tierpoints
-        total_tierpoints = sum(l.tpmax for l in all_levelranks) + max_extra_tierpoints
-        
-        f.write('\n\n[color=#%s]TPs[/color]: %d/%d %.1f%%' % (HEX_TP, earned_tierpoints, total_tierpoints, 100 * earned_tierpoints / total_tierpoints))
+        if len(pages[username]) < 2:
+            continue
 
+        public, token = pages[username]['public'], pages[username]['token']
+        basename = 'stats-%s-%s' % (timestamp, username)
+        write_reports(Report(public[0], token[0]), basename)
+
+        user_bytes = public[1] + token[1]
+        parse_time = public[3] + token[3]
+        total_bytes += user_bytes
+        total_parse_time += parse_time
+        print('[+] %s: %d bytes, fetch %.2fs, parse %.2fs -> %s' %
+            (username, user_bytes, max(public[2], token[2]), parse_time, basename))
+
+    fetcher.shutdown()
+    report_missing_levels()
+
+    elapsed = time.perf_counter() - start
+    done = len(usernames) - len(failed)
+    print('[+] Batch complete: %d/%d users in %.2fs (%.1f users/min)' %
+        (done, len(usernames), elapsed, 60 * done / elapsed if elapsed else 0))
+    print('[+] %d bytes fetched (%.1f KB/s), %.2fs spent parsing' %
+        (total_bytes, total_bytes / 1024 / elapsed if elapsed else 0, total_parse_time))
+
+def report_missing_levels():
+    missing = songdata.catalog().missing
+    if missing:
+        print('[+] %d level(s) not in levelarrows.json were counted as fully judged: %s' %
+            (len(missing), ', '.join(sorted(missing))))
+        print('[+] Run levelarrows.py to update it')
+
+def extra_tierpoints(totals):
+    """The bonus tier points for AAAing more than 49% of all levels"""
+    if totals.total == 0:
+        return 0
+    return max(int(100 * totals.aaa / totals.total) - 49, 0)
 
 def get_difficulty_index(d):
     for i in range(len(DIFFICULTIES)):
@@ -278,35 +740,86 @@ def get_difficulty_index(d):
             return i
 
 def main():
+    profiling.parse_args(sys.argv)
     credentials = json.loads(open('credentials.json', 'r').read())
 
+    # logs in only if the saved cookies are no longer accepted
+    session = ffrsession.FFRSession(credentials, pool_size=BATCH_MAX_CONCURRENCY)
+
+    # batch mode: write reports for several users without posting them
+    if len(sys.argv) > 2 and sys.argv[1] == '--batch':
+        run_batch(session, sys.argv[2:])
+        profiling.finish()
+        return
+
     # get the username that the stats will be retrieved for
     stats_username = credentials['username']
-    if len(sys.argv) == 2:
+    if len(sys.argv) == 2 and sys.argv[1] != '--batch':
         stats_username = sys.argv[1]
     elif len(sys.argv) != 1:
-        print('Invalid argument format. Please call this script with the following format:')
+        print('Invalid argument format. Please call this script with one of the following formats:')
         print('\tpython3 stats.py <OPTIONAL:stats_username>')
+        print('\tpython3 stats.py --batch <stats_username> [<stats_username> ...]')
+        print('Add --profile[=FILE] [--profile-phase=NAME] to any of them to write a phase trace.')
         sys.exit()
 
-    br = Browser()
-    br.login(credentials)
-
-    output_filename = time.strftime('stats-%Y-%m-%d-%H-%M-%S.txt')
-    print('[+] Writing stats to ' + output_filename)
-
-    url_levelrank = URL_BASE + '/levelrank.php?sub=' + stats_username
-    levelranks = extract_levelranks(br.get(url_levelrank))
-    format_levelranks(levelranks, output_filename, 'Public Level Stats', True)
-
-    url_tokenlevelrank = URL_BASE + '/levelrank_special.php?sub=' + stats_username
-    token_levelranks = extract_levelranks(br.get(url_tokenlevelrank))
-    format_levelranks(token_levelranks, output_filename, 'Token Level Stats', False)
-
-    all_levelranks = levelranks + token_levelranks
-    format_tierpoints(all_levelranks, output_filename)
-
-    br.post_stats(open(output_filename, 'r').read())
+    basename = time.strftime('stats-%Y-%m-%d-%H-%M-%S')
+    print('[+] Writing stats to %s.{%s}' % (basename, ','.join(REPORT_FORMATS)))
+
+    timeline = Timeline()
+    executor = ThreadPoolExecutor(max_workers=3)
+
+    def fetch(page):
+        # each page is parsed as it streams in, while the other one is still downloading
+        with timeline.stage(page + ' levelranks'):
+            return get_levelranks(session, stats_username, special=page == 'token')
+
+    def load_post_form():
+        with timeline.stage('load post form'):
+            return session.get_form(URL_POST)
+
+    # both pages are requested at once; whichever finds the session logged out logs in for both
+    futures = {executor.submit(fetch, page): page for page in ('public', 'token')}
+    # the post form is preloaded only once a page has changed since its last snapshot, since an
+    # unchanged report is not posted; the session is logged in by then
+    form_future = None
+    store = snapshots.SnapshotStore(SNAPSHOT_DB) if SNAPSHOT_DB else None
+    results = {}
+    try:
+        for future in as_completed(futures):
+            page = futures[future]
+            levelranks = future.result()
+            with timeline.stage(page + ' aggregates'):
+                if store is not None:
+                    results[page] = snapshot_aggregates(store, stats_username, page, levelranks)
+                else:
+                    results[page] = (Aggregates(levelranks), [], None)
+            _, changes, previous = results[page]
+            if form_future is None and (changes or previous is None):
+                form_future = executor.submit(load_post_form)
+    except ffrsession.LoginError as e:
+        print('[+] %s. Please update credentials.json' % e)
+        sys.exit()
+    finally:
+        if store is not None:
+            store.close()
+
+    report_missing_levels()
+    with timeline.stage('render report'):
+        aggregates, changes, previous = results['public']
+        token_aggregates, token_changes, _ = results['token']
+        report = Report(aggregates, token_aggregates, changes + token_changes,
+            previous.taken_at if previous else None)
+        body = write_reports(report, basename)
+
+    with timeline.stage('post'):
+        posted = post_stats_if_changed(session, body, form_future.result if form_future else None)
+    if not posted and form_future is not None:
+        form_future.cancel()
+    executor.shutdown()
+
+    timeline.report()
+    profiling.finish()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,365 @@
+"""
+Long-running stats.py: keeps one logged-in session and the song metadata in
+memory, refreshes a set of watched users on a schedule, and answers queries
+for their totals and reports from memory over a local HTTP endpoint.
+
+Each watched user is refreshed every INTERVAL seconds, give or take JITTER
+(a fraction of the interval) so several users and several daemons do not
+hit the site in lockstep. A refresh that fails is retried sooner, with
+exponential backoff. Results are kept in an LRU cache of at most MAX_USERS
+entries; entries older than TTL seconds are dropped, so nothing staler than
+that is ever served. A query for a user that is not cached gets a 404 and
+queues a one-off refresh; queries never wait on the site.
+
+    python3 statsdaemon.py [--users NAME,...] [--interval MIN] [--ttl MIN] [--port P | --socket PATH] [--post]
+
+Endpoints:
+    /status                 refresh counts, cache hits and the schedule
+    /users                  cached users and the age of their data
+    /totals/NAME            JSON totals and tier points
+    /report/NAME.FORMAT     the rendered report (txt, json, csv or html)
+
+Assumes credentials.json exists, as for stats.py.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import ffrsession
+import heapq
+import json
+import os
+import random
+import requests
+import signal
+import snapshots
+import socketserver
+import songdata
+import stats
+import threading
+import time
+import urllib.parse
+
+# config
+INTERVAL = 15 * 60
+JITTER = 0.1
+TTL = 60 * 60
+MAX_USERS = 32
+PORT = 8642
+# first retry after a failed refresh; doubled after every further failure, up to INTERVAL
+RETRY_DELAY = 60
+# snapshot runs kept per user and page; a refresh only diffs against the latest one, and the
+# daemon saves a run every INTERVAL, far more often than stats.py
+SNAPSHOT_RUNS = 8
+
+CONTENT_TYPES = {
+    'txt': 'text/plain; charset=utf-8',
+    'json': 'application/json',
+    'csv': 'text/csv; charset=utf-8',
+    'html': 'text/html; charset=utf-8',
+}
+
+class UserStats:
+    """The results of one refresh of a user, with each report format rendered on first use"""
+    def __init__(self, username, aggregates, token_aggregates, report):
+        self.username = username
+        self.fetched_at = time.time()
+        self.aggregates = aggregates
+        self.token_aggregates = token_aggregates
+        self.report = report
+        self.rendered = {}
+
+    def render(self, ext):
+        if ext not in self.rendered:
+            self.rendered[ext] = stats.RENDERERS[ext](self.report)
+        return self.rendered[ext]
+
+    def totals(self):
+        report = self.report
+        all_totals = stats.Aggregates().merge(self.aggregates).merge(self.token_aggregates).totals
+        return OrderedDict([
+            ('username', self.username),
+            ('fetched_at', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.fetched_at))),
+            ('public', self.aggregates.totals.to_dict()),
+            ('token', self.token_aggregates.totals.to_dict()),
+            ('all', all_totals.to_dict()),
+            ('tierpoints', OrderedDict([
+                ('earned', report.earned_tierpoints),
+                ('total', report.total_tierpoints),
+                ('extra', report.extra_tierpoints),
+            ])),
+        ])
+
+class Cache:
+    """Least recently used cache whose entries also expire 'ttl' seconds after they were stored"""
+    def __init__(self, max_entries=MAX_USERS, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (stored at, value), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def values(self):
+        with self.lock:
+            now = time.monotonic()
+            return [value for stored_at, value in self.entries.values() if now - stored_at <= self.ttl]
+
+class Refresher:
+    """Refreshes users in a background thread, each at its own jittered time"""
+    def __init__(self, session, cache, users, interval=INTERVAL, jitter=JITTER, post_username=None):
+        self.session = session
+        self.cache = cache
+        self.watched = set(users)
+        self.interval = interval
+        self.jitter = jitter
+        # the user whose report is posted to the random thought after each refresh, if any
+        self.post_username = post_username
+        # (due, username) on the monotonic clock
+        self.schedule = []
+        self.failures = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.refreshes = 0
+        self.errors = 0
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        for username in users:
+            self.request(username)
+
+    def request(self, username, delay=0):
+        """Schedules a refresh of 'username' after 'delay' seconds, unless one is due sooner"""
+        with self.condition:
+            due = time.monotonic() + delay
+            for scheduled_due, scheduled in self.schedule:
+                if scheduled == username and scheduled_due <= due:
+                    return
+            self.schedule = [item for item in self.schedule if item[1] != username]
+            heapq.heapify(self.schedule)
+            heapq.heappush(self.schedule, (due, username))
+            self.condition.notify()
+
+    def next_delay(self):
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        self.executor.shutdown()
+
+    def run(self):
+        # the SQLite connection has to stay on this thread
+        store = snapshots.SnapshotStore(stats.SNAPSHOT_DB, SNAPSHOT_RUNS) if stats.SNAPSHOT_DB else None
+        try:
+            while True:
+                with self.condition:
+                    while not self.stopped and (not self.schedule or self.schedule[0][0] > time.monotonic()):
+                        self.condition.wait(self.schedule[0][0] - time.monotonic() if self.schedule else None)
+                    if self.stopped:
+                        return
+                    _, username = heapq.heappop(self.schedule)
+                self.refresh(username, store)
+        finally:
+            if store is not None:
+                store.close()
+
+    def refresh(self, username, store):
+        start = time.perf_counter()
+        try:
+            user_stats = self.fetch(username, store)
+        except Exception as e:
+            # whatever goes wrong with one user, this thread has to keep refreshing the others
+            self.errors += 1
+            failures = self.failures[username] = self.failures.get(username, 0) + 1
+            delay = min(RETRY_DELAY * 2 ** (failures - 1), self.interval)
+            expected = isinstance(e, (requests.RequestException, ffrsession.LoginError))
+            print('[+] Refreshing %s failed (%s); retrying in %ds' % (username, e if expected else repr(e), delay))
+            if username in self.watched or failures == 1:
+                self.request(username, delay)
+            return
+
+        self.cache.put(username, user_stats)
+        self.failures.pop(username, None)
+        self.refreshes += 1
+        print('[+] Refreshed %s in %.2fs' % (username, time.perf_counter() - start))
+
+        if username == self.post_username:
+            try:
+                stats.post_stats_if_changed(self.session, user_stats.render('txt'))
+            except Exception as e:
+                print('[+] Posting stats failed: %s' % e)
+        if username in self.watched:
+            self.request(username, self.next_delay())
+
+    def fetch(self, username, store):
+        """Fetches both levelrank pages and returns the user's UserStats"""
+        pages = {page: self.executor.submit(stats.get_levelranks, self.session, username, page == 'token')
+            for page in ('public', 'token')}
+        results = {}
+        for page, future in pages.items():
+            levelranks = future.result()
+            if store is not None:
+                results[page] = stats.snapshot_aggregates(store, username, page, levelranks)
+            else:
+                results[page] = (stats.Aggregates(levelranks), [], None)
+
+        aggregates, changes, previous = results['public']
+        token_aggregates, token_changes, _ = results['token']
+        report = stats.Report(aggregates, token_aggregates, changes + token_changes,
+            previous.taken_at if previous else None)
+        return UserStats(username, aggregates, token_aggregates, report)
+
+    def status(self):
+        now = time.monotonic()
+        with self.condition:
+            schedule = sorted(self.schedule)
+        return OrderedDict([
+            ('watched', sorted(self.watched)),
+            ('alive', self.thread.is_alive()),
+            ('refreshes', self.refreshes),
+            ('errors', self.errors),
+            ('scheduled', [OrderedDict([('username', username), ('in_seconds', round(due - now, 1))])
+                for due, username in schedule]),
+        ])
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type='application/json'):
+        if not isinstance(body, str):
+            body = json.dumps(body, indent=4) + '\n'
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def user_stats(self, username):
+        """The cached stats for 'username', or None after answering with a 404"""
+        user_stats = self.server.cache.get(username)
+        if user_stats is None:
+            self.server.refresher.request(username)
+            self.send(404, {'error': 'no current stats for %s; a refresh has been queued' % username})
+        return user_stats
+
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = path.strip('/').split('/', 1)
+
+        if parts == ['status']:
+            status = self.server.refresher.status()
+            status['uptime'] = round(time.monotonic() - self.server.started, 1)
+            status['cache'] = OrderedDict([('users', len(self.server.cache.values())),
+                ('hits', self.server.cache.hits), ('misses', self.server.cache.misses)])
+            return self.send(200, status)
+        if parts == ['users']:
+            now = time.time()
+            return self.send(200, [OrderedDict([('username', user_stats.username),
+                ('age_seconds', round(now - user_stats.fetched_at, 1))]) for user_stats in self.server.cache.values()])
+        if len(parts) == 2 and parts[0] == 'totals' and parts[1]:
+            user_stats = self.user_stats(parts[1])
+            if user_stats is not None:
+                self.send(200, user_stats.totals())
+            return
+        if len(parts) == 2 and parts[0] == 'report':
+            username, _, ext = parts[1].rpartition('.')
+            if username and ext in stats.RENDERERS:
+                user_stats = self.user_stats(username)
+                if user_stats is not None:
+                    self.send(200, user_stats.render(ext), CONTENT_TYPES[ext])
+                return
+        self.send(404, {'error': 'unknown path %s' % path})
+
+class HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve FFR stats from memory, refreshing them on a schedule.')
+    parser.add_argument('--users', help='comma separated users to keep refreshed (default: the credentials user)')
+    parser.add_argument('--interval', type=float, default=INTERVAL / 60, help='minutes between refreshes (default: %(default)g)')
+    parser.add_argument('--jitter', type=float, default=JITTER, help='random spread of the interval (default: %(default)g)')
+    parser.add_argument('--ttl', type=float, default=TTL / 60, help='minutes before cached stats expire (default: %(default)g)')
+    parser.add_argument('--max-users', type=int, default=MAX_USERS, help='cached users (default: %(default)d)')
+    parser.add_argument('--port', type=int, default=PORT, help='local HTTP port (default: %(default)d)')
+    parser.add_argument('--socket', help='serve on this Unix socket instead of a port')
+    parser.add_argument('--post', action='store_true',
+        help="post the credentials user's report to the random thought when it changes")
+    args = parser.parse_args()
+
+    credentials = json.loads(open('credentials.json', 'r').read())
+    users = args.users.split(',') if args.users else [credentials['username']]
+
+    # load the song metadata now rather than on the first refresh
+    songdata.catalog()
+
+    session = ffrsession.FFRSession(credentials)
+    cache = Cache(args.max_users, args.ttl * 60)
+    refresher = Refresher(session, cache, users, args.interval * 60, args.jitter,
+        credentials['username'] if args.post else None)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        address = args.socket
+    else:
+        server = HTTPServer(('127.0.0.1', args.port), Handler)
+        address = 'http://127.0.0.1:%d' % args.port
+    server.cache = cache
+    server.refresher = refresher
+    server.started = time.monotonic()
+
+    # shut down cleanly on SIGTERM as well as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    refresher.start()
+    print('[+] Watching %s; serving on %s' % (', '.join(users), address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        refresher.stop()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+        print('[+] Stopped')
+
+if __name__ == "__main__":
+    main()
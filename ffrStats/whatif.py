@@ -0,0 +1,268 @@
+"""
+What-if calculator: how would the totals change if some scores were raised?
+
+The public and token levelranks are loaded once into Fenwick trees indexed
+by difficulty (d), one per Totals field. Rows are keyed by (page, level), so
+a level on both pages counts twice, as it does in stats.py. A hypothetical score swaps one
+level's classified row, which is O(log D) per tree, and the totals for any
+d, any DIFFICULTIES band, and the grand totals (with the AAA-percentage
+tier point bonus) are range sums of the same trees, also O(log D).
+
+Hypotheticals are journaled: WhatIf.mark() returns a point that
+rollback() can return to, and hypothetical() does both around a block, so
+batches can be tried and undone without rebuilding anything.
+
+    python3 whatif.py [<username>] [--offline]
+
+starts an interactive prompt; type 'help' for the commands. A level that is
+on both levelrank pages is picked with a 'public:' or 'token:' prefix.
+"""
+
+import argparse
+import cmd
+import contextlib
+import json
+import os
+import planner
+import snapshots
+import songdata
+import stats
+
+class FenwickTree:
+    """Prefix sums over positions 0..size-1 with O(log n) point updates and queries"""
+    def __init__(self, size):
+        self.tree = [0] * (size + 1)
+
+    def add(self, i, delta):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        """Sum of positions 0..i-1"""
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def range(self, lo, hi):
+        """Sum of positions lo..hi-1"""
+        return self.prefix(hi) - self.prefix(lo)
+
+class TotalsTree:
+    """A Fenwick tree per Totals field, indexed by d"""
+    def __init__(self, max_d):
+        self.size = max_d + 1
+        self.trees = [FenwickTree(self.size) for _ in stats.Totals.FIELDS]
+
+    def add(self, row, count=1):
+        values = (1, row.is_aaa, row.is_sdg, row.fc, row.is_passed, row.tp, row.tpmax)
+        for tree, value in zip(self.trees, values):
+            if value:
+                tree.add(row.d, value * count)
+
+    def totals(self, lo=0, hi=None):
+        """Returns the Totals of every level with lo <= d < hi"""
+        hi = self.size if hi is None else min(hi, self.size)
+        lo = min(max(lo, 0), hi)
+        return stats.Totals.from_list([tree.range(lo, hi) for tree in self.trees])
+
+class WhatIf:
+    def __init__(self, levelranks, token_levelranks=()):
+        """The public and token levelranks are Levelrank objects or snapshots.Row"""
+        # (page, level) -> Row
+        self.rows = {}
+        for page, page_levelranks in (('public', levelranks), ('token', token_levelranks)):
+            for row in snapshots.unique_levels(levelrank if isinstance(levelrank, snapshots.Row)
+                    else snapshots.Row.from_levelrank(levelrank) for levelrank in page_levelranks):
+                self.rows[page, row.level] = row
+        self.tree = TotalsTree(max((row.d for row in self.rows.values()), default=0))
+        for row in self.rows.values():
+            self.tree.add(row)
+        # ((page, level), previous row) for every hypothetical, oldest first
+        self.journal = []
+
+    def replace(self, key, row):
+        old = self.rows[key]
+        self.tree.add(old, -1)
+        self.tree.add(row)
+        self.rows[key] = row
+        self.journal.append((key, old))
+        return old
+
+    def set_score(self, key, score, passed=True, fc=None):
+        """
+        Pretends the level at 'key' ((page, level)) was played for 'score'.
+        The max score is an AAA; 'fc' defaults to the AAA or the FC already
+        held. Returns the old row.
+        """
+        old = self.rows[key]
+        aaa = score >= stats.PERFECT_SCORE * old.arrows
+        if fc is None:
+            fc = aaa or old.fc
+        tp = 0
+        song = songdata.catalog().get(old.level)
+        tier_table = song.tier_table if song is not None else None
+        if tier_table is not None:
+            tp = tier_table.tierpoints(score, passed)
+        return self.replace(key, old._replace(score=score, fc=fc, tp=tp, is_aaa=aaa,
+            is_sdg=passed and score >= planner.sdg_score(old.arrows), is_passed=passed))
+
+    def mark(self):
+        """A point in the journal that rollback() can return to"""
+        return len(self.journal)
+
+    def rollback(self, mark=0):
+        """Undoes every hypothetical made since 'mark' (all of them by default)"""
+        while len(self.journal) > mark:
+            key, old = self.journal.pop()
+            self.tree.add(self.rows[key], -1)
+            self.tree.add(old)
+            self.rows[key] = old
+
+    @contextlib.contextmanager
+    def hypothetical(self):
+        """Rolls back whatever the block changes"""
+        mark = self.mark()
+        try:
+            yield self
+        finally:
+            self.rollback(mark)
+
+    def totals(self):
+        return self.tree.totals()
+
+    def level_totals(self, d):
+        return self.tree.totals(d, d + 1)
+
+    def difficulty_totals(self):
+        """Returns [(difficulty name, Totals)], hardest first, like stats.DIFFICULTIES"""
+        bands = []
+        hi = None
+        for name, lo in stats.DIFFICULTIES:
+            bands.append((name, self.tree.totals(lo, hi)))
+            hi = lo
+        return bands
+
+    def tierpoints(self):
+        """Returns (earned, total) tier points including the AAA-percentage bonus"""
+        totals = self.totals()
+        return (totals.tpearned + stats.extra_tierpoints(totals),
+            totals.tptotal + stats.MAX_EXTRA_TIERPOINTS)
+
+def format_totals(totals):
+    return 'AAAs %d/%d, SDGs %d/%d, FCs %d/%d, TPs %d/%d' % (totals.aaa, totals.total, totals.sdg, totals.total,
+        totals.fc, totals.total, totals.tpearned, totals.tptotal)
+
+def format_change(label, old, new):
+    return '%s %d -> %d (%+d)' % (label, old, new, new - old)
+
+class WhatIfShell(cmd.Cmd):
+    intro = "Enter hypothetical scores; type 'help' for the commands."
+    prompt = 'what-if> '
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self.baseline = engine.totals()
+        self.baseline_tierpoints = engine.tierpoints()
+
+    def find_level(self, name):
+        """Returns the (page, level) key for a level name, optionally prefixed with 'public:' or 'token:'"""
+        page, sep, rest = name.partition(':')
+        if sep and page in ('public', 'token'):
+            name = rest.strip()
+        else:
+            page = None
+        keys = [key for key in self.engine.rows if page in (None, key[0])]
+        matches = [key for key in keys if key[1] == name] or [key for key in keys if key[1].lower() == name.lower()]
+        if not matches:
+            print('[+] Unknown level: ' + name)
+            return None
+        if len(set(page for page, _ in matches)) > 1:
+            print('[+] %s is on both levelrank pages; prefix it with public: or token:' % name)
+            return None
+        return matches[0]
+
+    def do_score(self, arg):
+        """score SCORE LEVEL: pretend LEVEL was passed with SCORE"""
+        score, _, name = arg.partition(' ')
+        level = self.find_level(name.strip())
+        if level is None:
+            return
+        try:
+            self.engine.set_score(level, int(score.replace(',', '')))
+        except ValueError:
+            print('[+] Not a score: ' + score)
+            return
+        self.do_totals('')
+
+    def do_aaa(self, arg):
+        """aaa LEVEL: pretend LEVEL was AAA'd"""
+        level = self.find_level(arg.strip())
+        if level is not None:
+            self.engine.set_score(level, stats.PERFECT_SCORE * self.engine.rows[level].arrows)
+            self.do_totals('')
+
+    def do_undo(self, arg):
+        """undo: take back the last hypothetical"""
+        self.engine.rollback(max(self.engine.mark() - 1, 0))
+        self.do_totals('')
+
+    def do_reset(self, arg):
+        """reset: take back every hypothetical"""
+        self.engine.rollback()
+        self.do_totals('')
+
+    def do_totals(self, arg):
+        """totals: grand totals and tier points, compared with the loaded levelranks"""
+        totals = self.engine.totals()
+        earned, total = self.engine.tierpoints()
+        print('[+] %d hypothetical(s)' % self.engine.mark())
+        for label, field in (('AAAs', 'aaa'), ('SDGs', 'sdg'), ('FCs', 'fc'), ('Passed', 'passed')):
+            print('[+]   ' + format_change(label, getattr(self.baseline, field), getattr(totals, field)))
+        print('[+]   ' + format_change('TPs', self.baseline_tierpoints[0], earned) + ' of %d' % total)
+        print('[+]   ' + format_change('AAA bonus', stats.extra_tierpoints(self.baseline), stats.extra_tierpoints(totals)))
+
+    def do_bands(self, arg):
+        """bands: per-difficulty totals"""
+        for name, totals in reversed(self.engine.difficulty_totals()):
+            if totals.total:
+                print('[+]   %-16s %s' % (name, format_totals(totals)))
+
+    def do_level(self, arg):
+        """level D: totals for difficulty D"""
+        try:
+            totals = self.engine.level_totals(int(arg))
+        except ValueError:
+            print('[+] Not a difficulty: ' + arg)
+            return
+        print('[+]   %s: %s' % (arg, format_totals(totals)))
+
+    def do_quit(self, arg):
+        """quit: leave the prompt"""
+        return True
+
+    do_EOF = do_quit
+
+def main():
+    parser = argparse.ArgumentParser(description='Try hypothetical FFR scores and see how the totals change.')
+    parser.add_argument('username', nargs='?',
+        help='user to load (default: the user in credentials.json)')
+    parser.add_argument('--offline', action='store_true',
+        help='use the latest snapshots stored by stats.py instead of fetching the levelranks')
+    args = parser.parse_args()
+
+    username = args.username
+    if username is None:
+        if not os.path.exists('credentials.json'):
+            parser.error('no username given and no credentials.json')
+        username = json.loads(open('credentials.json', 'r').read())['username']
+
+    WhatIfShell(WhatIf(planner.load_levelranks(username, args.offline),
+        planner.load_levelranks(username, args.offline, special=True))).cmdloop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Bounded-memory live chat statistics per channel.
+
+Analytics is a chatclient consumer that keeps, for every channel:
+
+	- message rates over 1, 5 and 15 minutes, from a ring of per-second counts
+	- distinct chatters over the same windows, from a ring of HyperLogLog
+	  sketches, one per SLOT seconds, that are merged on demand
+	- the top-K chatters, tokens and emotes, from Count-Min Sketches with a
+	  small heap of heavy hitter candidates; counts are halved every
+	  'decay_interval' seconds so the lists follow recent activity
+
+Memory per channel is fixed by the sketch parameters, so it can run for
+days. snapshot() builds a plain dict of the current numbers; run() refreshes
+'latest' periodically so readers never touch the sketches.
+"""
+
+import array
+import asyncio
+import heapq
+import math
+import random
+import time
+
+WINDOWS = (60, 300, 900)
+TOP_K = 10
+# seconds covered by each distinct chatter sketch; windows are accurate to within one slot
+SLOT = 10
+
+# sketch parameters
+HLL_PRECISION = 10
+CMS_WIDTH = 1024
+CMS_DEPTH = 4
+DECAY_INTERVAL = 3600
+
+MASK64 = (1 << 64) - 1
+# Mersenne prime for the count-min row hashes
+PRIME = (1 << 61) - 1
+
+def hash64(item):
+	# str hashes are SipHash, randomized per process, which is fine for in-memory sketches
+	return hash(item) & MASK64
+
+class HyperLogLog:
+	"""Distinct count estimate in 2^precision bytes"""
+	def __init__(self, precision=HLL_PRECISION):
+		self.precision = precision
+		self.registers = bytearray(1 << precision)
+
+	def add(self, item):
+		h = hash64(item)
+		bits = 64 - self.precision
+		index = h >> bits
+		rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	def merge(self, other):
+		self.registers = bytearray(map(max, self.registers, other.registers))
+		return self
+
+	def clear(self):
+		self.registers = bytearray(len(self.registers))
+
+	def count(self):
+		m = len(self.registers)
+		alpha = 0.7213 / (1 + 1.079 / m)
+		estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+		zeros = self.registers.count(0)
+		if estimate <= 2.5 * m and zeros:
+			# linear counting is more accurate for small cardinalities
+			return m * math.log(m / zeros)
+		return estimate
+
+	def memory(self):
+		return len(self.registers)
+
+class CountMinSketch:
+	"""Approximate counts that never underestimate, in width * depth counters"""
+	def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH):
+		self.width = width
+		self.rows = [array.array('q', bytes(8 * width)) for _ in range(depth)]
+		# a pairwise independent hash per row; deriving every row from the same pair of hashes makes two
+		# items that collide in one row collide in all of them
+		rng = random.Random(depth)
+		self.hashes = [(rng.randrange(1, PRIME), rng.randrange(PRIME)) for _ in range(depth)]
+
+	def columns(self, item):
+		h = hash64(item)
+		return [(a * h + b) % PRIME % self.width for a, b in self.hashes]
+
+	def add(self, item, count=1):
+		"""Adds 'count' occurrences of item and returns its new estimate"""
+		estimate = None
+		for row, j in zip(self.rows, self.columns(item)):
+			row[j] += count
+			if estimate is None or row[j] < estimate:
+				estimate = row[j]
+		return estimate
+
+	def estimate(self, item):
+		return min(row[j] for row, j in zip(self.rows, self.columns(item)))
+
+	def halve(self):
+		for row in self.rows:
+			for j in range(len(row)):
+				row[j] >>= 1
+
+	def memory(self):
+		return sum(row.itemsize * len(row) for row in self.rows)
+
+class HeavyHitters:
+	"""Top-K items by Count-Min estimate, tracked with a min-heap of candidates"""
+	def __init__(self, k=TOP_K, width=CMS_WIDTH, depth=CMS_DEPTH):
+		self.k = k
+		self.sketch = CountMinSketch(width, depth)
+		# item -> estimate for the current candidates
+		self.candidates = {}
+		# (estimate, item) entries; stale ones are skipped when popped
+		self.heap = []
+
+	def add(self, item):
+		estimate = self.sketch.add(item)
+		candidates = self.candidates
+		if item in candidates:
+			candidates[item] = estimate
+			heapq.heappush(self.heap, (estimate, item))
+		elif len(candidates) < self.k:
+			candidates[item] = estimate
+			heapq.heappush(self.heap, (estimate, item))
+		elif estimate > self._minimum():
+			_, evicted = heapq.heappop(self.heap)
+			del candidates[evicted]
+			candidates[item] = estimate
+			heapq.heappush(self.heap, (estimate, item))
+
+		if len(self.heap) > 4 * self.k:
+			self.heap = [(estimate, item) for item, estimate in candidates.items()]
+			heapq.heapify(self.heap)
+
+	def _minimum(self):
+		"""Drops stale heap entries and returns the smallest current candidate estimate"""
+		heap = self.heap
+		while heap[0][1] not in self.candidates or self.candidates[heap[0][1]] != heap[0][0]:
+			heapq.heappop(heap)
+		return heap[0][0]
+
+	def top(self):
+		return sorted(self.candidates.items(), key=lambda x: (-x[1], x[0]))
+
+	def halve(self):
+		self.sketch.halve()
+		self.candidates = {item: estimate >> 1 for item, estimate in self.candidates.items()}
+		self.heap = [(estimate, item) for item, estimate in self.candidates.items()]
+		heapq.heapify(self.heap)
+
+	def memory(self):
+		return self.sketch.memory()
+
+class ChannelStats:
+	def __init__(self, now, k=TOP_K, precision=HLL_PRECISION, width=CMS_WIDTH, depth=CMS_DEPTH):
+		self.total = 0
+		# per-second message counts for the longest window
+		self.counts = array.array('q', bytes(8 * max(WINDOWS)))
+		self.second = int(now)
+		# distinct chatter sketches, one per slot, for the longest window plus the partial current slot
+		self.slot_sketches = [HyperLogLog(precision) for _ in range(max(WINDOWS) // SLOT + 1)]
+		self.slot = int(now) // SLOT
+		self.chatters = HeavyHitters(k, width, depth)
+		self.tokens = HeavyHitters(k, width, depth)
+		self.emotes = HeavyHitters(k, width, depth)
+
+	def advance(self, now):
+		"""Clears the ring slots that have gone stale since the last message"""
+		second = int(now)
+		if second > self.second:
+			size = len(self.counts)
+			for s in range(self.second + 1, min(second, self.second + size) + 1):
+				self.counts[s % size] = 0
+			self.second = second
+
+		slot = second // SLOT
+		if slot > self.slot:
+			size = len(self.slot_sketches)
+			for n in range(self.slot + 1, min(slot, self.slot + size) + 1):
+				self.slot_sketches[n % size].clear()
+			self.slot = slot
+
+	def add(self, now, username, text, emotes):
+		self.advance(now)
+		self.total += 1
+		self.counts[self.second % len(self.counts)] += 1
+		self.slot_sketches[self.slot % len(self.slot_sketches)].add(username)
+		self.chatters.add(username)
+		for token in text.split():
+			self.tokens.add(token)
+		for emote in emotes:
+			self.emotes.add(emote)
+
+	def rate(self, window):
+		"""Messages per second over the last 'window' seconds"""
+		size = len(self.counts)
+		return sum(self.counts[s % size] for s in range(self.second - window + 1, self.second + 1)) / window
+
+	def distinct(self, window):
+		size = len(self.slot_sketches)
+		merged = HyperLogLog(self.slot_sketches[0].precision)
+		# from the slot holding the start of the window to the current one
+		for n in range((self.second - window + 1) // SLOT, self.slot + 1):
+			merged.merge(self.slot_sketches[n % size])
+		return round(merged.count())
+
+	def halve(self):
+		self.chatters.halve()
+		self.tokens.halve()
+		self.emotes.halve()
+
+	def memory(self):
+		return (self.counts.itemsize * len(self.counts) + sum(s.memory() for s in self.slot_sketches) +
+			self.chatters.memory() + self.tokens.memory() + self.emotes.memory())
+
+def message_emotes(message):
+	"""Returns the emote names in a message, using the IRCv3 'emotes' tag"""
+	emotes = message.tags.get('emotes')
+	if not emotes:
+		return []
+	text = message.text
+	names = []
+	# e.g. '25:0-4,12-16/1902:6-10'; positions count code points
+	for emote in emotes.split('/'):
+		_, _, positions = emote.partition(':')
+		first = positions.split(',', 1)[0]
+		start, _, end = first.partition('-')
+		if start.isdigit() and end.isdigit():
+			name = text[int(start):int(end) + 1]
+			names.extend([name] * (positions.count(',') + 1))
+	return names
+
+class Analytics:
+	def __init__(self, k=TOP_K, precision=HLL_PRECISION, width=CMS_WIDTH, depth=CMS_DEPTH,
+			decay_interval=DECAY_INTERVAL):
+		self.params = (k, precision, width, depth)
+		self.decay_interval = decay_interval
+		self.channels = {}
+		self.last_decay = time.monotonic()
+		self.latest = {}
+
+	async def consume(self, message):
+		"""chatclient consumer handler"""
+		self.add(message.channel, message.username, message.text, message_emotes(message))
+
+	def add(self, channel, username, text, emotes=(), now=None):
+		if now is None:
+			now = time.time()
+		stats = self.channels.get(channel)
+		if stats is None:
+			stats = self.channels[channel] = ChannelStats(now, *self.params)
+		stats.add(now, username, text, emotes)
+
+	def decay(self):
+		for stats in self.channels.values():
+			stats.halve()
+
+	def snapshot(self, now=None):
+		"""Returns the current statistics for every channel as plain data"""
+		if now is None:
+			now = time.time()
+		snapshot = {}
+		for channel, stats in self.channels.items():
+			stats.advance(now)
+			snapshot[channel] = {
+				'total': stats.total,
+				'rate': {window: stats.rate(window) for window in WINDOWS},
+				'distinct': {window: stats.distinct(window) for window in WINDOWS},
+				'top_chatters': stats.chatters.top(),
+				'top_tokens': stats.tokens.top(),
+				'top_emotes': stats.emotes.top(),
+			}
+		return snapshot
+
+	async def run(self, interval):
+		"""Refreshes 'latest' every 'interval' seconds and applies the count decay"""
+		while True:
+			await asyncio.sleep(interval)
+			if self.decay_interval and time.monotonic() - self.last_decay >= self.decay_interval:
+				self.decay()
+				self.last_decay = time.monotonic()
+			self.latest = self.snapshot()
+
+	def memory(self):
+		return sum(stats.memory() for stats in self.channels.values())
@@ -0,0 +1,386 @@
+"""
+Benchmarks for the twitchChat message pipeline.
+
+	python3 bench.py parser [--corpus FILE] [--lines N] [--chunk BYTES]
+	python3 bench.py sink [--corpus FILE] [--lines N] [--channels N]
+	python3 bench.py load [--corpus FILE] [--channels N] [--rate R] [--duration S]
+	python3 bench.py analytics [--corpus FILE] [--lines N] [--rate R]
+	python3 bench.py matcher [--corpus FILE] [--lines N] [--patterns N] [--rate R]
+"""
+
+import argparse
+import asyncio
+import collections
+import math
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import analytics
+import chatclient
+import chatlog
+import corpus
+import ircparser
+import matcher
+
+# the share of the true top-k chatters and tokens the analytics sketches have to report
+MIN_RECALL = 0.9
+
+def legacy_parse(chunks):
+	"""The original twitchChat.py loop, ported to Python 3, kept as a baseline"""
+	readbuffer = ''
+	MODT = True
+	out = []
+	for chunk in chunks:
+		readbuffer = readbuffer + chunk.decode('utf-8', 'replace')
+		temp = readbuffer.split('\n')
+		readbuffer = temp.pop()
+
+		for line in temp:
+			if line[0] == 'PING':
+				continue
+			parts = line.split(':')
+
+			if 'QUIT' not in parts[1] and 'JOIN' not in parts[1] and 'PART' not in parts[1]:
+				try:
+					username = parts[1].split('!')[0]
+				except IndexError:
+					username = ''
+				try:
+					message = parts[2][:len(parts[2]) - 1]
+				except IndexError:
+					message = ''
+				if MODT:
+					out.append((username, message))
+				for l in parts:
+					if 'End of /NAMES list' in l:
+						MODT = True
+	return out
+
+def framer_parse(chunks):
+	"""The bytes-level parser, reading the same fields as the baseline"""
+	framer = ircparser.LineFramer()
+	out = []
+	for chunk in chunks:
+		for message in framer.feed(chunk):
+			if message.is_command(b'PRIVMSG'):
+				out.append((message.username, message.text))
+	return out
+
+def framer_scan(chunks):
+	"""The bytes-level parser when only the command is needed, so nothing is decoded"""
+	framer = ircparser.LineFramer()
+	count = 0
+	for chunk in chunks:
+		for message in framer.feed(chunk):
+			if message.is_command(b'PRIVMSG'):
+				count += 1
+	return count
+
+def run(name, fn, chunks, lines):
+	start = time.perf_counter()
+	result = fn(chunks)
+	elapsed = time.perf_counter() - start
+
+	tracemalloc.start()
+	fn(chunks)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	print('\t%-20s %10.0f lines/s  %8.1f peak bytes/line' % (name, lines / elapsed, peak / lines))
+	return result
+
+def bench_parser(args):
+	lines = corpus.load(args.corpus) if args.corpus else corpus.generate(args.lines)
+	data = b'\r\n'.join(lines) + b'\r\n'
+	chunks = [data[i:i + args.chunk] for i in range(0, len(data), args.chunk)]
+
+	print('Parsing %d lines (%d bytes) in %d-byte chunks' % (len(lines), len(data), args.chunk))
+	legacy = run('string.split', legacy_parse, chunks, len(lines))
+	parsed = run('ircparser', framer_parse, chunks, len(lines))
+	run('ircparser (scan)', framer_scan, chunks, len(lines))
+
+	wrong = sum(1 for a, b in zip(legacy, parsed) if a != b) + abs(len(legacy) - len(parsed))
+	print('\tstring.split mis-parsed %d of %d messages' % (wrong, len(parsed)))
+
+def bench_sink(args):
+	channels = ['chan%d' % i for i in range(args.channels)]
+	lines = corpus.load(args.corpus) if args.corpus else corpus.generate(args.lines, channels)
+	messages = [ircparser.parse(line) for line in lines]
+	directory = tempfile.mkdtemp(prefix='chatlog-')
+
+	try:
+		sink = chatlog.ChatLogSink(directory)
+		start = time.perf_counter()
+		for i, message in enumerate(messages):
+			sink.add(message.channel, 1600000000 + i / 1000, message.username, message.text)
+			if sink.pending >= sink.batch_size:
+				sink.flush()
+		sink.flush()
+		elapsed = time.perf_counter() - start
+
+		size = sum(os.path.getsize(os.path.join(root, name))
+			for root, _, names in os.walk(directory) for name in names)
+		print('Sink: %d messages over %d channels in %.2fs, %.0f msgs/s, %.1f bytes/msg on disk' %
+			(len(messages), len(channels), elapsed, len(messages) / elapsed, size / len(messages)))
+
+		log = chatlog.ChatLog(directory)
+		username = messages[0].username
+		since = 1600000000 + len(messages) / 1000 - 60
+		start = time.perf_counter()
+		found = sum(1 for _ in log.query(username=username, since=since))
+		print('Query: %d messages from %s in the last minute in %.1f ms' %
+			(found, username, 1000 * (time.perf_counter() - start)))
+	finally:
+		shutil.rmtree(directory)
+
+def percentile(values, p):
+	return values[min(int(len(values) * p / 100), len(values) - 1)] if values else 0
+
+async def drive_client(port, channels, duration, warmup):
+	"""Runs the client against the fake server and returns (consumed, latencies in ns) after warm-up"""
+	latencies = []
+	counts = {'consumed': 0}
+	measuring = {'on': False}
+
+	async def consume(message):
+		if not measuring['on']:
+			return
+		now = time.time_ns()
+		raw = message.raw
+		start = raw.find(b'sent-ns=') + 8
+		end = raw.find(b';', start)
+		latencies.append(now - int(raw[start:end if end > 0 else raw.find(b' ', start)]))
+		counts['consumed'] += 1
+
+	credentials = {'NICK': 'justinfan12345', 'PASS': 'oauth:benchmark'}
+	client = chatclient.TwitchChatClient(credentials, channels, host='127.0.0.1', port=port)
+	client.add_consumer('bench', consume, maxsize=10000, policy='block')
+	task = asyncio.ensure_future(client.run())
+
+	await asyncio.sleep(warmup)
+	measuring['on'] = True
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	start = time.perf_counter()
+	await asyncio.sleep(duration)
+	elapsed = time.perf_counter() - start
+	measuring['on'] = False
+	after = resource.getrusage(resource.RUSAGE_SELF)
+	task.cancel()
+
+	cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+	return counts['consumed'], latencies, elapsed, cpu, after.ru_maxrss
+
+def bench_load(args):
+	channels = ['chan%d' % i for i in range(args.channels)]
+	connections = (len(channels) + chatclient.CHANNELS_PER_CONNECTION - 1) // chatclient.CHANNELS_PER_CONNECTION
+
+	# the server runs in its own process so its CPU time is not charged to the client
+	command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeserver.py'),
+		'--port', '0', '--rate', str(args.rate / connections), '--ping-interval', '5']
+	if args.corpus:
+		command += ['--corpus', args.corpus]
+	server = subprocess.Popen(command, stdout=subprocess.PIPE)
+	try:
+		port = int(server.stdout.readline())
+		consumed, latencies, elapsed, cpu, maxrss = asyncio.run(
+			drive_client(port, channels, args.duration, args.warmup))
+	finally:
+		server.terminate()
+		server.wait()
+
+	latencies.sort()
+	print('Load: %d channels over %d connection(s), offered %.0f msgs/s for %.0fs' %
+		(len(channels), connections, args.rate, elapsed))
+	print('\tsustained:  %.0f msgs/s' % (consumed / elapsed))
+	print('\tlatency:    p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms' % tuple(
+		percentile(latencies, p) / 1e6 for p in (50, 90, 99, 100)))
+	print('\tclient CPU: %.1f%% of one core, max RSS %.1f MB' % (100 * cpu / elapsed, maxrss / 1024))
+
+def exact_analytics(messages, rate):
+	"""Exact counts over the whole stream for one channel, to check the sketches against"""
+	end = len(messages) / rate
+	users = {window: set() for window in analytics.WINDOWS}
+	chatters = collections.Counter()
+	tokens = collections.Counter()
+	for i, message in enumerate(messages):
+		username = message.username
+		for window in analytics.WINDOWS:
+			if i / rate > end - window:
+				users[window].add(username)
+		chatters[username] += 1
+		tokens.update(message.text.split())
+	return {window: len(names) for window, names in users.items()}, chatters, tokens
+
+def top_k_accuracy(estimated, exact, k):
+	"""
+	Returns (recall of the true top-k, worst relative overestimate, worst
+	absolute overestimate) of the reported counts.
+	"""
+	true_top = set(item for item, _ in exact.most_common(k))
+	recall = len(true_top & set(item for item, _ in estimated)) / len(true_top)
+	error = max((count - exact[item]) / exact[item] for item, count in estimated)
+	excess = max(count - exact[item] for item, count in estimated)
+	return recall, error, excess
+
+def accuracy_failures(precision, width, errors, sketches):
+	"""
+	Checks one sketch configuration against its error bounds and returns a
+	description of every bound that was exceeded. 'errors' holds the relative
+	distinct count error of each window, and 'sketches' (name, recall, excess,
+	total count added) for each heavy hitters sketch.
+	"""
+	failures = []
+	# four standard errors of a HyperLogLog with 2^precision registers; the raw estimate is biased between
+	# 2.5 and 5 times the register count, where the smallest sketches spend most of the benchmark
+	distinct_bound = 4 * 1.04 / math.sqrt(1 << precision)
+	for window, error in zip(analytics.WINDOWS, errors):
+		if error > distinct_bound:
+			failures.append('%ds distinct error %.1f%% > %.1f%%' % (window, 100 * error, 100 * distinct_bound))
+	for name, recall, excess, total in sketches:
+		if recall < MIN_RECALL:
+			failures.append('%s recall %.0f%% < %.0f%%' % (name, 100 * recall, 100 * MIN_RECALL))
+		# a count-min sketch overestimates by at most e/width of everything added, with high probability
+		excess_bound = math.e * total / width
+		if excess > excess_bound:
+			failures.append('%s overestimate %d > %d' % (name, excess, excess_bound))
+	return failures
+
+def bench_analytics(args):
+	lines = corpus.load(args.corpus) if args.corpus else corpus.generate(args.lines)
+	messages = [ircparser.parse(line) for line in lines]
+	texts = [(message.username, message.text) for message in messages]
+	end = len(messages) / args.rate
+
+	tracemalloc.start()
+	distinct, chatters, tokens = exact_analytics(messages, args.rate)
+	exact_memory = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	print('Analytics: %d messages at %.0f msgs/s (%.0fs of chat), exact counts use %.0f KB' %
+		(len(messages), args.rate, end, exact_memory / 1024))
+	print('\t%-22s %10s %9s %20s %16s %16s' % ('precision/width', 'msgs/s', 'KB', 'distinct err 1/5/15m',
+		'chatters recall', 'tokens recall'))
+
+	failures = []
+	for precision, width in ((8, 256), (10, 1024), (12, 4096)):
+		stats = analytics.Analytics(precision=precision, width=width, decay_interval=0)
+		start = time.perf_counter()
+		for i, (username, text) in enumerate(texts):
+			stats.add('chan0', username, text, now=i / args.rate)
+		elapsed = time.perf_counter() - start
+
+		snapshot = stats.snapshot(now=end)['chan0']
+		errors = [abs(snapshot['distinct'][w] - distinct[w]) / distinct[w] for w in analytics.WINDOWS]
+		chatter_recall, chatter_error, chatter_excess = top_k_accuracy(snapshot['top_chatters'], chatters,
+			analytics.TOP_K)
+		token_recall, token_error, token_excess = top_k_accuracy(snapshot['top_tokens'], tokens, analytics.TOP_K)
+		print('\t%-22s %10.0f %9.0f %20s %6.0f%% (+%4.1f%%) %6.0f%% (+%4.1f%%)' % ('%d / %d' % (precision, width),
+			len(texts) / elapsed, stats.memory() / 1024, '/'.join('%.1f%%' % (100 * error) for error in errors),
+			100 * chatter_recall, 100 * chatter_error, 100 * token_recall, 100 * token_error))
+		failures += ['%d / %d: %s' % (precision, width, failure) for failure in accuracy_failures(precision, width,
+			errors, [('chatters', chatter_recall, chatter_excess, len(texts)),
+				('tokens', token_recall, token_excess, sum(tokens.values()))])]
+
+	for failure in failures:
+		print('[+] Accuracy bound exceeded: %s' % failure)
+	if failures:
+		sys.exit(1)
+
+def generate_patterns(n, seed=0):
+	"""Returns 'n' watch terms: random words and phrases, plus a few that occur in the synthetic chat"""
+	rng = random.Random(seed)
+	letters = 'abcdefghijklmnopqrstuvwxyz'
+	patterns = [matcher.Pattern(term.casefold(), True, term) for term in ('LUL', 'monkaS', 'clip')]
+	while len(patterns) < n:
+		term = ' '.join(''.join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+			for _ in range(rng.choice((1, 1, 1, 2, 3))))
+		patterns.append(matcher.Pattern(term, rng.random() < 0.5, term))
+	return patterns
+
+def naive_match(patterns, text):
+	"""The loop of 'in' tests and regexes the matcher replaces, as a baseline"""
+	text = text.casefold()
+	return [pattern for pattern, regex in patterns
+		if (regex.search(text) if regex else pattern.term in text)]
+
+def bench_matcher(args):
+	lines = corpus.load(args.corpus) if args.corpus else corpus.generate(args.lines)
+	texts = [(message.channel, message.text) for message in map(ircparser.parse, lines)]
+	patterns = generate_patterns(args.patterns)
+
+	start = time.perf_counter()
+	m = matcher.Matcher({matcher.ALL_CHANNELS: patterns})
+	compile_time = time.perf_counter() - start
+	automaton = m.automata[matcher.ALL_CHANNELS]
+	print('Matcher: %d patterns compiled into %d states in %.0f ms' %
+		(len(patterns), len(automaton.goto), 1000 * compile_time))
+
+	start = time.perf_counter()
+	results = [m.match(channel, text) for channel, text in texts]
+	elapsed = time.perf_counter() - start
+	rate = len(texts) / elapsed
+	print('\tautomaton:  %.0f msgs/s, %d of %d messages matched; %.0f%% of one core at %.0f msgs/s' %
+		(rate, sum(1 for r in results if r), len(texts), 100 * args.rate / rate, args.rate))
+
+	# the baseline is far too slow for the whole corpus, so time a sample
+	sample = texts[:max(1, min(len(texts), 20000000 // len(patterns)))]
+	compiled = [(pattern, re.compile(r'(?<!\w)%s(?!\w)' % re.escape(pattern.term)) if pattern.words else None)
+		for pattern in patterns]
+	start = time.perf_counter()
+	naive = [naive_match(compiled, text) for _, text in sample]
+	naive_rate = len(sample) / (time.perf_counter() - start)
+	print('\tloop of in/re: %.0f msgs/s (%d message sample)' % (naive_rate, len(sample)))
+
+	wrong = sum(1 for expected, found in zip(naive, results)
+		if set(map(id, expected)) != set(id(match.pattern) for match in found))
+	print('\t%d of %d sampled messages differ from the baseline' % (wrong, len(sample)))
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the twitchChat message pipeline.')
+	sub = parser.add_subparsers(dest='bench', required=True)
+
+	p = sub.add_parser('parser', help='IRC line parsing throughput')
+	p.add_argument('--corpus', help='file of raw IRC lines (default: synthetic chat)')
+	p.add_argument('--lines', type=int, default=200000, help='synthetic corpus size')
+	p.add_argument('--chunk', type=int, default=1024, help='bytes per simulated recv()')
+	p.set_defaults(fn=bench_parser)
+
+	p = sub.add_parser('sink', help='chat log sink write throughput and indexed queries')
+	p.add_argument('--corpus', help='file of raw IRC lines (default: synthetic chat)')
+	p.add_argument('--lines', type=int, default=200000, help='synthetic corpus size')
+	p.add_argument('--channels', type=int, default=20, help='synthetic channel count')
+	p.set_defaults(fn=bench_sink)
+
+	p = sub.add_parser('load', help='client throughput and latency against the local fake server')
+	p.add_argument('--corpus', help='file of raw IRC lines to replay (default: synthetic chat)')
+	p.add_argument('--channels', type=int, default=20, help='channels to join')
+	p.add_argument('--rate', type=float, default=5000, help='total messages per second offered')
+	p.add_argument('--duration', type=float, default=10, help='seconds to measure')
+	p.add_argument('--warmup', type=float, default=2, help='seconds to wait before measuring')
+	p.set_defaults(fn=bench_load)
+
+	p = sub.add_parser('analytics', help='sketch accuracy and memory against exact counts')
+	p.add_argument('--corpus', help='file of raw IRC lines (default: synthetic chat)')
+	p.add_argument('--lines', type=int, default=200000, help='synthetic corpus size')
+	p.add_argument('--rate', type=float, default=100, help='messages per second the corpus is spread over')
+	p.set_defaults(fn=bench_analytics)
+
+	p = sub.add_parser('matcher', help='watch-term matching throughput against a loop of in tests')
+	p.add_argument('--corpus', help='file of raw IRC lines (default: synthetic chat)')
+	p.add_argument('--lines', type=int, default=50000, help='synthetic corpus size')
+	p.add_argument('--patterns', type=int, default=10000, help='number of watch terms')
+	p.add_argument('--rate', type=float, default=5000, help='message rate to report CPU use at')
+	p.set_defaults(fn=bench_matcher)
+
+	args = parser.parse_args()
+	args.fn(args)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,241 @@
+"""
+asyncio Twitch IRC client that monitors many channels at once.
+
+Channels are spread over a pool of connections (Twitch limits how many
+channels one connection should join), PINGs are answered directly by the
+reading task, and every chat message is handed to each registered consumer
+through its own bounded queue. What happens when a consumer's queue is full
+depends on its backpressure policy:
+
+	block - the connection stops reading until the consumer catches up
+	drop  - the message is discarded for that consumer and counted
+	spill - the message is appended to a temporary file on disk and fed
+	        back to the consumer once its queue has drained
+"""
+
+import asyncio
+import collections
+import tempfile
+import time
+
+import ircparser
+
+HOST = 'irc.twitch.tv'
+PORT = 6667
+
+# channels joined per connection, and how many are sent in one JOIN command
+CHANNELS_PER_CONNECTION = 50
+JOIN_BATCH_SIZE = 10
+# Twitch allows 20 JOINs per 10 seconds for regular accounts
+JOIN_INTERVAL = 0.5
+
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+# Twitch PINGs every 5 minutes; after this long without data we PING the server ourselves,
+# and drop the connection if nothing arrives within PING_TIMEOUT
+IDLE_TIMEOUT = 360
+PING_TIMEOUT = 30
+
+POLICIES = ('block', 'drop', 'spill')
+
+READ_SIZE = 65536
+
+class Consumer:
+	"""
+	Feeds messages to an async handler through a bounded queue with the
+	given backpressure policy.
+	"""
+	def __init__(self, name, handler, maxsize=1000, policy='block'):
+		if policy not in POLICIES:
+			raise ValueError('Unknown backpressure policy: ' + policy)
+		self.name = name
+		self.handler = handler
+		self.policy = policy
+		self.queue = asyncio.Queue(maxsize)
+		self.handled = 0
+		# messages whose handler raised
+		self.errors = 0
+		self.dropped = 0
+		self.spilled = 0
+		self.spill_file = None
+		# byte offsets of messages written to the spill file but not yet read back
+		self.spill_offsets = collections.deque()
+		self.spill_read_offset = 0
+
+	async def put(self, message):
+		if self.policy == 'block':
+			await self.queue.put(message)
+		elif self.spill_offsets:
+			# keep ordering: once spilling, everything goes to disk until it has drained
+			self._spill(message)
+		else:
+			try:
+				self.queue.put_nowait(message)
+			except asyncio.QueueFull:
+				if self.policy == 'drop':
+					self.dropped += 1
+				else:
+					self._spill(message)
+
+	def _spill(self, message):
+		if self.spill_file is None:
+			self.spill_file = tempfile.TemporaryFile()
+		self.spill_file.seek(0, 2)
+		self.spill_file.write(message.raw + b'\n')
+		self.spill_offsets.append(self.spill_file.tell())
+		self.spilled += 1
+
+	def _unspill(self):
+		"""Moves spilled messages back into the queue while there is room"""
+		self.spill_file.seek(self.spill_read_offset)
+		while self.spill_offsets and not self.queue.full():
+			end = self.spill_offsets.popleft()
+			raw = self.spill_file.read(end - self.spill_read_offset)[:-1]
+			self.spill_read_offset = end
+			self.queue.put_nowait(ircparser.parse(raw))
+
+		if not self.spill_offsets:
+			# everything has been read back, so the file can start over
+			self.spill_file.seek(0)
+			self.spill_file.truncate()
+			self.spill_read_offset = 0
+
+	async def run(self):
+		while True:
+			if self.spill_offsets and self.queue.empty():
+				self._unspill()
+			message = await self.queue.get()
+			try:
+				await self.handler(message)
+			except Exception as e:
+				# one bad message must not stop this consumer, let alone the whole client
+				self.errors += 1
+				print('[+] Consumer %s failed on a message from #%s: %r' % (self.name, message.channel, e))
+			finally:
+				self.handled += 1
+				self.queue.task_done()
+
+	def depth(self):
+		return self.queue.qsize() + len(self.spill_offsets)
+
+class Connection:
+	"""One IRC connection joined to a subset of the channels"""
+	def __init__(self, client, channels):
+		self.client = client
+		self.channels = channels
+		self.writer = None
+		# whether the current session has received anything from the server
+		self.alive = False
+
+	async def send(self, line):
+		self.writer.write(line.encode('utf-8') + b'\r\n')
+		await self.writer.drain()
+
+	async def run(self):
+		delay = RECONNECT_DELAY
+		while True:
+			try:
+				await self.session()
+			except OSError as e:
+				if self.alive:
+					# only back off further while connection attempts keep failing
+					delay = RECONNECT_DELAY
+				print('[+] Connection lost (%s), reconnecting in %ds' % (e, delay))
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+	async def session(self):
+		self.alive = False
+		reader, self.writer = await asyncio.open_connection(self.client.host, self.client.port)
+		try:
+			if self.client.request_tags:
+				await self.send('CAP REQ :twitch.tv/tags')
+			await self.send('PASS ' + self.client.credentials['PASS'])
+			await self.send('NICK ' + self.client.credentials['NICK'])
+			joining = asyncio.ensure_future(self.join())
+			try:
+				await self.read(reader)
+			finally:
+				joining.cancel()
+		finally:
+			self.writer.close()
+
+	async def join(self):
+		for i in range(0, len(self.channels), JOIN_BATCH_SIZE):
+			batch = self.channels[i:i + JOIN_BATCH_SIZE]
+			await self.send('JOIN ' + ','.join('#' + channel for channel in batch))
+			await asyncio.sleep(JOIN_INTERVAL * len(batch))
+
+	async def read(self, reader):
+		framer = ircparser.LineFramer()
+		while True:
+			data = await self.receive(reader)
+			if not data:
+				raise ConnectionResetError('connection closed by server')
+			self.alive = True
+
+			for message in framer.feed(data):
+				if message.is_command(b'PING'):
+					# answer right away so the server never sees us as idle
+					await self.send('PONG :' + message.text)
+				elif message.is_command(b'PRIVMSG'):
+					# consumers may hold on to the message, so stop it pinning the whole chunk
+					await self.client.dispatch(message.detach())
+
+	async def receive(self, reader):
+		"""Reads the next chunk, PINGing the server if it has gone quiet to tell a dead socket from a slow channel"""
+		try:
+			return await asyncio.wait_for(reader.read(READ_SIZE), IDLE_TIMEOUT)
+		except asyncio.TimeoutError:
+			await self.send('PING :' + self.client.host)
+		try:
+			return await asyncio.wait_for(reader.read(READ_SIZE), PING_TIMEOUT)
+		except asyncio.TimeoutError:
+			raise TimeoutError('no reply to PING within %ds' % PING_TIMEOUT) from None
+
+class TwitchChatClient:
+	def __init__(self, credentials, channels, host=HOST, port=PORT,
+			channels_per_connection=CHANNELS_PER_CONNECTION, request_tags=True):
+		self.credentials = credentials
+		self.request_tags = request_tags
+		self.host = host
+		self.port = port
+		self.connections = [Connection(self, channels[i:i + channels_per_connection])
+			for i in range(0, len(channels), channels_per_connection)]
+		self.consumers = []
+		self.received = 0
+
+	def add_consumer(self, name, handler, maxsize=1000, policy='block'):
+		"""Registers an async handler(message) that receives every chat message"""
+		consumer = Consumer(name, handler, maxsize, policy)
+		self.consumers.append(consumer)
+		return consumer
+
+	async def dispatch(self, message):
+		self.received += 1
+		for consumer in self.consumers:
+			await consumer.put(message)
+
+	async def report(self, interval):
+		"""Prints the message rate and consumer queue depths every 'interval' seconds"""
+		last_count = self.received
+		last_time = time.monotonic()
+		while True:
+			await asyncio.sleep(interval)
+			now = time.monotonic()
+			rate = (self.received - last_count) / (now - last_time)
+			last_count, last_time = self.received, now
+			queues = ', '.join('%s=%d/%d (dropped %d, spilled %d, errors %d)' % (c.name, c.depth(),
+				c.queue.maxsize, c.dropped, c.spilled, c.errors) for c in self.consumers)
+			print('[+] %.1f msgs/s, queues: %s' % (rate, queues))
+
+	async def run(self, report_interval=0):
+		tasks = [asyncio.ensure_future(consumer.run()) for consumer in self.consumers]
+		tasks += [asyncio.ensure_future(connection.run()) for connection in self.connections]
+		if report_interval:
+			tasks.append(asyncio.ensure_future(self.report(report_interval)))
+		try:
+			await asyncio.gather(*tasks)
+		finally:
+			for task in tasks:
+				task.cancel()
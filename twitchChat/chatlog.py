@@ -0,0 +1,176 @@
+"""
+Durable, compressed chat history.
+
+ChatLogSink is a chatclient consumer that buffers messages and flushes them
+in batches (once 'batch_size' messages are waiting or 'flush_interval'
+seconds have passed). Each channel gets its own directory of segment files;
+every flush appends one gzip member to the current segment, and segments
+are rotated by size and age. Next to each segment is a small index with
+one JSON line per flushed block, holding its file offset, time range and
+the usernames in it, so ChatLog.query only decompresses the blocks that
+can contain matching messages.
+
+Records are stored one per line as 'timestamp<TAB>username<TAB>text'.
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import time
+import zlib
+
+SEGMENT_SUFFIX = '.log.gz'
+INDEX_SUFFIX = '.idx'
+
+# defaults
+BATCH_SIZE = 2000
+FLUSH_INTERVAL = 1.0
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+SEGMENT_MAX_AGE = 3600
+COMPRESSION_LEVEL = 6
+
+class Segment:
+	"""An open segment file for one channel and its index"""
+	def __init__(self, path):
+		self.path = path
+		self.index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+		self.created = time.time()
+		self.size = 0
+
+	def append(self, records):
+		"""Compresses 'records' into one gzip member at the end of the segment"""
+		lines = ''.join('%.3f\t%s\t%s\n' % record for record in records).encode('utf-8')
+		compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31) # 31: gzip container
+		data = compressor.compress(lines) + compressor.flush()
+
+		with open(self.path, 'ab') as f:
+			f.write(data)
+
+		# the index line is written after the data, so it never points past the end of the segment
+		entry = [self.size, len(data), records[0][0], records[-1][0], sorted(set(record[1] for record in records))]
+		with open(self.index_path, 'a') as f:
+			f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+		self.size += len(data)
+
+class ChatLogSink:
+	def __init__(self, directory, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+			segment_max_bytes=SEGMENT_MAX_BYTES, segment_max_age=SEGMENT_MAX_AGE):
+		self.directory = directory
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.segment_max_bytes = segment_max_bytes
+		self.segment_max_age = segment_max_age
+		# channel -> list of (timestamp, username, text)
+		self.buffers = {}
+		self.segments = {}
+		self.pending = 0
+		self.written = 0
+		# messages without a usable channel, which would have no directory to go in
+		self.dropped = 0
+		self.flusher = None
+
+	async def consume(self, message):
+		"""chatclient consumer handler"""
+		if not self.add(message.channel, time.time(), message.username, message.text):
+			print('[+] Dropped a chat message with no usable channel: %r' % message.raw[:200])
+			return
+		if self.flusher is None:
+			self.flusher = asyncio.ensure_future(self.flush_periodically())
+		if self.pending >= self.batch_size:
+			self.flush()
+
+	def add(self, channel, timestamp, username, text):
+		"""Buffers a record; returns False and drops it if 'channel' can't be a directory name"""
+		if not channel or channel in ('.', '..') or '/' in channel or os.sep in channel:
+			self.dropped += 1
+			return False
+		# tabs and newlines would break the record format
+		if '\t' in text or '\n' in text or '\r' in text:
+			text = text.replace('\t', ' ').replace('\n', ' ').replace('\r', ' ')
+		buffer = self.buffers.get(channel)
+		if buffer is None:
+			buffer = self.buffers[channel] = []
+		buffer.append((timestamp, username, text))
+		self.pending += 1
+		return True
+
+	async def flush_periodically(self):
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			self.flush()
+
+	def flush(self):
+		for channel, records in self.buffers.items():
+			if records:
+				self.segment(channel).append(records)
+				self.written += len(records)
+		self.buffers = {}
+		self.pending = 0
+
+	def segment(self, channel):
+		"""Returns the channel's open segment, rotating it if it is too big or too old"""
+		segment = self.segments.get(channel)
+		if segment is not None and (segment.size >= self.segment_max_bytes or
+				time.time() - segment.created >= self.segment_max_age):
+			segment = None
+
+		if segment is None:
+			channel_dir = os.path.join(self.directory, channel)
+			os.makedirs(channel_dir, exist_ok=True)
+			name = time.strftime('%Y%m%d-%H%M%S')
+			path = os.path.join(channel_dir, name + SEGMENT_SUFFIX)
+			sequence = 1
+			while os.path.exists(path):
+				path = os.path.join(channel_dir, '%s-%d%s' % (name, sequence, SEGMENT_SUFFIX))
+				sequence += 1
+			segment = self.segments[channel] = Segment(path)
+		return segment
+
+	def close(self):
+		if self.flusher is not None:
+			self.flusher.cancel()
+			self.flusher = None
+		self.flush()
+
+class ChatLog:
+	"""Reads the segments written by ChatLogSink"""
+	def __init__(self, directory):
+		self.directory = directory
+
+	def channels(self):
+		return sorted(name for name in os.listdir(self.directory)
+			if os.path.isdir(os.path.join(self.directory, name)))
+
+	def query(self, channel=None, username=None, since=None, until=None):
+		"""
+		Yields (timestamp, channel, username, text) for every stored message
+		matching all of the given filters, reading only the blocks whose
+		index says they can contain a match.
+		"""
+		for channel in [channel] if channel else self.channels():
+			channel_dir = os.path.join(self.directory, channel)
+			if not os.path.isdir(channel_dir):
+				continue
+			for name in sorted(os.listdir(channel_dir)):
+				if not name.endswith(INDEX_SUFFIX):
+					continue
+				with open(os.path.join(channel_dir, name), 'r') as f:
+					blocks = [json.loads(line) for line in f]
+
+				segment_path = os.path.join(channel_dir, name[:-len(INDEX_SUFFIX)] + SEGMENT_SUFFIX)
+				with open(segment_path, 'rb') as segment:
+					for offset, length, first, last, users in blocks:
+						if (since is not None and last < since) or (until is not None and first > until):
+							continue
+						if username is not None and username not in users:
+							continue
+						segment.seek(offset)
+						for line in gzip.decompress(segment.read(length)).decode('utf-8').split('\n')[:-1]:
+							timestamp, user, text = line.split('\t', 2)
+							timestamp = float(timestamp)
+							if username is not None and user != username:
+								continue
+							if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+								continue
+							yield timestamp, channel, user, text
@@ -0,0 +1,35 @@
+"""
+Chat corpora for benchmarking: recorded raw IRC logs or synthetic chat.
+
+A recorded corpus is a file of raw IRC lines exactly as received from the
+server. The synthetic corpus mimics busy Twitch channels: IRCv3 tags on
+every message, a skewed set of chatters, emotes, colons and non-ASCII text.
+"""
+
+import random
+
+EMOTES = ['Kappa', 'PogChamp', 'LUL', 'Kreygasm', 'BibleThump', 'ResidentSleeper', 'monkaS', 'OMEGALUL', '4Head', 'EZ']
+WORDS = ['gg', 'wp', 'lol', 'what', 'is', 'this', 'play', 'no', 'yes', 'clip', 'it', 'chat', 'so', 'good', 'bad',
+	'streamer', 'when', 'why', 'nice', 'ok', 'time:', '12:30', 'http://example.com', 'héllo', 'ありがとう', '🙂']
+
+def load(filename):
+	"""Returns the lines of a recorded corpus as bytes, without line endings"""
+	with open(filename, 'rb') as f:
+		return [line.rstrip(b'\r\n') for line in f if line.strip()]
+
+def generate(n, channels=('chan0',), users=5000, seed=0):
+	"""Returns 'n' synthetic PRIVMSG lines as bytes, without line endings"""
+	rng = random.Random(seed)
+	lines = []
+	for i in range(n):
+		# a few heavy chatters and a long tail, roughly like real chat
+		user = 'user%d' % min(int(rng.paretovariate(1.2)) - 1, users - 1) if rng.random() < 0.6 \
+			else 'user%d' % rng.randrange(users)
+		words = [rng.choice(EMOTES) if rng.random() < 0.3 else rng.choice(WORDS) for _ in range(rng.randint(1, 12))]
+		tags = ('@badge-info=;badges=subscriber/12;color=#%06X;display-name=%s;emotes=;id=%08x-0000;mod=0;'
+			'room-id=1234;subscriber=1;tmi-sent-ts=%d;turbo=0;user-id=%d;user-type=') % (
+			rng.randrange(0x1000000), user, i, 1600000000000 + i, hash(user) & 0xffffff)
+		line = '%s :%s!%s@%s.tmi.twitch.tv PRIVMSG #%s :%s' % (tags, user, user, user,
+			channels[i % len(channels)], ' '.join(words))
+		lines.append(line.encode('utf-8'))
+	return lines
@@ -0,0 +1,174 @@
+"""
+Local stand-in for the Twitch IRC server, for offline testing and benchmarks.
+
+Accepts CAP/PASS/NICK/JOIN like irc.twitch.tv, sends the welcome/MOTD and
+NAMES sequence for every joined channel, PINGs each client periodically and
+replays recorded or synthetic chat to it at a fixed rate per connection,
+spread over the channels it has joined. Every replayed message carries an extra
+'sent-ns' tag with the server's time.time_ns() at send, so a client on the
+same host can measure delivery latency.
+
+	python3 fakeserver.py [--port 6667] [--rate 1000] [--corpus FILE] [--ping-interval 60]
+"""
+
+import argparse
+import asyncio
+import time
+
+import corpus
+import ircparser
+
+HOSTNAME = b'tmi.twitch.tv'
+# how often the replay loop wakes up to send the messages that are due
+TICK = 0.01
+
+class FakeTwitchServer:
+	def __init__(self, lines, rate=1000, ping_interval=60, host='127.0.0.1', port=0):
+		"""'lines' are raw PRIVMSG lines; their channels are replaced by the client's joined channels"""
+		self.rate = rate
+		self.ping_interval = ping_interval
+		self.host = host
+		self.port = port
+		self.server = None
+		self.sent = 0
+		# (tags, prefix, text) fragments, ready to be joined with a channel
+		self.templates = []
+		for line in lines:
+			message = ircparser.parse(line)
+			if not message.is_command(b'PRIVMSG'):
+				continue
+			tags = line[1:line.index(b' ')] if line.startswith(b'@') else b''
+			self.templates.append((tags, message.prefix.encode('utf-8'), message.text.encode('utf-8')))
+
+	async def start(self):
+		self.server = await asyncio.start_server(self.handle, self.host, self.port)
+		self.port = self.server.sockets[0].getsockname()[1]
+		return self.port
+
+	def close(self):
+		self.server.close()
+
+	async def handle(self, reader, writer):
+		client = FakeClient(self, writer)
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				await client.command(line.rstrip(b'\r\n'))
+		except ConnectionError:
+			pass
+		finally:
+			client.stop()
+			writer.close()
+
+class FakeClient:
+	"""Server-side state of one connected client"""
+	def __init__(self, server, writer):
+		self.server = server
+		self.writer = writer
+		self.nick = b'justinfan'
+		self.channels = []
+		self.tasks = []
+
+	def send(self, *lines):
+		self.writer.write(b''.join(line + b'\r\n' for line in lines))
+
+	async def command(self, line):
+		command, _, rest = line.partition(b' ')
+		command = command.upper()
+
+		if command == b'CAP':
+			self.send(b':' + HOSTNAME + b' CAP * ACK :' + rest.partition(b':')[2])
+		elif command == b'NICK':
+			self.nick = rest.strip()
+			self.welcome()
+			self.tasks.append(asyncio.ensure_future(self.ping()))
+			self.tasks.append(asyncio.ensure_future(self.replay()))
+		elif command == b'JOIN':
+			for channel in rest.strip().split(b','):
+				self.join(channel.lstrip(b'#'))
+		elif command == b'PING':
+			self.send(b':' + HOSTNAME + b' PONG ' + HOSTNAME + b' ' + rest)
+		await self.writer.drain()
+
+	def welcome(self):
+		prefix = b':' + HOSTNAME + b' '
+		nick = self.nick
+		self.send(prefix + b'001 ' + nick + b' :Welcome, GLHF!',
+			prefix + b'002 ' + nick + b' :Your host is ' + HOSTNAME,
+			prefix + b'003 ' + nick + b' :This server is rather new',
+			prefix + b'004 ' + nick + b' :-',
+			prefix + b'375 ' + nick + b' :-',
+			prefix + b'372 ' + nick + b' :You are in a maze of twisty passages, all alike.',
+			prefix + b'376 ' + nick + b' :>')
+
+	def join(self, channel):
+		nick = self.nick
+		user = nick + b'!' + nick + b'@' + nick + b'.' + HOSTNAME
+		self.send(b':' + user + b' JOIN #' + channel,
+			b':' + nick + b'.' + HOSTNAME + b' 353 ' + nick + b' = #' + channel + b' :' + nick,
+			b':' + nick + b'.' + HOSTNAME + b' 366 ' + nick + b' #' + channel + b' :End of /NAMES list')
+		self.channels.append(channel)
+
+	async def ping(self):
+		while True:
+			await asyncio.sleep(self.server.ping_interval)
+			self.send(b'PING :' + HOSTNAME)
+			await self.writer.drain()
+
+	async def replay(self):
+		templates = self.server.templates
+		if not templates:
+			return
+		start = time.monotonic()
+		sent = 0
+		while True:
+			await asyncio.sleep(TICK)
+			if not self.channels:
+				start = time.monotonic()
+				continue
+
+			due = int((time.monotonic() - start) * self.server.rate)
+			channels = self.channels
+			now = b'%d' % time.time_ns()
+			batch = []
+			while sent < due:
+				tags, prefix, text = templates[sent % len(templates)]
+				channel = channels[sent % len(channels)]
+				batch.append(b'@sent-ns=' + now + (b';' + tags if tags else b'') + b' :' + prefix +
+					b' PRIVMSG #' + channel + b' :' + text)
+				sent += 1
+			if batch:
+				self.send(*batch)
+				self.server.sent += len(batch)
+				await self.writer.drain()
+
+	def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+async def serve(args):
+	lines = corpus.load(args.corpus) if args.corpus else corpus.generate(10000)
+	server = FakeTwitchServer(lines, args.rate, args.ping_interval, args.host, args.port)
+	port = await server.start()
+	# benchmark harnesses read the port from the first line of output
+	print(port, flush=True)
+	await server.server.serve_forever()
+
+def main():
+	parser = argparse.ArgumentParser(description='Run a local stand-in for the Twitch IRC server.')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=6667, help='port to listen on (0 picks a free one)')
+	parser.add_argument('--rate', type=float, default=1000, help='messages per second sent to each client')
+	parser.add_argument('--corpus', help='file of raw PRIVMSG lines to replay (default: synthetic chat)')
+	parser.add_argument('--ping-interval', type=float, default=60, help='seconds between PINGs')
+	args = parser.parse_args()
+
+	try:
+		asyncio.run(serve(args))
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
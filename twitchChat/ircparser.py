@@ -0,0 +1,152 @@
+"""
+Bytes-level IRC line framing and parsing with IRCv3 tag support.
+
+LineFramer splits received chunks into lines without copying them: every
+Message only records the receive buffer and the offsets of its line. The
+tags, prefix, command and parameters are located lazily on first access,
+and text is only decoded from UTF-8 when a property asking for it is read.
+Call Message.detach() before keeping a message around for long, so it
+holds a copy of its own line rather than the whole receive buffer.
+"""
+
+import re
+
+# IRCv3 tag value escapes
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+# tags, prefix, command, middle parameters and trailing parameter of a line
+LINE = re.compile(rb'(?:@([^ ]*) +)?(?::([^ ]*) +)?([^ ]*)(.*?)(?: :(.*))?$', re.DOTALL)
+TAGS, PREFIX, COMMAND, PARAMS, TRAILING = 1, 2, 3, 4, 5
+
+class Message:
+	"""A single IRC line stored as offsets into a receive buffer"""
+	__slots__ = ('buf', 'start', 'end', '_match')
+
+	def __init__(self, buf, start=0, end=None):
+		self.buf = buf
+		self.start = start
+		self.end = len(buf) if end is None else end
+		# spans of the line's parts in buf; None until first accessed
+		self._match = None
+
+	def _parse(self):
+		self._match = LINE.match(self.buf, self.start, self.end)
+		return self._match
+
+	def _decode(self, group, encoding='utf-8'):
+		start, end = (self._match or self._parse()).span(group)
+		return self.buf[start:end].decode(encoding, 'replace') if start >= 0 else ''
+
+	@property
+	def command(self):
+		return self._decode(COMMAND, 'ascii')
+
+	def is_command(self, command):
+		"""Compares the command against a bytes value without decoding anything"""
+		start, end = (self._match or self._parse()).span(COMMAND)
+		return end - start == len(command) and self.buf.startswith(command, start)
+
+	@property
+	def prefix(self):
+		return self._decode(PREFIX)
+
+	@property
+	def username(self):
+		start, end = (self._match or self._parse()).span(PREFIX)
+		if start < 0:
+			return ''
+		bang = self.buf.find(b'!', start, end)
+		return self.buf[start:end if bang < 0 else bang].decode('utf-8', 'replace')
+
+	@property
+	def params(self):
+		"""All parameters, including the trailing one, as a list of strings"""
+		params = self._decode(PARAMS).split()
+		if (self._match or self._parse()).start(TRAILING) >= 0:
+			params.append(self._decode(TRAILING))
+		return params
+
+	@property
+	def channel(self):
+		start, end = (self._match or self._parse()).span(PARAMS)
+		channel = self.buf.find(b'#', start, end)
+		# the channel must be the first middle parameter
+		if channel < 0 or self.buf[start:channel].strip():
+			return ''
+		space = self.buf.find(b' ', channel, end)
+		return self.buf[channel + 1:end if space < 0 else space].decode('utf-8', 'replace')
+
+	@property
+	def text(self):
+		"""The trailing parameter, e.g. the chat message of a PRIVMSG"""
+		if (self._match or self._parse()).start(TRAILING) >= 0:
+			return self._decode(TRAILING)
+		params = self._decode(PARAMS).split()
+		return params[-1] if params else ''
+
+	@property
+	def tags(self):
+		"""IRCv3 message tags as a dict of unescaped strings"""
+		tags = {}
+		for tag in self._decode(TAGS).split(';'):
+			key, _, value = tag.partition('=')
+			if key:
+				tags[key] = _unescape(value) if '\\' in value else value
+		return tags
+
+	@property
+	def raw(self):
+		"""The line as bytes, without the line ending"""
+		if self.start == 0 and self.end == len(self.buf):
+			return self.buf
+		return self.buf[self.start:self.end]
+
+	def detach(self):
+		"""Copies this message's line out of the shared receive buffer"""
+		if self.start != 0 or self.end != len(self.buf):
+			self.buf = self.raw
+			self.start, self.end = 0, len(self.buf)
+			self._match = None
+		return self
+
+class LineFramer:
+	"""Splits a stream of received chunks into Messages"""
+	def __init__(self):
+		self.tail = b''
+
+	def feed(self, data):
+		"""Returns the Messages for every complete line received so far"""
+		# only an incomplete line left over from the previous chunk is ever copied
+		buf = self.tail + data if self.tail else bytes(data)
+		messages = []
+		start = 0
+		while True:
+			newline = buf.find(b'\n', start)
+			if newline < 0:
+				break
+			end = newline - 1 if newline > start and buf[newline - 1] == 0x0d else newline
+			if end > start:
+				messages.append(Message(buf, start, end))
+			start = newline + 1
+		self.tail = buf[start:]
+		return messages
+
+def parse(line):
+	"""Parses a single line (str or bytes, without the line ending)"""
+	if isinstance(line, str):
+		line = line.encode('utf-8')
+	return Message(bytes(line))
+
+def _unescape(value):
+	out = []
+	i = 0
+	while i < len(value):
+		c = value[i]
+		if c == '\\':
+			i += 1
+			if i < len(value):
+				out.append(TAG_ESCAPES.get(value[i], value[i]))
+		else:
+			out.append(c)
+		i += 1
+	return ''.join(out)
@@ -0,0 +1,176 @@
+"""
+Watch-term matching for chat moderation.
+
+All terms for a channel are compiled into one Aho-Corasick automaton, so each
+message is scanned once, character by character, no matter how many terms
+there are. Matching is case-insensitive (terms and text are casefolded), and
+terms can be restricted to whole words.
+
+Watch lists are plain text files, with one term per line:
+
+	# comment
+	[*]             terms for every channel
+	some phrase
+	=kappa          '=' matches whole words only
+	[channelname]   terms for one channel, on top of the [*] ones
+	...
+
+Matcher is a chatclient consumer. Matcher.watch() polls the watch list and
+recompiles it in a worker thread when it changes; the new automata replace
+the old ones in a single assignment, so messages keep flowing through the
+old set until the new one is ready and none are skipped.
+"""
+
+import asyncio
+import collections
+import os
+
+ALL_CHANNELS = '*'
+
+# term is casefolded; label is the term as written in the watch list
+Pattern = collections.namedtuple('Pattern', 'term words label')
+# start and end are offsets into the casefolded message text
+Match = collections.namedtuple('Match', 'pattern start end')
+
+def is_word_char(c):
+	return c.isalnum() or c == '_'
+
+class Automaton:
+	def __init__(self, patterns):
+		# goto[state] maps a character to the next state; state 0 is the root
+		goto = [{}]
+		# patterns ending at each state, including those reached through fail links
+		out = [()]
+		self.count = 0
+		for pattern in patterns:
+			if not pattern.term:
+				continue
+			state = 0
+			for c in pattern.term:
+				next_state = goto[state].get(c)
+				if next_state is None:
+					next_state = goto[state][c] = len(goto)
+					goto.append({})
+					out.append(())
+				state = next_state
+			out[state] += (pattern,)
+			self.count += 1
+
+		# breadth first, so every fail link points at an already finished state
+		fail = [0] * len(goto)
+		queue = collections.deque(goto[0].values())
+		while queue:
+			state = queue.popleft()
+			for c, next_state in goto[state].items():
+				queue.append(next_state)
+				f = fail[state]
+				while f and c not in goto[f]:
+					f = fail[f]
+				fail[next_state] = goto[f].get(c, 0)
+				out[next_state] += out[fail[next_state]]
+
+		self.goto = goto
+		self.fail = fail
+		self.out = out
+
+	def search(self, text):
+		"""Returns every Match in 'text', which must already be casefolded"""
+		goto, fail, out = self.goto, self.fail, self.out
+		matches = []
+		state = 0
+		for i, c in enumerate(text):
+			next_state = goto[state].get(c)
+			while next_state is None and state:
+				state = fail[state]
+				next_state = goto[state].get(c)
+			state = next_state or 0
+
+			if out[state]:
+				end = i + 1
+				for pattern in out[state]:
+					start = end - len(pattern.term)
+					if pattern.words and ((start > 0 and is_word_char(text[start - 1])) or
+							(end < len(text) and is_word_char(text[end]))):
+						continue
+					matches.append(Match(pattern, start, end))
+		return matches
+
+def load_watchlist(filename):
+	"""Returns {channel: [Pattern]} from a watch list file; [*] terms are under ALL_CHANNELS"""
+	watchlist = {ALL_CHANNELS: []}
+	channel = ALL_CHANNELS
+	with open(filename, 'r', encoding='utf-8') as f:
+		for line in f:
+			line = line.strip()
+			if not line or line.startswith('#'):
+				continue
+			if line.startswith('[') and line.endswith(']'):
+				channel = line[1:-1].strip().lstrip('#').lower() or ALL_CHANNELS
+				watchlist.setdefault(channel, [])
+				continue
+			words = line.startswith('=')
+			label = line[1:].strip() if words else line
+			watchlist[channel].append(Pattern(label.casefold(), words, label))
+	return watchlist
+
+def compile_watchlist(watchlist):
+	"""Builds one automaton per channel, each including the terms for all channels"""
+	common = watchlist.get(ALL_CHANNELS, [])
+	automata = {ALL_CHANNELS: Automaton(common)}
+	for channel, patterns in watchlist.items():
+		if channel != ALL_CHANNELS:
+			automata[channel] = Automaton(common + patterns)
+	return automata
+
+def print_matches(message, matches):
+	print('[!] %s | %s : %s (%s)' % (message.channel, message.username, message.text,
+		', '.join(sorted(set(match.pattern.label for match in matches)))))
+
+class Matcher:
+	def __init__(self, watchlist=None, on_match=print_matches):
+		"""'watchlist' is a {channel: [Pattern]} dict; on_match(message, matches) is called for every hit"""
+		self.on_match = on_match
+		self.automata = compile_watchlist(watchlist or {})
+		self.checked = 0
+		self.matched = 0
+
+	def match(self, channel, text):
+		automata = self.automata
+		automaton = automata.get(channel) or automata[ALL_CHANNELS]
+		return automaton.search(text.casefold())
+
+	async def consume(self, message):
+		"""chatclient consumer handler"""
+		matches = self.match(message.channel, message.text)
+		self.checked += 1
+		if matches:
+			self.matched += 1
+			self.on_match(message, matches)
+
+	def reload(self, filename):
+		"""Loads and compiles a watch list; safe to run in a worker thread"""
+		watchlist = load_watchlist(filename)
+		automata = compile_watchlist(watchlist)
+		# a single assignment, so consume() sees either the old set or the new one
+		self.automata = automata
+		return sum(len(patterns) for patterns in watchlist.values())
+
+	async def watch(self, filename, interval=1.0):
+		"""Reloads the watch list whenever the file changes"""
+		loop = asyncio.get_running_loop()
+		mtime = None
+		error = None
+		while True:
+			try:
+				current = os.stat(filename).st_mtime_ns
+				if current != mtime:
+					mtime = current
+					count = await loop.run_in_executor(None, self.reload, filename)
+					print('[+] Loaded %d watch terms from %s' % (count, filename))
+				error = None
+			except (OSError, UnicodeDecodeError) as e:
+				# keep matching with the previous terms, and only complain once per problem
+				if str(e) != error:
+					error = str(e)
+					print('[+] Could not load watch list %s: %s' % (filename, e))
+			await asyncio.sleep(interval)
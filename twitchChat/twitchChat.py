@@ -1,5 +1,5 @@
 """
-Outputs twitch chat for the specified channel.
+Outputs twitch chat for the specified channels.
 
 Assumes there is an existing file in this directory named 'credentials'
 that contains a username and password in JSON format:
@@ -8,56 +8,80 @@ that contains a username and password in JSON format:
 Your OAuth token can be found here: http://www.twitchapps.com/tmi/
 """
 
+import argparse
+import asyncio
 import json
-import socket
-import string
-
-channel = "couragejd"
-
-# Set all the variables necessary to connect to Twitch IRC
-HOST = "irc.twitch.tv"
-PORT = 6667
-readbuffer = ""
-MODT = False
-credentials = json.loads(open('credentials', 'r').read())
-
-# Connecting to Twitch IRC by passing credentials and joining a certain channel
-s = socket.socket()
-s.connect((HOST, PORT))
-s.send("PASS " + credentials["PASS"] + "\r\n")
-s.send("NICK " + credentials["NICK"] + "\r\n")
-s.send("JOIN #" + channel + " \r\n")
-
-while True:
-	readbuffer = readbuffer + s.recv(1024)
-	temp = string.split(readbuffer, "\n")
-	readbuffer = temp.pop()
-	
-	for line in temp:
-		# Checks whether the message is PING because its a method of Twitch to check if you're afk
-		if (line[0] == "PING"):
-			s.send("PONG %s\r\n" % line[1])
-		else:
-			# Splits the given string so we can work with it better
-			parts = string.split(line, ":")
-			
-			if "QUIT" not in parts[1] and "JOIN" not in parts[1] and "PART" not in parts[1]:
-				try:
-					username = parts[1].split("!")[0]
-				except:
-					username = ""
-			
-				try:
-					# Sets the message variable to the actual message sent
-					message = parts[2][:len(parts[2]) - 1]
-				except:
-					message = ""
-				
-				# Only print after twitch is done announcing stuff (MODT = Message of the day)
-				if MODT:
-					print(username + " : " + message)
-					
-				# Set MODT to True after the last announcement message
-				for l in parts:
-					if "End of /NAMES list" in l:
-						MODT = True
+
+from analytics import Analytics, WINDOWS
+from chatclient import TwitchChatClient
+from chatlog import ChatLogSink
+from matcher import Matcher
+
+channels = ["couragejd"]
+
+async def print_message(message):
+	print(message.channel + " | " + message.username + " : " + message.text)
+
+async def print_analytics(analytics, interval):
+	while True:
+		await asyncio.sleep(interval)
+		for channel, stats in sorted(analytics.latest.items()):
+			print("[+] %s: %s msgs/s, %s chatters (1m/5m/15m), top: %s" % (channel,
+				"/".join("%.1f" % stats["rate"][w] for w in WINDOWS),
+				"/".join("%d" % stats["distinct"][w] for w in WINDOWS),
+				", ".join(name for name, _ in stats["top_chatters"][:5])))
+
+async def run(client, analytics, matcher, args):
+	tasks = [asyncio.ensure_future(client.run(args.stats))]
+	if matcher is not None:
+		tasks.append(asyncio.ensure_future(matcher.watch(args.watch)))
+	if analytics is not None:
+		tasks.append(asyncio.ensure_future(analytics.run(args.analytics)))
+		tasks.append(asyncio.ensure_future(print_analytics(analytics, args.analytics)))
+	await asyncio.gather(*tasks)
+
+def main():
+	parser = argparse.ArgumentParser(description="Output twitch chat for one or more channels.")
+	parser.add_argument("channels", nargs="*", default=channels, help="channels to join (default: %(default)s)")
+	parser.add_argument("--stats", type=float, default=0, metavar="SECONDS",
+		help="print message rate and queue depths every SECONDS")
+	parser.add_argument("--log", metavar="DIR", help="also store all messages in compressed logs under DIR")
+	parser.add_argument("--analytics", type=float, default=0, metavar="SECONDS",
+		help="print message rates, distinct chatters and top chatters per channel every SECONDS")
+	parser.add_argument("--watch", metavar="FILE",
+		help="report messages containing the terms in FILE, reloading it when it changes")
+	parser.add_argument("--quiet", action="store_true", help="do not print messages")
+	args = parser.parse_args()
+
+	credentials = json.loads(open('credentials', 'r').read())
+
+	client = TwitchChatClient(credentials, args.channels)
+	if not args.quiet:
+		# printing is cheap, but never let a blocked terminal stall the connections
+		client.add_consumer("print", print_message, maxsize=10000, policy="drop")
+	sink = None
+	if args.log:
+		sink = ChatLogSink(args.log)
+		# the log must not lose messages, so overflow goes to disk rather than being dropped
+		client.add_consumer("log", sink.consume, maxsize=10000, policy="spill")
+	analytics = None
+	if args.analytics:
+		analytics = Analytics()
+		# approximate statistics can afford to skip messages under load
+		client.add_consumer("analytics", analytics.consume, maxsize=10000, policy="drop")
+	matcher = None
+	if args.watch:
+		matcher = Matcher()
+		# moderation must see every message
+		client.add_consumer("watch", matcher.consume, maxsize=10000, policy="spill")
+
+	try:
+		asyncio.run(run(client, analytics, matcher, args))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if sink is not None:
+			sink.close()
+
+if __name__ == "__main__":
+	main()